@@ -10,6 +10,7 @@ from pychell.spectralmodeling.spectralrvprob import IterativeSpectralRVProb
 import pychell.spectralmodeling.spectralmodels as pcsm
 from pychell.spectralmodeling.spectral_objectives import WeightedSpectralUncRMS
 from pychell.spectralmodeling.template_augmenters import CubicSplineLSQ, WeightedMedian, WeightedMean
+from pychell.spectralmodeling.spectral_optimizers import LevenbergMarquardt
 import pychell.data.ishell as ishell
 
 # Optimize deps
@@ -63,9 +64,12 @@ for order_num in do_orders:
                                          target_dict=target_dict,
                                          augmenter=CubicSplineLSQ(max_thresh=1.005, downweight_tellurics=True),
                                          obj=WeightedSpectralUncRMS(),
-                                         optimizer=IterativeNelderMead(),
+                                         optimizer=IterativeNelderMead(), # Or LevenbergMarquardt() to use the Jacobian of WeightedSpectralUncRMS
+                                         n_chunks=1, # > 1 to fit overlapping sub-order chunks independently
+                                         plot_every=1, plot_worst=0, # e.g. plot_every=10, plot_worst=5 for large datasets
                                          n_cores=2,
+                                         persistent_pool=False, # True to ship the model to each worker once per run
                                          verbose=True)
     
-    # Run RVs for this order
-    specrvprob.compute_rvs_for_target()
\ No newline at end of file
+    # Run RVs for this order, resume=True picks up from the checkpoint of an interrupted run
+    specrvprob.compute_rvs_for_target(resume=False)
\ No newline at end of file
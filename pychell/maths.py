@@ -6,9 +6,11 @@ import sys
 
 # Science/Math
 import scipy.interpolate # spline interpolation
+import scipy.linalg
 from scipy import constants as cs # cs.c = speed of light in m/s
 import numpy as np
 import scipy.ndimage.filters
+import scipy.signal
 try:
     import torch
 except:
@@ -102,12 +104,13 @@ def rmsloss(x, y, weights=None, flag_worst=0, remove_edges=0):
         diffs2 *= weights[good]
         norm = np.copy(weights[good])
     
-    # Ignore worst N pixels
-    if flag_worst > 0:
-        ss = np.argsort(diffs2)
-        diffs2[ss[-1*flag_worst:]] = np.nan
+    # Ignore worst N pixels, only a partial sort is needed
+    if flag_worst > 0 and diffs2.size > 0:
+        k = diffs2.size - np.min([flag_worst, diffs2.size])
+        worst = np.argpartition(diffs2, k)[k:]
+        diffs2[worst] = np.nan
         if weights is not None:
-            norm[ss[-1*flag_worst:]] = 0
+            norm[worst] = 0
                 
     # Remove edges
     if remove_edges > 0:
@@ -151,6 +154,19 @@ def Rfromlsf(wave, fwhm=None, sigma=None):
     
     
 def rolling_clip(x, y, weights=None, width=None, method='median', n_sigma=3):
+    """Flags outliers within bins of a fixed width in x. Bin membership is found with np.searchsorted on the sorted abscissa and each bin is clipped in a compiled loop.
+
+    Args:
+        x (np.ndarray): The independent variable.
+        y (np.ndarray): The dependent variable.
+        weights (np.ndarray, optional): The weights. Defaults to uniform weights.
+        width (float, optional): The width of each bin in units of x. Defaults to the width containing ~10 good points on average.
+        method (str, optional): 'median' to clip about the weighted median with the scaled M.A.D., otherwise the weighted mean and stddev are used. Defaults to 'median'.
+        n_sigma (int, optional): The clipping threshold. Defaults to 3.
+
+    Returns:
+        np.ndarray: The mask, 0 for flagged points and 1 otherwise.
+    """
     
     # Mask must be the length of x
     mask = np.ones_like(x)
@@ -160,41 +176,107 @@ def rolling_clip(x, y, weights=None, width=None, method='median', n_sigma=3):
         weights = np.ones_like(x)
     good = np.where(np.isfinite(x) & np.isfinite(y) & np.isfinite(weights) & (weights >= 0))[0]
     n_good = len(good)
+    if n_good == 0:
+        return mask
+    
+    # Sort the good points by x
+    good = good[np.argsort(x[good], kind='stable')]
     xx, yy, ww = x[good], y[good], weights[good]
     
     # Start and last x value
     x_start = np.nanmin(x)
     x_end = np.nanmax(x)
-    delta_x = x_start - x_end
+    delta_x = x_end - x_start
     
     # Want n_per_bin ~ 10
+    n_per_bin = 10
     if width is None:
-        n_per_bin = 10
         width = n_per_bin * delta_x / n_good
         
-    # Bins
+    # Bins, and the range of sorted points within each (inclusive on both edges)
     n_bins = int(delta_x / width)
-    bins = np.linspace(x_end - width / 1000, x_start + width / 1000, num=n_bins + 1)
-    
-    # Loop over bins and flag
-    for i in range(len(bins) - 1):
-        use = np.where((xx >= bins[i]) & (xx <= bins[i+1]))[0]
-        if use.size >= n_per_bin / 2:
-            if method == 'median':
-                wmed = weighted_median(yy[use], weights=ww[use], percentile=0.5)
-                wavg = wmed
-                meddev = weighted_median(yy[use] - wmed, weights=ww[use], percentile=0.5)
-                wstddev = meddev * 1.4826
-            else:
-                wavg = weighted_mean(yy[use], ww[use])
-                wstddev = weighted_stddev(yy[use], ww[use])
-                
-            bad = np.where(np.abs(yy[use] - wavg) > n_sigma * wstddev)[0]
-            if bad.size > 0:
-                mask[use[bad]] = 0
+    bins = np.linspace(x_start - width / 1000, x_end + width / 1000, num=n_bins + 1)
+    bin_starts = np.searchsorted(xx, bins[:-1], side='left')
+    bin_ends = np.searchsorted(xx, bins[1:], side='right')
+    
+    # Flag
+    bad = _rolling_clip_bins(yy, ww, bin_starts, bin_ends, method == 'median', n_sigma, n_per_bin / 2)
+    mask[good[bad]] = 0
  
     return mask
 
+@njit(nogil=True)
+def _weighted_median_finite(data, weights, percentile):
+    """Compiled equivalent of weighted_median for finite data and weights.
+
+    Args:
+        data (np.ndarray): The input data.
+        weights (np.ndarray): The weights.
+        percentile (float): The desired percentile.
+
+    Returns:
+        float: The weighted percentile of the data.
+    """
+    n = data.size
+    percentile = percentile * np.sum(weights)
+    if np.any(weights > percentile):
+        return data[np.argmax(weights)]
+    inds = np.argsort(data)
+    cs = 0.0
+    idx = -1
+    for k in range(n):
+        cs += weights[inds[k]]
+        if cs <= percentile:
+            idx = k
+    if idx < 0 or (idx == n - 1 and weights[inds[idx]] != percentile):
+        return np.nan
+    if weights[inds[idx]] == percentile:
+        if idx == n - 1:
+            return data[inds[idx]]
+        return (data[inds[idx]] + data[inds[idx + 1]]) / 2
+    return data[inds[idx + 1]]
+
+@njit(nogil=True)
+def _rolling_clip_bins(y, w, bin_starts, bin_ends, use_median, n_sigma, min_count):
+    """Flags outliers within each bin of sorted data.
+
+    Args:
+        y (np.ndarray): The dependent variable, sorted by the independent variable.
+        w (np.ndarray): The corresponding weights.
+        bin_starts (np.ndarray): The first index of each bin.
+        bin_ends (np.ndarray): The last index + 1 of each bin.
+        use_median (bool): Whether to clip about the weighted median with the scaled M.A.D. or the weighted mean and stddev.
+        n_sigma (float): The clipping threshold.
+        min_count (float): Bins with fewer points are not clipped.
+
+    Returns:
+        np.ndarray: Boolean array, True for flagged points.
+    """
+    bad = np.zeros(y.size, dtype=np.bool_)
+    for i in range(bin_starts.size):
+        f, l = bin_starts[i], bin_ends[i]
+        if l - f < min_count:
+            continue
+        yy, ww = y[f:l], w[f:l]
+        if use_median:
+            wavg = _weighted_median_finite(yy, ww, 0.5)
+            wstddev = _weighted_median_finite(np.abs(yy - wavg), ww, 0.5) * 1.4826
+        else:
+            # Bins without two or more weighted points have an undefined stddev and are not clipped
+            wsum = np.sum(ww)
+            if wsum <= 0:
+                continue
+            wavg = np.sum(yy * ww) / wsum
+            wn = ww / wsum
+            bias_estimator = 1.0 - np.sum(wn**2) / np.sum(wn)**2
+            if bias_estimator <= 0:
+                continue
+            wstddev = np.sqrt(np.sum((yy - wavg)**2 * wn) / bias_estimator)
+        for k in range(f, l):
+            if np.abs(y[k] - wavg) > n_sigma * wstddev:
+                bad[k] = True
+    return bad
+
 def doppler_shift(wave, vel, wave_out=None, flux=None, interp='cspline', kind='exp'):
     
     if wave_out is None:
@@ -219,6 +301,48 @@ def doppler_shift(wave, vel, wave_out=None, flux=None, interp='cspline', kind='e
     return flux_out
     
 
+def doppler_shift_multi(wave, vels, wave_out=None, flux=None, interp='cspline', kind='exp'):
+    """Doppler shifts a spectrum by many velocities at once. Shifting the source grid by a constant factor is equivalent to evaluating the unshifted interpolant on the target grid divided by that factor, so the interpolant is constructed once.
+
+    Args:
+        wave (np.ndarray): The wavelength grid of the spectrum.
+        vels (np.ndarray): The velocities in m/s.
+        wave_out (np.ndarray, optional): The wavelength grid to interpolate onto. Defaults to wave.
+        flux (np.ndarray, optional): The flux. Defaults to None, in which case only the shifted wavelength grids are returned.
+        interp (str, optional): The interpolation method, 'cspline', 'akima', 'pchip', or 'linear'. Defaults to 'cspline'.
+        kind (str, optional): The type of shift, 'exp' or 'sr'. Defaults to 'exp'.
+
+    Returns:
+        np.ndarray: The shifted fluxes (or wavelength grids) with shape (n_vels, n_out).
+    """
+    
+    if wave_out is None:
+        wave_out = wave
+        
+    # Multiplicative factor for each velocity
+    vels = np.atleast_1d(vels).astype(np.float64)
+    if kind == 'exp':
+        factors = _dop_shift_exponential(np.ones(vels.size), vels)
+    else:
+        factors = _dop_shift_SR(np.ones(vels.size), vels)
+    
+    if interp is None and flux is None:
+        return np.outer(factors, wave)
+    
+    # Target grids in the frame of the unshifted spectrum
+    wave_eval = np.outer(1 / factors, wave_out)
+    
+    good = np.where(np.isfinite(wave) & np.isfinite(flux))[0]
+    if interp == 'cspline':
+        flux_out = scipy.interpolate.CubicSpline(wave[good], flux[good], extrapolate=False)(wave_eval)
+    elif interp == 'akima':
+        flux_out = scipy.interpolate.Akima1DInterpolator(wave[good], flux[good])(wave_eval)
+    elif interp == 'pchip':
+        flux_out = scipy.interpolate.PchipInterpolator(wave[good], flux[good], extrapolate=False)(wave_eval)
+    else:
+        flux_out = np.interp(wave_eval, wave[good], flux[good], left=np.nan, right=np.nan)
+    return flux_out
+
 def lin_interp(x, y, xnew):
     return np.interp(xnew, x, y, left=np.nan, right=np.nan)
 
@@ -226,6 +350,240 @@ def cspline_interp(x, y, xnew):
     good = np.where(np.isfinite(x) & np.isfinite(y))[0]
     return scipy.interpolate.CubicSpline(x[good], y[good], extrapolate=False)(xnew)
 
+def cspline_basis(x, xnew):
+    """Computes the matrix which maps values on x to the cubic spline through them (see cspline_interp) evaluated at xnew. The spline is linear in the values, so column j is the spline through the j'th unit vector.
+
+    Args:
+        x (np.ndarray): The knots, must be finite.
+        xnew (np.ndarray): The grid to evaluate the spline on.
+
+    Returns:
+        np.ndarray: The basis matrix; shape=(len(xnew), len(x)). Rows outside the knots are nan.
+    """
+    return np.array([cspline_interp(x, y, xnew) for y in np.eye(len(x))]).T
+
+@njit(nogil=True)
+def _all_finite(x):
+    """Whether or not every value of a 1d array is finite, without allocating a mask.
+
+    Args:
+        x (np.ndarray): The input array.
+
+    Returns:
+        bool: True if all values are finite.
+    """
+    for i in range(x.size):
+        if not np.isfinite(x[i]):
+            return False
+    return True
+
+@njit(nogil=True)
+def _cspline_slope_rhs(x, dx, y, b):
+    """Computes the right hand side of the not-a-knot cubic spline slope system in place, see CubicSplineInterp.slopes.
+
+    Args:
+        x (np.ndarray): The source grid.
+        dx (np.ndarray): The spacing of the source grid.
+        y (np.ndarray): The values on the source grid.
+        b (np.ndarray): The output array, of the same length as x.
+    """
+    n = x.size
+    for k in range(1, n - 1):
+        b[k] = 3 * (dx[k] * ((y[k] - y[k - 1]) / dx[k - 1]) + dx[k - 1] * ((y[k + 1] - y[k]) / dx[k]))
+    dd = x[2] - x[0]
+    b[0] = ((dx[0] + 2 * dd) * dx[1] * ((y[1] - y[0]) / dx[0]) + dx[0]**2 * ((y[2] - y[1]) / dx[1])) / dd
+    dd = x[n - 1] - x[n - 3]
+    b[n - 1] = (dx[n - 2]**2 * ((y[n - 2] - y[n - 3]) / dx[n - 3]) + (2 * dd + dx[n - 2]) * dx[n - 3] * ((y[n - 1] - y[n - 2]) / dx[n - 2])) / dd
+
+@njit(nogil=True)
+def _cspline_eval(y, s, inds, good_new, w00, w10, w01, w11, out):
+    """Evaluates a cubic Hermite spline in place, see CubicSplineInterp.__call__.
+
+    Args:
+        y (np.ndarray): The values on the source grid.
+        s (np.ndarray): The slopes on the source grid.
+        inds (np.ndarray): The left bracketing index of each good target point.
+        good_new (np.ndarray): The indices of the target points within the source grid.
+        w00 (np.ndarray): The Hermite basis weight of y[inds].
+        w10 (np.ndarray): The Hermite basis weight of s[inds].
+        w01 (np.ndarray): The Hermite basis weight of y[inds + 1].
+        w11 (np.ndarray): The Hermite basis weight of s[inds + 1].
+        out (np.ndarray): The output array, nan outside the source grid.
+    """
+    out[:] = np.nan
+    for j in range(good_new.size):
+        i = inds[j]
+        out[good_new[j]] = w00[j] * y[i] + w10[j] * s[i] + w01[j] * y[i + 1] + w11[j] * s[i + 1]
+
+def readonly_copy(x, dtype=None):
+    """Copies an array and makes the copy read-only, for grids and outputs which are stored by a cache.
+
+    Args:
+        x (np.ndarray): The input array.
+        dtype (type, optional): The dtype of the copy. Defaults to the dtype of x.
+
+    Returns:
+        np.ndarray: The read-only copy.
+    """
+    x = np.array(x, dtype=dtype)
+    x.setflags(write=False)
+    return x
+
+def same_values(x, x_ref):
+    """Determines whether an array matches a grid stored by a cache (see readonly_copy). The stored grid can't be modified in place, so it matches itself, and any other array matches if its values are identical.
+
+    Args:
+        x (np.ndarray): The input array.
+        x_ref (np.ndarray): The stored read-only grid, or None.
+
+    Returns:
+        bool: Whether or not the values are identical.
+    """
+    return x is x_ref or (x_ref is not None and np.shape(x) == x_ref.shape and np.array_equal(x, x_ref))
+
+class CubicSplineInterp:
+    """Cubic spline interpolation from a fixed source grid, identical to cspline_interp (not-a-knot, no extrapolation) for finite y. The tridiagonal system for the spline slopes is factored once, and the bracketing indices and Hermite basis weights are computed once per target grid, so each new y costs one banded solve and a sparse gather. Both grids are stored as read-only copies, and a target grid is matched by its values, so arrays modified in place by the caller are never interpolated with stale weights.
+    """
+    
+    def __init__(self, x, xnew=None):
+        """Initiate a cubic spline interpolator.
+
+        Args:
+            x (np.ndarray): The source grid, must be finite, strictly increasing, and contain at least 4 points.
+            xnew (np.ndarray, optional): The target grid. Defaults to None, and must then be passed on each call.
+        """
+        self.x = readonly_copy(x, dtype=np.float64)
+        assert self.x.size >= 4
+        self.dx = np.diff(self.x)
+        
+        # Banded slope system for not-a-knot boundaries (see scipy.interpolate.CubicSpline)
+        x, dx = self.x, self.dx
+        dl, d, du = np.zeros(x.size - 1), np.zeros(x.size), np.zeros(x.size - 1)
+        d[1:-1] = 2 * (dx[:-1] + dx[1:])
+        du[1:] = dx[:-1]
+        dl[:-1] = dx[1:]
+        d[0], du[0] = dx[1], x[2] - x[0]
+        d[-1], dl[-1] = dx[-2], x[-1] - x[-3]
+        
+        # Factor once
+        self._dl, self._d, self._du, self._du2, self._ipiv, info = scipy.linalg.lapack.dgttrf(dl, d, du)
+        if info != 0:
+            raise ValueError("Singular cubic spline system")
+        
+        # Target grid
+        self.xnew = None
+        if xnew is not None:
+            self.set_target(xnew)
+        
+    def set_target(self, xnew):
+        """Computes the bracketing indices and Hermite basis weights for a target grid.
+
+        Args:
+            xnew (np.ndarray): The target grid.
+        """
+        self.xnew = readonly_copy(xnew, dtype=np.float64)
+        x, dx, xnew = self.x, self.dx, self.xnew
+        self.good_new = np.where((xnew >= x[0]) & (xnew <= x[-1]))[0]
+        xx = xnew[self.good_new]
+        self.inds = np.clip(np.searchsorted(x, xx, side='right') - 1, 0, x.size - 2)
+        h = dx[self.inds]
+        u = (xx - x[self.inds]) / h
+        self._h, self._u = h, u
+        self.w00 = (1 + 2 * u) * (1 - u)**2
+        self.w10 = u * (1 - u)**2 * h
+        self.w01 = u**2 * (3 - 2 * u)
+        self.w11 = u**2 * (u - 1) * h
+        
+    def slopes(self, y, out=None):
+        """Solves for the spline slopes at the source grid.
+
+        Args:
+            y (np.ndarray): The values on the source grid.
+            out (np.ndarray, optional): A float64 array of the same length as the source grid to solve in place. Defaults to None.
+
+        Returns:
+            np.ndarray: The first derivatives at each source point.
+        """
+        if out is None:
+            out = np.empty(self.x.size)
+        _cspline_slope_rhs(self.x, self.dx, y, out)
+        s, _ = scipy.linalg.lapack.dgttrs(self._dl, self._d, self._du, self._du2, self._ipiv, out, overwrite_b=1)
+        return s
+    
+    def __call__(self, y, xnew=None, s=None, out=None, work=None):
+        """Interpolates y from the source grid onto the target grid.
+
+        Args:
+            y (np.ndarray): The values on the source grid.
+            xnew (np.ndarray, optional): The target grid. If not the current target grid, the weights are recomputed. Defaults to the current target grid.
+            s (np.ndarray, optional): The slopes of y from slopes(y), which are linear in y and may be precomputed. Defaults to None.
+            out (np.ndarray, optional): A float64 array of the same length as the target grid to store the result. Defaults to None.
+            work (np.ndarray, optional): A float64 array of the same length as the source grid to store the slopes if s is not provided. Defaults to None.
+
+        Returns:
+            np.ndarray: The interpolated values, nan outside the source grid.
+        """
+        if xnew is not None and not same_values(xnew, self.xnew):
+            self.set_target(xnew)
+        if s is None:
+            if not _all_finite(y):
+                return cspline_interp(self.x, y, self.xnew)
+            s = self.slopes(y, out=work)
+        if out is None:
+            out = np.empty(len(self.xnew))
+        _cspline_eval(y, s, self.inds, self.good_new, self.w00, self.w10, self.w01, self.w11, out)
+        return out
+    
+    def derivative(self, y, xnew=None):
+        """Evaluates the first derivative of the spline through y on the target grid.
+
+        Args:
+            y (np.ndarray): The values on the source grid, must be finite.
+            xnew (np.ndarray, optional): The target grid. If not the current target grid, the weights are recomputed. Defaults to the current target grid.
+
+        Returns:
+            np.ndarray: The derivative dy/dx, nan outside the source grid.
+        """
+        if xnew is not None and not same_values(xnew, self.xnew):
+            self.set_target(xnew)
+        s = self.slopes(y)
+        i, h, u = self.inds, self._h, self._u
+        out = np.full(len(self.xnew), np.nan)
+        out[self.good_new] = 6 * u * (u - 1) * (y[i] - y[i + 1]) / h + (1 - u) * (1 - 3 * u) * s[i] + u * (3 * u - 2) * s[i + 1]
+        return out
+    
+    def interp_torch(self, y, xnew=None):
+        """Differentiable equivalent of __call__ for torch tensors. Gradients propagate to both y and xnew, and the slope system is solved with the same factorization through TridiagonalSolve.
+
+        Args:
+            y (torch.Tensor): The values on the source grid, must be finite.
+            xnew (torch.Tensor, optional): The target grid. Defaults to the current target grid.
+
+        Returns:
+            torch.Tensor: The interpolated values, nan outside the source grid.
+        """
+        x, dx = torch.from_numpy(self.x), torch.from_numpy(self.dx)
+        if xnew is None:
+            xnew = self.xnew
+        xnew = torch.as_tensor(xnew, dtype=torch.float64)
+        
+        # Right hand side of the slope system, see slopes
+        slope = (y[1:] - y[:-1]) / dx
+        dd0, dd1 = self.x[2] - self.x[0], self.x[-1] - self.x[-3]
+        b0 = ((dx[0] + 2 * dd0) * dx[1] * slope[0] + dx[0]**2 * slope[1]) / dd0
+        b1 = (dx[-1]**2 * slope[-2] + (2 * dd1 + dx[-1]) * dx[-2] * slope[-1]) / dd1
+        b = torch.cat([b0.reshape(1), 3 * (dx[1:] * slope[:-1] + dx[:-1] * slope[1:]), b1.reshape(1)])
+        s = TridiagonalSolve.apply(b, self)
+        
+        # Hermite basis on the target grid, points outside the source grid are evaluated at x[0] to keep their gradients finite
+        good = (xnew >= x[0]) & (xnew <= x[-1])
+        xnew = torch.where(good, xnew, x[0])
+        i = torch.clamp(torch.searchsorted(x, xnew.detach(), right=True) - 1, 0, x.numel() - 2)
+        h = dx[i]
+        u = (xnew - x[i]) / h
+        out = (1 + 2 * u) * (1 - u)**2 * y[i] + u * (1 - u)**2 * h * s[i] + u**2 * (3 - 2 * u) * y[i + 1] + u**2 * (u - 1) * h * s[i + 1]
+        return torch.where(good, out, torch.full_like(out, np.nan))
+
 def cspline_fit(x, y, knots, weights=None):
     if weights is None:
         weights = np.ones_like(y)
@@ -259,13 +617,14 @@ def fmedian(x):
         return np.nanmedian(x)
 
 # Fast median filter 1d over a fixed box width in "pixels"
-def median_filter1d(x, width, preserve_nans=True):
+def median_filter1d(x, width, preserve_nans=True, method="sorted"):
     """Computes a median 1d filter.
 
     Args:
         x (np.ndarray): The array to filter.
         width (int): The width of the filter.
         preserve_nans (bool, optional): Whether or not to preserve any nans or infs which may get overwritten. Defaults to True.
+        method (str, optional): "sorted" for the compiled running median, or "generic" for scipy's generic_filter with fmedian. Defaults to "sorted".
 
     Returns:
         np.ndarray: The filtered array.
@@ -276,6 +635,8 @@ def median_filter1d(x, width, preserve_nans=True):
     
     if good.size == 0:
         return np.full(x.size, fill_value=np.nan)
+    elif method == "sorted":
+        out = _median_filter1d_sorted(np.asarray(x, dtype=np.float64), int(width))
     else:
         out = scipy.ndimage.filters.generic_filter(x, fmedian, size=width, cval=np.nan, mode='constant')    
         
@@ -284,6 +645,151 @@ def median_filter1d(x, width, preserve_nans=True):
         
     return out
 
+@njit(nogil=True)
+def _sorted_window_insert(window, n, val):
+    """Inserts val into the sorted window[:n] in place.
+
+    Args:
+        window (np.ndarray): The window buffer, sorted up to n.
+        n (int): The number of values currently in the window.
+        val (float): The value to insert.
+    """
+    i = n
+    while i > 0 and window[i - 1] > val:
+        window[i] = window[i - 1]
+        i -= 1
+    window[i] = val
+
+@njit(nogil=True)
+def _sorted_window_remove(window, n, val):
+    """Removes one instance of val from the sorted window[:n] in place.
+
+    Args:
+        window (np.ndarray): The window buffer, sorted up to n.
+        n (int): The number of values currently in the window.
+        val (float): The value to remove, must be present in the window.
+    """
+    k = 0
+    while k < n - 1 and window[k] != val:
+        k += 1
+    for i in range(k, n - 1):
+        window[i] = window[i + 1]
+
+@njit(nogil=True)
+def _sorted_window_median(window, n, n_inf):
+    """The nan-median of a sorted window, nan if the window holds no finite values.
+
+    Args:
+        window (np.ndarray): The window buffer, sorted up to n (nans excluded).
+        n (int): The number of values currently in the window.
+        n_inf (int): The number of infs currently in the window.
+
+    Returns:
+        float: The median.
+    """
+    if n - n_inf <= 0:
+        return np.nan
+    m = n // 2
+    if n % 2 == 1:
+        return window[m]
+    else:
+        return (window[m - 1] + window[m]) / 2
+
+@njit(nogil=True)
+def _median_filter1d_sorted(x, width):
+    """Running median which keeps the non-nan values of the current window sorted. Windows are aligned identically to scipy.ndimage.generic_filter(..., mode='constant', cval=np.nan).
+
+    Args:
+        x (np.ndarray): The array to filter.
+        width (int): The width of the filter.
+
+    Returns:
+        np.ndarray: The filtered array.
+    """
+    nx = x.size
+    out = np.empty(nx, dtype=np.float64)
+    window = np.empty(width, dtype=np.float64)
+    n, n_inf = 0, 0
+    offset = width // 2
+    
+    # Initial window for the first pixel
+    for j in range(-offset, width - offset):
+        if j >= 0 and j < nx and not np.isnan(x[j]):
+            _sorted_window_insert(window, n, x[j])
+            n += 1
+            if np.isinf(x[j]):
+                n_inf += 1
+    out[0] = _sorted_window_median(window, n, n_inf)
+    
+    # Slide the window, one value leaves and one enters
+    for i in range(1, nx):
+        jout = i - offset - 1
+        jin = i - offset + width - 1
+        if jout >= 0 and jout < nx and not np.isnan(x[jout]):
+            _sorted_window_remove(window, n, x[jout])
+            n -= 1
+            if np.isinf(x[jout]):
+                n_inf -= 1
+        if jin >= 0 and jin < nx and not np.isnan(x[jin]):
+            _sorted_window_insert(window, n, x[jin])
+            n += 1
+            if np.isinf(x[jin]):
+                n_inf += 1
+        out[i] = _sorted_window_median(window, n, n_inf)
+    
+    return out
+
+@njit(nogil=True, parallel=True)
+def _median_filter2d_sorted(x, width):
+    """Running 2d box median. Each row slides a sorted window of the non-nan values in the box, removing and inserting one column of the box per step. Windows are aligned identically to scipy.ndimage.generic_filter(..., mode='constant', cval=np.nan).
+
+    Args:
+        x (np.ndarray): The image to filter.
+        width (int): The width of the (square) filter.
+
+    Returns:
+        np.ndarray: The filtered image.
+    """
+    ny, nx = x.shape
+    out = np.empty((ny, nx), dtype=np.float64)
+    offset = width // 2
+    for i in prange(ny):
+        window = np.empty(width * width, dtype=np.float64)
+        n, n_inf = 0, 0
+        ylow, yhigh = max(i - offset, 0), min(i - offset + width, ny)
+        
+        # Initial window for the first column
+        for j in range(max(-offset, 0), min(width - offset, nx)):
+            for k in range(ylow, yhigh):
+                if not np.isnan(x[k, j]):
+                    _sorted_window_insert(window, n, x[k, j])
+                    n += 1
+                    if np.isinf(x[k, j]):
+                        n_inf += 1
+        out[i, 0] = _sorted_window_median(window, n, n_inf)
+        
+        # Slide the window, one column leaves and one enters
+        for j in range(1, nx):
+            jout = j - offset - 1
+            jin = j - offset + width - 1
+            if jout >= 0 and jout < nx:
+                for k in range(ylow, yhigh):
+                    if not np.isnan(x[k, jout]):
+                        _sorted_window_remove(window, n, x[k, jout])
+                        n -= 1
+                        if np.isinf(x[k, jout]):
+                            n_inf -= 1
+            if jin >= 0 and jin < nx:
+                for k in range(ylow, yhigh):
+                    if not np.isnan(x[k, jin]):
+                        _sorted_window_insert(window, n, x[k, jin])
+                        n += 1
+                        if np.isinf(x[k, jin]):
+                            n_inf += 1
+            out[i, j] = _sorted_window_median(window, n, n_inf)
+    
+    return out
+
 # Returns a gaussian
 @njit
 def gauss(x, amp, mu, sigma):
@@ -363,13 +869,14 @@ def robust_stddev(x):
         return 0
 
 
-def median_filter2d(x, width, preserve_nans=True):
+def median_filter2d(x, width, preserve_nans=True, method="sorted"):
     """Computes a median 2d filter.
 
     Args:
         x (np.ndarray): The array to filter.
         width (int): The width of the filter.
         preserve_nans (bool, optional): Whether or not to preserve any nans or infs which may get overwritten. Defaults to True.
+        method (str, optional): "sorted" for the compiled running median, or "generic" for scipy's generic_filter with fmedian. Defaults to "sorted".
 
     Returns:
         np.ndarray: The filtered array.
@@ -379,6 +886,8 @@ def median_filter2d(x, width, preserve_nans=True):
     
     if good[0].size == 0:
         return np.full(x.shape, fill_value=np.nan)
+    elif method == "sorted":
+        out = _median_filter2d_sorted(np.asarray(x, dtype=np.float64), int(width))
     else:
         out = scipy.ndimage.filters.generic_filter(x, fmedian, size=width, cval=np.nan, mode='constant')
     
@@ -543,6 +1052,100 @@ def convolve_flux(wave, flux, R=None, width=None, interp=None, lsf=None, croplsf
     
     return fluxc
 
+class FluxConvolver:
+    """Convolves flux on a fixed uniform grid with a kernel of odd length up to a fixed maximum, equivalent to convolve_flux(None, flux, lsf=lsf, interp=False) for finite flux. The padded buffer is allocated once, and the choice of direct vs. FFT (overlap-add) convolution is made once per kernel length.
+    """
+    
+    def __init__(self, nx, nk, method=None, dtype=np.float64):
+        """Initiate a flux convolver.
+
+        Args:
+            nx (int): The number of flux points to convolve.
+            nk (int): The maximum number of kernel points, must be odd.
+            method (str, optional): "direct" or "fft". Defaults to None, which chooses the faster method from nx and the length of each kernel.
+            dtype (type, optional): The precision of the convolution, the kernel is cast to this type. Defaults to np.float64.
+        """
+        assert nk % 2 == 1
+        self.nx = nx
+        self.nk = nk
+        self.n_pad = int(nk / 2)
+        self.flux_padded = np.zeros(nx + 2 * self.n_pad, dtype=dtype)
+        self.auto_method = method is None
+        if method is None:
+            method = scipy.signal.choose_conv_method(self.flux_padded, np.ones(nk), mode='valid')
+        self.method = method
+        self.methods = {nk: method}
+        
+    def convolve(self, flux, lsf, out=None):
+        """Convolves the flux with the kernel.
+
+        Args:
+            flux (np.ndarray): The flux to convolve, of length nx.
+            lsf (np.ndarray): The kernel, of odd length up to nk.
+            out (np.ndarray, optional): An array of length nx with the dtype of the convolver to store the result. Defaults to None.
+
+        Returns:
+            np.ndarray: The convolved flux.
+        """
+        
+        # Masked values are removed before convolving, defer to the general routine
+        if not _all_finite(flux):
+            fluxc = convolve_flux(None, flux, interp=False, lsf=lsf)
+            if out is None:
+                return fluxc
+            out[:] = fluxc
+            return out
+        
+        # Pad with the edge values
+        n_pad = self.n_pad
+        self.flux_padded[n_pad:n_pad + self.nx] = flux
+        self.flux_padded[0:n_pad] = flux[0]
+        self.flux_padded[n_pad + self.nx:] = flux[-1]
+        lsf = lsf.astype(self.flux_padded.dtype, copy=False)
+        
+        # Shorter kernels only need part of the padding
+        flux_padded = self.flux_padded[n_pad - int(lsf.size / 2):n_pad + self.nx + int(lsf.size / 2)]
+        
+        # Method for this kernel length
+        method = self.method
+        if self.auto_method:
+            if lsf.size not in self.methods:
+                self.methods[lsf.size] = scipy.signal.choose_conv_method(flux_padded, lsf, mode='valid')
+            method = self.methods[lsf.size]
+        
+        # Convolve
+        if method == "fft":
+            fluxc = scipy.signal.oaconvolve(flux_padded, lsf, mode='valid')
+        else:
+            fluxc = np.convolve(flux_padded, lsf, mode='valid')
+        if out is None:
+            return fluxc
+        out[:] = fluxc
+        return out
+        
+    def convolve_torch(self, flux, lsf):
+        """Differentiable equivalent of convolve for torch tensors, the flux must be finite.
+
+        Args:
+            flux (torch.Tensor): The flux to convolve, of length nx.
+            lsf (torch.Tensor): The kernel, of length nk.
+
+        Returns:
+            torch.Tensor: The convolved flux.
+        """
+        
+        # Pad with the edge values, shorter kernels only need part of the padding
+        n_pad = int(lsf.numel() / 2)
+        flux_padded = torch.cat([flux[0:1].expand(n_pad), flux, flux[-1:].expand(n_pad)])
+        
+        # Convolve
+        if self.method == "fft":
+            n = flux_padded.numel() + lsf.numel() - 1
+            fluxc = torch.fft.irfft(torch.fft.rfft(flux_padded, n) * torch.fft.rfft(lsf, n), n)
+            return fluxc[lsf.numel() - 1:flux_padded.numel()]
+        else:
+            return torch.nn.functional.conv1d(flux_padded[None, None, :], torch.flip(lsf, (0,))[None, None, :])[0, 0]
+
 @njit
 def width_from_R(R, ml):
     return ml / (2 * np.sqrt(2 * np.log(2)) * R)
@@ -595,6 +1198,57 @@ def hermfun(x, deg):
             herm[:, k] = np.sqrt(2 / k) * (x * herm[:, k-1] - np.sqrt((k - 1) / 2) * herm[:, k-2])
     return herm
 
+@njit(nogil=True)
+def hermite_band_operator(pos, n_half, scale, coeffs):
+    """Computes a banded operator which convolves a uniformly sampled signal with a sum of Hermite-Gaussian functions and samples the result at fractional grid positions. Row j holds the kernel evaluated at the offsets of pos[j] from the grid points floor(pos[j]) - n_half through floor(pos[j]) + n_half + 1, normalized to sum to 1.
+
+    Args:
+        pos (np.ndarray): The fractional grid positions to sample.
+        n_half (int): The half width of the band in grid points.
+        scale (float): The grid spacing divided by the width of the Hermite-Gaussian functions.
+        coeffs (np.ndarray): The coefficient of each Hermite-Gaussian function, see hermfun.
+
+    Returns:
+        np.ndarray: The grid index of each entry (not clipped to the grid); shape=(len(pos), 2 * n_half + 2).
+        np.ndarray: The weight of each entry.
+    """
+    n, nb, deg = pos.size, 2 * n_half + 2, coeffs.size - 1
+    inds = np.empty((n, nb), dtype=np.int64)
+    weights = np.empty((n, nb))
+    
+    # Recursion constants of the Hermite functions
+    a_rec, b_rec = np.zeros(deg + 1), np.zeros(deg + 1)
+    for k in range(2, deg + 1):
+        a_rec[k], b_rec[k] = np.sqrt(2 / k), np.sqrt((k - 1) / 2)
+    
+    # Consecutive Gaussians along a row differ by a ratio which itself changes by a constant factor, so each row only needs two exps
+    c = np.exp(-1 * scale**2)
+    for j in range(n):
+        i0 = int(np.floor(pos[j])) - n_half
+        x0 = (pos[j] - i0) * scale
+        gauss = np.pi**-0.25 * np.exp(-0.5 * x0**2)
+        ratio = np.exp(scale * x0 - 0.5 * scale**2)
+        s = 0.0
+        for m in range(nb):
+            x = (pos[j] - (i0 + m)) * scale
+            if m > 0:
+                gauss *= ratio
+                ratio *= c
+            herm_prev = gauss
+            val = coeffs[0] * herm_prev
+            if deg > 0:
+                herm = np.sqrt(2.0) * herm_prev * x
+                val += coeffs[1] * herm
+                for k in range(2, deg + 1):
+                    herm_prev, herm = herm, a_rec[k] * (x * herm - b_rec[k] * herm_prev)
+                    val += coeffs[k] * herm
+            inds[j, m] = i0 + m
+            weights[j, m] = val
+            s += val
+        for m in range(nb):
+            weights[j, m] /= s
+    return inds, weights
+
 # This calculates the median absolute deviation of array x
 def mad(x):
     """Computes the true median absolute deviation.
@@ -620,28 +1274,98 @@ def weighted_median(data, weights=None, percentile=0.5):
         float: The weighted percentile of the data.
     """
     if weights is None:
-        weights = np.ones(shape=data.shape, dtype=np.float64)
-    bad = np.where(~np.isfinite(data))
-    if bad[0].size == data.size:
+        return _uniform_percentile(data, percentile)
+    return weighted_percentile(data, weights, q=percentile, axis=None)
+
+def _uniform_percentile(data, percentile):
+    """Equivalent of weighted_median with uniform weights using an O(n) selection instead of a sort.
+
+    Args:
+        data (np.ndarray): The input data.
+        percentile (float): The desired percentile.
+
+    Returns:
+        float: The percentile of the finite data.
+    """
+    x = np.asarray(data, dtype=np.float64).ravel()
+    x = x[np.isfinite(x)]
+    n = x.size
+    if n == 0:
         return np.nan
-    if bad[0].size > 0:
-        weights[bad] = 0
-    data = data.flatten()
-    weights = weights.flatten()
-    inds = np.argsort(data)
-    data_s = data[inds]
-    weights_s = weights[inds]
-    percentile = percentile * np.nansum(weights)
-    if np.any(weights > percentile):
-        good = np.where(weights == np.nanmax(weights))[0][0]
-        w_median = data[good]
+    cs_percentile = percentile * n
+    
+    # A single weight exceeds the percentile
+    if cs_percentile < 1:
+        return float(x[0])
+    
+    # The data point after the last index where the cumulative weight is <= the percentile
+    k = int(np.floor(cs_percentile))
+    if k >= n:
+        return weighted_percentile(data, None, q=percentile, axis=None)
+    x.partition(k)
+    if cs_percentile == 1:
+        return float((x[0] + x[1]) / 2)
+    return float(x[k])
+
+def weighted_percentile(x, w=None, q=0.5, axis=-1):
+    """Computes the weighted percentile along an axis with a single sort. Data which are nan or inf receive zero weight, and slices with no finite data are nan. Neither input is modified.
+
+    Args:
+        x (np.ndarray): The input data.
+        w (np.ndarray, optional): How to weight the data, must be broadcastable to x. Defaults to uniform weights.
+        q (float, optional): The desired percentile in [0, 1). Defaults to 0.5.
+        axis (int, optional): The axis to compute the percentile along. If None, the flattened array is used. Defaults to -1.
+
+    Returns:
+        np.ndarray or float: The weighted percentile(s), with the axis removed.
+    """
+    
+    # Move the axis of interest to the end
+    x = np.asarray(x, dtype=np.float64)
+    if w is None:
+        w = np.ones(x.shape)
     else:
-        cs_weights = np.nancumsum(weights_s)
-        idx = np.where(cs_weights <= percentile)[0][-1]
-        if weights_s[idx] == percentile:
-            w_median = np.nanmean(data_s[idx:idx+2])
-        else:
-            w_median = data_s[idx+1]
+        w = np.broadcast_to(np.asarray(w, dtype=np.float64), x.shape)
+    if axis is None:
+        x, w, axis = x.ravel(), w.ravel(), -1
+    x, w = np.moveaxis(x, axis, -1), np.moveaxis(w, axis, -1)
+    n = x.shape[-1]
+    
+    # Zero weight for bad data
+    bad = ~np.isfinite(x)
+    w = np.where(bad, 0, w)
+    
+    # Sort along the axis
+    inds = np.argsort(x, axis=-1)
+    x_s = np.take_along_axis(x, inds, axis=-1)
+    w_s = np.take_along_axis(w, inds, axis=-1)
+    percentile = q * np.nansum(w, axis=-1)
+    
+    # If a single weight exceeds the percentile, use the data point with the largest weight
+    big = np.any(w > percentile[..., None], axis=-1)
+    imax = np.argmax(np.where(np.isnan(w), -np.inf, w), axis=-1)
+    w_median_big = np.take_along_axis(x, imax[..., None], axis=-1)[..., 0]
+    
+    # Otherwise use the last index where the cumulative weight is <= the percentile
+    cs_weights = np.nancumsum(w_s, axis=-1)
+    below = cs_weights <= percentile[..., None]
+    idx = n - 1 - np.argmax(below[..., ::-1], axis=-1)
+    x_lo = np.take_along_axis(x_s, idx[..., None], axis=-1)[..., 0]
+    x_hi = np.take_along_axis(x_s, np.minimum(idx + 1, n - 1)[..., None], axis=-1)[..., 0]
+    x_hi = np.where(idx + 1 < n, x_hi, np.nan)
+    w_lo = np.take_along_axis(w_s, idx[..., None], axis=-1)[..., 0]
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        x_mid = np.nanmean(np.array([x_lo, x_hi]), axis=0)
+    w_median = np.where(w_lo == percentile, x_mid, x_hi)
+    w_median = np.where(np.any(below, axis=-1), w_median, np.nan)
+    
+    # Combine
+    w_median = np.where(big, w_median_big, w_median)
+    w_median = np.where(np.all(bad, axis=-1), np.nan, w_median)
+    
+    if w_median.ndim == 0:
+        return float(w_median)
     return w_median
 
 # This calculates the unbiased weighted standard deviation of array x with weights w
@@ -745,10 +1469,10 @@ def weighted_combine(y, w, yerr=None, err_type="Poisson"):
 
 # Rolling function f over a window given w of y given the independent variable x
 def rolling_fun_true_window(f, x, y, w):
-    """Computes a filter over the data using windows determined from a proper independent variable.
+    """Computes a filter over the data using windows determined from a proper independent variable. Window bounds are found with np.searchsorted on the sorted abscissa. If f is np.median or np.nanmedian, a compiled running median is used.
 
     Args:
-        f (function): The desired filter, must take a numpy array as input.
+        f (function): The desired filter, must take a numpy array as input. The values in each window are passed in order of increasing x.
         x (np.ndarray): The independent variable.
         y (np.ndarray): The dependent variable.
         w (float): Window size (in units of x)
@@ -756,17 +1480,72 @@ def rolling_fun_true_window(f, x, y, w):
     Returns:
         np.ndarray: The filtered array.
     """
+    
+    # Sort by x, points with nan x are never in a window
+    good = np.where(~np.isnan(x))[0]
+    ss = good[np.argsort(x[good], kind='stable')]
+    xs, ys = x[ss], y[ss]
+    
+    # Windows are (x - w/2, x + w/2]
+    lefts = np.searchsorted(xs, x - w / 2, side='right')
+    rights = np.searchsorted(xs, x + w / 2, side='right')
+    
+    # Compiled running median for sorted windows
+    if f is np.median or f is np.nanmedian:
+        output = np.empty(x.size, dtype=np.float64)
+        output[ss] = _rolling_median_sorted(ys.astype(np.float64), lefts[ss], rights[ss], f is np.nanmedian)
+        bad = np.where(np.isnan(x))[0]
+        if bad.size > 0:
+            output[bad] = np.nan
+        return output
+    
     output = np.empty(x.size, dtype=np.float64)
-
     for i in range(output.size):
-        locs = np.where((x > x[i] - w/2) & (x <= x[i] + w/2))
-        if len(locs) == 0:
-            output[i] = np.nan
-        else:
-            output[i] = f(y[locs])
+        output[i] = f(ys[lefts[i]:rights[i]])
 
     return output
 
+@njit(nogil=True)
+def _rolling_median_sorted(y, lefts, rights, ignore_nans):
+    """Running median over windows [lefts[i], rights[i]) of y, where both bounds are non-decreasing. The values of the current window are kept sorted.
+
+    Args:
+        y (np.ndarray): The values.
+        lefts (np.ndarray): The first index of each window.
+        rights (np.ndarray): The last index + 1 of each window.
+        ignore_nans (bool): If True, nans are ignored (np.nanmedian), otherwise any nan in the window yields nan (np.median).
+
+    Returns:
+        np.ndarray: The median of each window.
+    """
+    n = lefts.size
+    out = np.empty(n, dtype=np.float64)
+    max_size = 1
+    for i in range(n):
+        max_size = max(max_size, rights[i] - lefts[i])
+    window = np.empty(max_size, dtype=np.float64)
+    nw, n_nan = 0, 0
+    left, right = 0, 0
+    for i in range(n):
+        while right < rights[i]:
+            if np.isnan(y[right]):
+                n_nan += 1
+            else:
+                _sorted_window_insert(window, nw, y[right])
+                nw += 1
+            right += 1
+        while left < lefts[i]:
+            if np.isnan(y[left]):
+                n_nan -= 1
+            else:
+                _sorted_window_remove(window, nw, y[left])
+                nw -= 1
+            left += 1
+        if n_nan > 0 and not ignore_nans:
+            out[i] = np.nan
+        else:
+            out[i] = _sorted_window_median(window, nw, 0)
+    return out
 
 # Rolling function f over a window given w of y given the independent variable x
 def rolling_stddev_overcols(image, nbins):
@@ -909,6 +1688,127 @@ def cross_correlate3(x1, y1, x2, y2, vels):
         corrfun[i] = rmsloss(y1, y2_shifted)
     return corrfun
 
+def cross_correlate_fft(y1, y2, lags):
+    """Cross-correlation in "pixel" space for integer lags using FFTs. For each lag, this is the mean of y1 * (y2 shifted by lag) over pixels where both are finite, as in cross_correlate2 with x1 = np.arange(n1) and x2 = np.arange(n2). All lags come from one FFT, so the cost does not scale with the number of lags.
+
+    Args:
+        y1 (np.ndarray): The array(s) to cross-correlate, shape (n1,) or (n_rows, n1).
+        y2 (np.ndarray): The array(s) to cross-correlate against, shape (n2,) or (n_rows, n2).
+        lags (np.ndarray): The lags (shifts), must be integers, shape (n_lags,) or (n_rows, n_lags).
+
+    Returns:
+        np.ndarray: The cross-correlation function(s), shape (n_lags,) or (n_rows, n_lags). Lags with fewer than 3 overlapping finite pixels are nan.
+    """
+    squeeze = np.ndim(y1) == 1 and np.ndim(y2) == 1 and np.ndim(lags) == 1
+    y1, y2 = np.atleast_2d(y1), np.atleast_2d(y2)
+    lags = np.atleast_2d(lags).astype(int)
+    n1, n2 = y1.shape[1], y2.shape[1]
+    n_rows = max(y1.shape[0], y2.shape[0], lags.shape[0])
+    
+    # Zero bad pixels and count the good overlap separately
+    mask1, mask2 = np.isfinite(y1), np.isfinite(y2)
+    y1z, y2z = np.where(mask1, y1, 0), np.where(mask2, y2, 0)
+    
+    # Full correlations, index k is a lag of k - (n2 - 1)
+    num = scipy.signal.fftconvolve(y1z, y2z[:, ::-1], axes=1)
+    count = np.round(scipy.signal.fftconvolve(mask1.astype(float), mask2[:, ::-1].astype(float), axes=1))
+    num = np.broadcast_to(num, (n_rows, n1 + n2 - 1))
+    count = np.broadcast_to(count, (n_rows, n1 + n2 - 1))
+    
+    # Gather the requested lags
+    k = np.broadcast_to(lags + n2 - 1, (n_rows, lags.shape[1]))
+    kc = np.clip(k, 0, n1 + n2 - 2)
+    num, count = np.take_along_axis(num, kc, axis=1), np.take_along_axis(count, kc, axis=1)
+    corrfun = np.full(k.shape, np.nan)
+    good = np.where((k == kc) & (count >= 3))
+    corrfun[good] = num[good] / count[good]
+    
+    if squeeze:
+        corrfun = corrfun[0]
+    return corrfun
+
+def cross_correlate2_batched(x1, y1, x2, y2, lags):
+    """Equivalent to cross_correlate2 for each column of y1 against a common reference, computed in one call with cross_correlate_fft. The reference is linearly interpolated once per column onto the unit grid offset by the fractional part of that column's lags.
+
+    Args:
+        x1 (np.ndarray): The common grid of the columns, must be uniformly spaced by 1, shape (n1,).
+        y1 (np.ndarray): The columns to cross-correlate, shape (n1, n_cols).
+        x2 (np.ndarray): The grid of the reference, must be increasing.
+        y2 (np.ndarray): The reference to cross-correlate against.
+        lags (np.ndarray): The lags for each column, shape (n_lags,) or (n_cols, n_lags). Lags of the same column must differ by integers.
+
+    Returns:
+        np.ndarray: The cross-correlation functions, shape (n_cols, n_lags).
+    """
+    n1, n_cols = y1.shape
+    lags = np.broadcast_to(lags, (n_cols, np.shape(lags)[-1]))
+    
+    # Split the lags into an integer part and a fractional shift per column
+    shifts = lags[:, 0] - x1[0]
+    base = np.floor(shifts)
+    frac = shifts - base
+    offsets = np.round(lags - lags[:, 0:1]).astype(int)
+    
+    # Reference at (integer - frac), nan outside of x2 like cross_correlate2
+    n_start = int(np.floor(x2[0]))
+    nn = np.arange(n_start, int(np.ceil(x2[-1])) + 2)
+    y2_samples = np.interp(nn[None, :] - frac[:, None], x2, y2, left=np.nan, right=np.nan)
+    
+    return cross_correlate_fft(y1.T, y2_samples, offsets + (base.astype(int) + n_start)[:, None])
+
+def ccf_peak(lags, corrfun, threshold=None, n_min=3):
+    """Sub-pixel location of the peak of one or many cross-correlation functions from the vertex of a least-squares parabola.
+
+    Args:
+        lags (np.ndarray): The lags, shape (n_lags,) or (n_rows, n_lags).
+        corrfun (np.ndarray): The cross-correlation function(s), shape (n_lags,) or (n_rows, n_lags).
+        threshold (float, optional): If provided, the parabola is fit to all points with corrfun > threshold. Defaults to None, in which case the maximum and its two neighbors are used.
+        n_min (int, optional): The minimum number of points to fit. Defaults to 3.
+
+    Returns:
+        float or np.ndarray: The location of the peak for each row, nan if it can't be determined.
+    """
+    squeeze = np.ndim(corrfun) == 1
+    corrfun = np.atleast_2d(corrfun)
+    lags = np.broadcast_to(lags, corrfun.shape).astype(float)
+    n_rows, n_lags = corrfun.shape
+    peaks = np.full(n_rows, np.nan)
+    
+    # Rows with a finite maximum
+    finite = np.isfinite(corrfun)
+    rows = np.where(np.any(finite, axis=1))[0]
+    imax = np.nanargmax(corrfun[rows], axis=1)
+    
+    # Points to fit
+    if threshold is None:
+        use = np.abs(np.arange(n_lags)[None, :] - imax[:, None]) <= 1
+        use &= finite[rows]
+    else:
+        use = finite[rows] & (np.where(finite[rows], corrfun[rows], -np.inf) > threshold)
+    
+    # Centered and scaled lags for conditioning
+    center = lags[rows, imax]
+    u = lags[rows] - center[:, None]
+    scale = np.max(np.abs(np.where(use, u, 0)), axis=1)
+    scale[scale == 0] = 1
+    u /= scale[:, None]
+    
+    # Normal equations of y = a*u^2 + b*u + c
+    y = np.where(use, corrfun[rows], 0)
+    w = use.astype(float)
+    S = [np.sum(w * u**k, axis=1) for k in range(5)]
+    T = [np.sum(y * u**k, axis=1) for k in range(3)]
+    A = np.stack([np.stack([S[4], S[3], S[2]], axis=1), np.stack([S[3], S[2], S[1]], axis=1), np.stack([S[2], S[1], S[0]], axis=1)], axis=1)
+    b = np.stack([T[2], T[1], T[0]], axis=1)
+    ok = np.where(np.sum(use, axis=1) >= max(n_min, 3))[0]
+    if ok.size > 0:
+        pfit = np.linalg.solve(A[ok], b[ok][:, :, None])[:, :, 0]
+        peaks[rows[ok]] = center[ok] - pfit[:, 1] / (2 * pfit[:, 0]) * scale[ok]
+    
+    if squeeze:
+        peaks = peaks[0]
+    return peaks
+
 def intersection(x, y, yval, precision=None):
     
     if precision is None:
@@ -1262,6 +2162,97 @@ if 'torch' in sys.modules:
             return (*result,)
 
 
+if 'torch' in sys.modules:
+    class TridiagonalSolve(torch.autograd.Function):
+        """Solves the factored tridiagonal slope system of a CubicSplineInterp. The backward pass is the solve with the transposed system.
+        """
+        
+        @staticmethod
+        def forward(ctx, b, interp):
+            ctx.interp = interp
+            s, _ = scipy.linalg.lapack.dgttrs(interp._dl, interp._d, interp._du, interp._du2, interp._ipiv, b.detach().numpy())
+            return torch.from_numpy(s)
+        
+        @staticmethod
+        def backward(ctx, grad_s):
+            interp = ctx.interp
+            grad_b, _ = scipy.linalg.lapack.dgttrs(interp._dl, interp._d, interp._du, interp._du2, interp._ipiv, grad_s.detach().numpy(), trans='T')
+            return torch.from_numpy(grad_b), None
+
+def basis_matmul_torch(basis, coeffs):
+    """Computes basis @ coeffs for a fixed basis matrix (e.g. from cspline_basis) and torch coefficients. Rows of the basis with nans are nan in the result without propagating nans to the gradient.
+
+    Args:
+        basis (np.ndarray): The basis matrix; shape=(n, m).
+        coeffs (torch.Tensor): The coefficients; shape=(m,).
+
+    Returns:
+        torch.Tensor: The result; shape=(n,).
+    """
+    good = np.all(np.isfinite(basis), axis=1)
+    out = torch.from_numpy(np.where(good[:, None], basis, 0)) @ coeffs
+    return torch.where(torch.from_numpy(good), out, torch.tensor(np.nan, dtype=out.dtype))
+
+def weighted_median_torch(x, percentile=0.5):
+    """Equivalent of weighted_median with uniform weights for a torch tensor. The gradient propagates to the selected element(s).
+
+    Args:
+        x (torch.Tensor): The input data.
+        percentile (float, optional): The desired percentile. Defaults to 0.5.
+
+    Returns:
+        torch.Tensor: The percentile of the data.
+    """
+    x_s = torch.sort(x[torch.isfinite(x)]).values
+    n = x_s.numel()
+    percentile = percentile * n
+    
+    # A single weight exceeds the percentile
+    if percentile < 1:
+        return x[torch.isfinite(x)][0]
+    
+    # Last index where the cumulative weight is <= the percentile
+    idx = int(np.floor(percentile)) - 1
+    if idx + 1 == n:
+        return x_s[idx] if percentile == 1 else torch.tensor(np.nan, dtype=x.dtype)
+    if percentile == 1:
+        return (x_s[idx] + x_s[idx + 1]) / 2
+    return x_s[idx + 1]
+
+def rmsloss_torch(x, y, weights, flag_worst=0, remove_edges=0):
+    """Equivalent of rmsloss with weights for torch tensors, differentiable with respect to y. The flagged pixels are determined from the current values.
+
+    Args:
+        x (np.ndarray): The data.
+        y (torch.Tensor): The model.
+        weights (np.ndarray): The weights.
+        flag_worst (int, optional): The number of worst pixels to ignore. Defaults to 0.
+        remove_edges (int, optional): The number of good pixels on each side to ignore. Defaults to 0.
+
+    Returns:
+        torch.Tensor: The weighted rms.
+    """
+    
+    # Good indices
+    good = np.where((weights > 0) & np.isfinite(y.detach().numpy()))[0]
+    
+    # Compute squared diffs
+    diffs2 = (torch.from_numpy(x[good]) - y[good])**2 * torch.from_numpy(weights[good])
+    norm = np.copy(weights[good])
+    
+    # Ignore worst N pixels and the edges
+    use = np.isfinite(diffs2.detach().numpy())
+    if flag_worst > 0 and len(good) > 0:
+        k = len(good) - np.min([flag_worst, len(good)])
+        worst = np.argpartition(diffs2.detach().numpy(), k)[k:]
+        use[worst] = False
+        norm[worst] = 0
+    if remove_edges > 0:
+        use[0:remove_edges] = False
+        use[-remove_edges:] = False
+    
+    return torch.sqrt(torch.sum(diffs2[np.where(use)[0]]) / np.nansum(norm))
+
 def shiftint1d(x, n, cval=np.nan):
     result = np.empty(x.size)
     if n > 0:
@@ -1280,27 +2271,123 @@ def lorentz(x, amp, mu, fwhm):
     return amp / (1 + xx**2)
 
 
-def poly_filter(y, width, poly_order):
+def poly_filter(y, width, poly_order, method="moments"):
+    """Smooths an array with a local polynomial fit of the given order within a sliding window, ignoring nans. Windows are truncated at the edges, and the output is nan beyond the first and last finite values.
+
+    Args:
+        y (np.ndarray): The array to filter.
+        width (int): The width of the window, must be odd.
+        poly_order (int): The polynomial order.
+        method (str, optional): "moments" for the nan-aware Savitzky-Golay filter built on block-wise cumulative moment sums, or "polyfit" for a separate np.polyfit at each pixel. Defaults to "moments".
+
+    Returns:
+        np.ndarray: The filtered array.
+    """
     width = int(width)
     assert width > poly_order
     assert width % 2 == 1
     nx = len(y)
-    x = np.arange(nx).astype(int)
-    window_arr = np.arange(width)
-    y_out = np.full(nx, np.nan)
-    for i in range(nx):
-        ilow = int(np.max([0, np.ceil(i - width / 2)]))
-        ihigh = int(np.min([np.floor(i + width / 2), nx - 1]))
-        good = np.where(np.isfinite(y[ilow:ihigh + 1]))[0]
-        if good.size < poly_order + 1:
-            continue
-        xx, yy = x[ilow:ihigh + 1][good], y[ilow:ihigh + 1][good]
-        pfit = np.polyfit(xx, yy, poly_order)
-        y_out[i] = np.polyval(pfit, x[i])
+    if method == "moments":
+        y_out = _poly_filter_moments(np.asarray(y, dtype=np.float64), width, int(poly_order))
+    else:
+        x = np.arange(nx).astype(int)
+        y_out = np.full(nx, np.nan)
+        for i in range(nx):
+            ilow = int(np.max([0, np.ceil(i - width / 2)]))
+            ihigh = int(np.min([np.floor(i + width / 2), nx - 1]))
+            good = np.where(np.isfinite(y[ilow:ihigh + 1]))[0]
+            if good.size < poly_order + 1:
+                continue
+            xx, yy = x[ilow:ihigh + 1][good], y[ilow:ihigh + 1][good]
+            pfit = np.polyfit(xx, yy, poly_order)
+            y_out[i] = np.polyval(pfit, x[i])
     good = np.where(np.isfinite(y))[0]
     ilow = np.min(good)
     ihigh = np.max(good)
     y_out[0:ilow] = np.nan
     y_out[ihigh + 1:] = np.nan
     return y_out
+
+@njit(nogil=True)
+def _poly_filter_moments(y, width, poly_order):
+    """Local polynomial regression from cumulative moment sums. Moments are accumulated in blocks of width // 2 pixels about each block's center so the sums stay well conditioned, and the pieces of each window are shifted to the window center with the binomial theorem.
+
+    Args:
+        y (np.ndarray): The array to filter.
+        width (int): The width of the window, must be odd.
+        poly_order (int): The polynomial order.
+
+    Returns:
+        np.ndarray: The filtered array.
+    """
+    nx = y.size
+    h = max(width // 2, 1)
+    n_mom = 2 * poly_order + 1
+    n_coeffs = poly_order + 1
+    
+    # Cumulative sums of the mask and y times ((x - a_b) / h)^k, restarted at each block b with center a_b
+    msum = np.zeros((nx, n_mom))
+    ysum = np.zeros((nx, n_coeffs))
+    for j in range(nx):
+        b = j // h
+        u = (j - (b * h + (h - 1) / 2)) / h
+        if j > b * h:
+            msum[j, :] = msum[j - 1, :]
+            ysum[j, :] = ysum[j - 1, :]
+        if np.isfinite(y[j]):
+            up = 1.0
+            for k in range(n_mom):
+                msum[j, k] += up
+                if k < n_coeffs:
+                    ysum[j, k] += y[j] * up
+                up *= u
+    
+    # Binomial coefficients
+    binom = np.zeros((n_mom, n_mom))
+    for k in range(n_mom):
+        binom[k, 0] = 1.0
+        for p in range(1, k + 1):
+            binom[k, p] = binom[k - 1, p - 1] + binom[k - 1, p]
+    
+    y_out = np.full(nx, np.nan)
+    piece_m = np.empty(n_mom)
+    piece_y = np.empty(n_coeffs)
+    dpow = np.empty(n_mom)
+    S = np.empty(n_mom)
+    T = np.empty(n_coeffs)
+    A = np.empty((n_coeffs, n_coeffs))
+    for i in range(nx):
+        ilow, ihigh = max(i - width // 2, 0), min(i + width // 2, nx - 1)
+        S[:] = 0.0
+        T[:] = 0.0
+        for b in range(ilow // h, ihigh // h + 1):
+            f, l = max(ilow, b * h), min(ihigh, b * h + h - 1)
+            piece_m[:] = msum[l, :]
+            piece_y[:] = ysum[l, :]
+            if f > b * h:
+                piece_m -= msum[f - 1, :]
+                piece_y -= ysum[f - 1, :]
+            
+            # Shift from the block center to the window center
+            d = (b * h + (h - 1) / 2 - i) / h
+            dpow[0] = 1.0
+            for k in range(1, n_mom):
+                dpow[k] = dpow[k - 1] * d
+            for k in range(n_mom):
+                for p in range(k + 1):
+                    S[k] += binom[k, p] * dpow[k - p] * piece_m[p]
+                    if k < n_coeffs:
+                        T[k] += binom[k, p] * dpow[k - p] * piece_y[p]
+        
+        # Need at least poly_order + 1 points
+        if np.round(S[0]) < n_coeffs:
+            continue
+        
+        # Normal equations, the fit at the window center is the constant term
+        for k in range(n_coeffs):
+            for p in range(n_coeffs):
+                A[k, p] = S[k + p]
+        y_out[i] = np.linalg.solve(A, T)[0]
+    
+    return y_out
         
\ No newline at end of file
@@ -407,40 +407,30 @@ class OptimalSlitExtractor(SpectralExtractor):
         spec1d_boxcar = pcmath.median_filter1d(spec1d_boxcar, width=3)
         spec1d_boxcar /= pcmath.weighted_median(spec1d_boxcar, percentile=0.95)
         
-        # Loop over columns
-        for x in range(nx):
-            
-            # See if column is even worth looking at
-            good = np.where((badpix_mask[:, x] == 1) & np.isfinite(trace_image_no_background_smooth[:, x]))[0]
-            if good.size <= 3 or spec1d_boxcar[x] < 0.2:
-                continue
+        # See which columns are even worth looking at
+        n_good = np.sum((badpix_mask == 1) & np.isfinite(trace_image_no_background_smooth), axis=0)
+        use = np.where((n_good > 3) & ~(spec1d_boxcar < 0.2))[0]
+        
+        if use.size > 0:
             
-            # Define CCF shifts for this column
-            lags = np.arange(trace_positions[x] - height / 2,
-                             trace_positions[x] + height / 2 + 1)
+            # Define CCF shifts for each column
+            lag_offsets = np.arange(-height / 2, height / 2 + 1)
+            lags = trace_positions[use, None] + lag_offsets
             
-            # Normalize data column to 1
-            data_x = trace_image_no_background_smooth[:, x] / np.nanmax(trace_image_no_background_smooth[:, x])
+            # Normalize data columns to 1
+            data = trace_image_no_background_smooth[:, use] / np.nanmax(trace_image_no_background_smooth[:, use], axis=0)
             
-            # Perform CCF
-            ccf = pcmath.cross_correlate2(yarr, data_x, trace_profile_cspline.x, trace_profile, lags)
+            # Perform CCF for all columns at once
+            ccf = pcmath.cross_correlate2_batched(yarr, data, trace_profile_cspline.x, trace_profile, lags)
             
             # Bias the ccf
-            ccf *= np.exp(-1 * (np.arange(ccf.size) - height / 2)**2 / (2 * lags.size**2)*3)
+            ccf *= np.exp(-1 * (np.arange(lag_offsets.size) - height / 2)**2 / (2 * lag_offsets.size**2)*3)
             
             # Normalize to max=1
-            ccf /= np.nanmax(ccf)
-            
-            # Check if it is useful
-            good = np.where(np.isfinite(ccf) & (ccf > 0.3))[0]
-            if good.size <= 3:
-                continue
+            ccf /= np.nanmax(ccf, axis=1)[:, None]
             
-            # Fit ccf
-            pfit = np.polyfit(lags[good], ccf[good], 2)
-                
-            # Store the nominal location
-            y_positions_xc[x] = -1 * pfit[1] / (2 * pfit[0])
+            # Fit ccf and store the nominal location
+            y_positions_xc[use] = trace_positions[use] + pcmath.ccf_peak(lag_offsets, ccf, threshold=0.3, n_min=4)
         
         # Smooth the deviations
         y_positions_xc_smooth = pcmath.median_filter1d(y_positions_xc, width=3)
@@ -74,8 +74,7 @@ class DensityClusterTracer(OrderTracer):
         for i in range(len(y_ranges)-1):
             y_low = y_ranges[i]
             y_top = y_ranges[i+1]
-            for x in range(first_x, last_x):
-                source_image_smooth[y_low:y_top, x] = source_image_smooth[y_low:y_top, x] / pcmath.weighted_median(source_image_smooth[y_low:y_top, x], percentile=0.99)
+            source_image_smooth[y_low:y_top, first_x:last_x] /= pcmath.weighted_percentile(source_image_smooth[y_low:y_top, first_x:last_x], q=0.99, axis=0)
 
         # Only consider regions where the flux is greater than 50%
         order_locations_all = np.full_like(source_image_smooth, np.nan)
@@ -19,6 +19,7 @@ from optimize.knowledge import BoundedParameters
 import pychell.spectralmodeling.rvcalc as pcrvcalc
 import pychell.utils as pcutils
 import pychell.maths as pcmaths
+from pychell.spectralmodeling.spectral_results import SpectralRVResults
 
 #################
 #### PARSING ####
@@ -34,22 +35,82 @@ def parse_problem(path, order_num):
 def parse_problems(path, do_orders):
     return [parse_problem(path, order_num) for order_num in do_orders]
 
+def parse_results(path, order_num, mmap_mode=None):
+    """Opens the results of an order written by IterativeSpectralRVProb.save_results. Arrays are only read when accessed.
+
+    Args:
+        path (str): The output path of the run.
+        order_num (int): The order number.
+        mmap_mode (str, optional): Passed to np.load, e.g. 'r' to memory map the arrays. Defaults to None.
+
+    Returns:
+        SpectralRVResults: The results.
+    """
+    fname = glob.glob(f"{path}Order{order_num}{os.sep}*_results_ord{order_num}")[0]
+    return SpectralRVResults(fname, mmap_mode=mmap_mode)
+
+def parse_results_all(path, do_orders, mmap_mode=None):
+    return [parse_results(path, order_num, mmap_mode=mmap_mode) for order_num in do_orders]
+
 def parse_fit_metrics(specrvprobs):
     n_orders = len(specrvprobs)
     fit_metrics = np.empty(shape=(n_orders, specrvprobs[0].n_spec, specrvprobs[0].n_iterations), dtype=float)
     for o in range(n_orders):
+        if isinstance(specrvprobs[o], SpectralRVResults):
+            fit_metrics[o, :, :] = specrvprobs[o]["fbest"]
+            continue
         for ispec in range(specrvprobs[0].n_spec):
             fit_metrics[o, ispec, :] = [specrvprobs[o].opt_results[ispec, k]["fbest"] for k in range(specrvprobs[0].n_iterations)]
     return fit_metrics
             
+def get_chunks(specrvprob):
+    """The chunks of a problem, which hold the best fit parameters. A problem which is not chunked (or was pickled before chunking) is its own single chunk.
+
+    Args:
+        specrvprob (IterativeSpectralRVProb): The problem.
+
+    Returns:
+        list: The chunks.
+    """
+    return getattr(specrvprob, "chunks", [specrvprob])
+
 def parse_parameters(specrvprobs):
+    """Parses the best fit parameters of each problem. The best fit parameters of a chunked problem are only stored by its chunks, see parse_chunk_parameters.
+
+    Args:
+        specrvprobs (list): The IterativeSpectralRVProb for each order, none of which are chunked.
+
+    Returns:
+        np.ndarray: The parameters; shape=(n_orders, n_spec, n_iterations).
+    """
     n_orders = len(specrvprobs)
+    for o in range(n_orders):
+        if len(get_chunks(specrvprobs[o])) > 1:
+            raise ValueError(f"Order {specrvprobs[o].order_num} is chunked, use parse_chunk_parameters instead")
     pars = np.empty(shape=(n_orders, specrvprobs[0].n_spec, specrvprobs[0].n_iterations), dtype=BoundedParameters)
     for o in range(n_orders):
         for ispec in range(specrvprobs[0].n_spec):
             pars[o, ispec, :] = [specrvprobs[o].opt_results[ispec, k]["pbest"] for k in range(specrvprobs[0].n_iterations)]
     return pars
 
+def parse_chunk_parameters(specrvprobs):
+    """Parses the best fit parameters of each chunk of each problem. A problem which is not chunked is a single chunk.
+
+    Args:
+        specrvprobs (list): The IterativeSpectralRVProb for each order.
+
+    Returns:
+        np.ndarray: The parameters; shape=(n_orders, n_spec, n_chunks, n_iterations), where orders with fewer chunks are padded with None.
+    """
+    n_orders = len(specrvprobs)
+    n_chunks = np.max([len(get_chunks(specrvprob)) for specrvprob in specrvprobs])
+    pars = np.empty(shape=(n_orders, specrvprobs[0].n_spec, n_chunks, specrvprobs[0].n_iterations), dtype=BoundedParameters)
+    for o in range(n_orders):
+        for ichunk, chunk in enumerate(get_chunks(specrvprobs[o])):
+            for ispec in range(specrvprobs[0].n_spec):
+                pars[o, ispec, ichunk, :] = [chunk.opt_results[ispec, k]["pbest"] for k in range(specrvprobs[0].n_iterations)]
+    return pars
+
 def parse_rvs(path, do_orders):
     
     # Define new dictionary containing rvs from all orders
@@ -412,51 +473,57 @@ def parameter_corrs(path, specrvprobs, rvs_dict):
     # Loop over orders and chunks
     for o in range(n_orders):
         
-        # Get varied parameters
-        pars_first_order = specrvprobs[o].opt_results[0, -1]["pbest"]
-        pars_first_order_numpy = pars_first_order.unpack()
-        varied_inds = np.where(pars_first_order_numpy["vary"])[0]
-        n_vary = len(varied_inds)
-        pars = np.empty(shape=(n_spec, n_iterations, n_vary), dtype=object)
-        par_vals = np.full(shape=(n_spec, n_iterations, n_vary), dtype=float, fill_value=np.nan)
-        par_names_vary = [pars_first_order_numpy["name"][i] for i in range(len(pars_first_order)) if pars_first_order_numpy["vary"][i]]
-        for ispec in range(n_spec):
-            for j in range(n_iterations):
-                for k in range(n_vary):
-                    pars[ispec, j, k] = specrvprobs[o].opt_results[ispec, j]['pbest'][par_names_vary[k]]
-                    par_vals[ispec, j, k] = pars[ispec, j, k].value
-        
-        n_cols = 5
-        n_rows = int(np.ceil(n_vary / n_cols))
-        fig, axarr = plt.subplots(nrows=n_rows, ncols=n_cols, figsize=(20, 15), dpi=400)
+        chunks = get_chunks(specrvprobs[o])
+        for ichunk, chunk in enumerate(chunks):
         
-        for row in range(n_rows):
-            for col in range(n_cols):
-                
-                # The par index
-                k = n_cols * row + col
-                if k + 1 > n_vary:
-                    axarr[row, col].set_visible(False)
-                    continue
-                
-                # Views to arrays
-                rvs0, rvslast = rvs_dict['rvsfwm'][o, :, 0], rvs_dict['rvsfwm'][o, :, -1]
-                pars0, parslast = par_vals[:, 0, k], par_vals[:, -1, k]
-                
-                axarr[row, col].scatter(rvs0, pars0, marker='o', s=1, c='red', alpha=0.7)
-                axarr[row, col].scatter(rvslast, parslast, marker='o', s=1, c='black', alpha=0.7)
-                axarr[row, col].set_xlabel('RV [m/s]', fontsize=4)
-                axarr[row, col].set_ylabel(par_names_vary[k].replace('_', ' '), fontsize=4)
-                axarr[row, col].tick_params(axis='both', which='major', labelsize=4)
-                good0 = np.where(np.isfinite(rvs0) & np.isfinite(pars0))[0]
-                goodlast = np.where(np.isfinite(rvslast) & np.isfinite(parslast))[0]
-                axarr[row, col].text(np.max(rvs0[good0]), np.max(pars0[good0]), f"pcc 1={round(scipy.stats.pearsonr(rvs0[good0], pars0[good0])[0], 2)}", horizontalalignment="right")
-                axarr[row, col].text(np.max(rvs0[good0]), np.min(pars0[good0]), f"pcc {n_iterations}={round(scipy.stats.pearsonr(rvslast[goodlast], parslast[goodlast])[0], 2)}", horizontalalignment="right")
-                
-        plt.tight_layout()
-        fname = f"{path}Order{specrvprobs[o].order_num}{os.sep}parameter_corrs_ord{specrvprobs[o].order_num}.png"
-        plt.savefig(fname)
-        plt.close()
+            # Get varied parameters
+            pars_first_order = chunk.opt_results[0, -1]["pbest"]
+            pars_first_order_numpy = pars_first_order.unpack()
+            varied_inds = np.where(pars_first_order_numpy["vary"])[0]
+            n_vary = len(varied_inds)
+            pars = np.empty(shape=(n_spec, n_iterations, n_vary), dtype=object)
+            par_vals = np.full(shape=(n_spec, n_iterations, n_vary), dtype=float, fill_value=np.nan)
+            par_names_vary = [pars_first_order_numpy["name"][i] for i in range(len(pars_first_order)) if pars_first_order_numpy["vary"][i]]
+            for ispec in range(n_spec):
+                for j in range(n_iterations):
+                    for k in range(n_vary):
+                        pars[ispec, j, k] = chunk.opt_results[ispec, j]['pbest'][par_names_vary[k]]
+                        par_vals[ispec, j, k] = pars[ispec, j, k].value
+            
+            n_cols = 5
+            n_rows = int(np.ceil(n_vary / n_cols))
+            fig, axarr = plt.subplots(nrows=n_rows, ncols=n_cols, figsize=(20, 15), dpi=400, squeeze=False)
+            
+            for row in range(n_rows):
+                for col in range(n_cols):
+                    
+                    # The par index
+                    k = n_cols * row + col
+                    if k + 1 > n_vary:
+                        axarr[row, col].set_visible(False)
+                        continue
+                    
+                    # Views to arrays, the RVs of a chunked order are the combined RVs
+                    rvs0, rvslast = rvs_dict['rvsfwm'][o, :, 0], rvs_dict['rvsfwm'][o, :, -1]
+                    pars0, parslast = par_vals[:, 0, k], par_vals[:, -1, k]
+                    
+                    axarr[row, col].scatter(rvs0, pars0, marker='o', s=1, c='red', alpha=0.7)
+                    axarr[row, col].scatter(rvslast, parslast, marker='o', s=1, c='black', alpha=0.7)
+                    axarr[row, col].set_xlabel('RV [m/s]', fontsize=4)
+                    axarr[row, col].set_ylabel(par_names_vary[k].replace('_', ' '), fontsize=4)
+                    axarr[row, col].tick_params(axis='both', which='major', labelsize=4)
+                    good0 = np.where(np.isfinite(rvs0) & np.isfinite(pars0))[0]
+                    goodlast = np.where(np.isfinite(rvslast) & np.isfinite(parslast))[0]
+                    axarr[row, col].text(np.max(rvs0[good0]), np.max(pars0[good0]), f"pcc 1={round(scipy.stats.pearsonr(rvs0[good0], pars0[good0])[0], 2)}", horizontalalignment="right")
+                    axarr[row, col].text(np.max(rvs0[good0]), np.min(pars0[good0]), f"pcc {n_iterations}={round(scipy.stats.pearsonr(rvslast[goodlast], parslast[goodlast])[0], 2)}", horizontalalignment="right")
+                    
+            plt.tight_layout()
+            if len(chunks) == 1:
+                fname = f"{path}Order{specrvprobs[o].order_num}{os.sep}parameter_corrs_ord{specrvprobs[o].order_num}.png"
+            else:
+                fname = f"{path}Order{specrvprobs[o].order_num}{os.sep}parameter_corrs_ord{specrvprobs[o].order_num}_chunk{ichunk + 1}.png"
+            plt.savefig(fname)
+            plt.close()
 
 ###############
 #### MISC. ####
@@ -545,48 +612,59 @@ def compute_rv_contents(specrvprobs, templates=None):
     # Compute RVC for each order and iteration
     for o in range(n_orders):
         
-        # Original templates
-        templates_dictcp = copy.deepcopy(specrvprobs[o].spectral_model.templates_dict)
+        # Each chunk has its own model and templates
+        chunks = get_chunks(specrvprobs[o])
         
         # Compute RVC for this iteration
         for j in range(n_iterations):
-        
-            # Use parameters for the first osbervation - Doesn't so much matter here.
-            pars = specrvprobs[o].opt_results[0, j]['pbest']
             
-            # Set the star in the templates dict
-            specrvprobs[o].spectral_model.templates_dict["star"] = np.copy(specrvprobs[o].stellar_templates[j])
-        
-            # Alias the model wave grid
-            model_wave = specrvprobs[o].spectral_model.model_wave
-        
-            # Data wave grid
-            data_wave = specrvprobs[o].spectral_model.wavelength_solution.build(pars)
-        
-            # LSF
-            if specrvprobs[o].spectral_model.lsf is not None:
-                lsf = specrvprobs[o].spectral_model.lsf.build(pars)
-        
-            # RV Content for each template individually
-            rvcs_per_template = np.zeros(len(templates))
+            # RV Content for each chunk
+            rvcs_per_chunk = np.full(len(chunks), np.nan)
+            
+            for ichunk, chunk in enumerate(chunks):
+                
+                # Original templates
+                templates_dictcp = copy.deepcopy(chunk.spectral_model.templates_dict)
         
-            # Loop over templates
-            for i, template_key in enumerate(templates):
+                # Use parameters for the first osbervation - Doesn't so much matter here.
+                pars = chunk.opt_results[0, j]['pbest']
+                
+                # Set the star in the templates dict
+                chunk.spectral_model.templates_dict["star"] = np.copy(chunk.stellar_templates[j])
+            
+                # Alias the model wave grid
+                model_wave = chunk.spectral_model.model_wave
+            
+                # Data wave grid
+                data_wave = chunk.spectral_model.wavelength_solution.build(pars)
             
-                # Build the high res template
-                template_flux = getattr(specrvprobs[o].spectral_model, template_key).build(pars, specrvprobs[o].spectral_model.templates_dict[template_key], model_wave)
+                # LSF
+                if chunk.spectral_model.lsf is not None:
+                    lsf = chunk.spectral_model.lsf.build(pars)
             
-                # The S/N for this observation
-                snr = np.nanmedian(nightly_snrs[o, :, j])
+                # RV Content for each template individually
+                rvcs_per_template = np.zeros(len(templates))
             
-                # Compute content for this template
-                _, rvcs_per_template[i] = pcrvcalc.compute_rv_content(model_wave, template_flux, snr=snr, blaze=True, ron=0, wave_to_sample=data_wave)
-           
-            # Add in quadrature
-            rvcs[o, j] = np.sqrt(np.nansum(rvcs_per_template**2))
+                # Loop over templates
+                for i, template_key in enumerate(templates):
+                
+                    # Build the high res template
+                    template_flux = getattr(chunk.spectral_model, template_key).build(pars, chunk.spectral_model.templates_dict[template_key], model_wave)
+                
+                    # The S/N for this observation
+                    snr = np.nanmedian(nightly_snrs[o, :, j])
+                
+                    # Compute content for this template
+                    _, rvcs_per_template[i] = pcrvcalc.compute_rv_content(model_wave, template_flux, snr=snr, blaze=True, ron=0, wave_to_sample=data_wave)
+               
+                # Add in quadrature
+                rvcs_per_chunk[ichunk] = np.sqrt(np.nansum(rvcs_per_template**2))
+                
+                # Reset templates dict
+                chunk.spectral_model.templates_dict = templates_dictcp
             
-        # Reset templates dict
-        specrvprobs[o].spectral_model.templates_dict = templates_dictcp
+            # The chunks are independent measurements of the RV
+            rvcs[o, j] = np.nansum(1 / rvcs_per_chunk**2)**-0.5
         
     # Return
     return rvcs
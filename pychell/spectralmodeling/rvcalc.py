@@ -101,19 +101,22 @@ def brute_force_ccf(p0, spectral_model, iter_index, vel_step=10):
     rvc, _ = compute_rv_content(spectral_model.templates_dict['star'][:, 0], spectral_model.templates_dict['star'][:, 1], snr=100, blaze=True, ron=0, width=width)
     star_weights = 1 / rvc**2
     
+    # The data wavelength grid does not depend on the stellar velocity
+    wave_data = spectral_model.wavelength_solution.build(pars)
+    
+    # Shift the stellar weights for all velocities instead of recomputing the rv content.
+    star_weights_shifted = pcmath.doppler_shift_multi(spectral_model.templates_dict['star'][:, 0], vels, flux=star_weights, interp='linear', wave_out=wave_data)
+    
     for i in range(vels.size):
         
         # Set the RV parameter to the current step
         pars[spectral_model.star.par_names[0]].value = vels[i]
         
         # Build the model
-        wave_data, model_lr = spectral_model.build(pars)
-        
-        # Shift the stellar weights instead of recomputing the rv content.
-        star_weights_shifted = pcmath.doppler_shift(spectral_model.templates_dict['star'][:, 0], vels[i], flux=star_weights, interp='linear', wave_out=wave_data)
+        _, model_lr = spectral_model.build(pars, use_workspace=True)
         
         # Final weights
-        weights = weights_init * star_weights_shifted
+        weights = weights_init * star_weights_shifted[i, :]
         
         # Compute the RMS
         rmss[i] = pcmath.rmsloss(spectral_model.data.flux, model_lr, weights=weights)
@@ -181,7 +184,7 @@ def brute_force_ccf_crude(p0, data, spectral_model):
         pars[spectral_model.star.par_names[0]].value = vels[i]
         
         # Build the model
-        _, model_lr = spectral_model.build(pars)
+        _, model_lr = spectral_model.build(pars, use_workspace=True)
         
         # Compute the RMS
         rmss[i] = pcmath.rmsloss(data.flux, model_lr, weights=weights)
@@ -422,7 +425,45 @@ def compute_nightly_rvs_single_order(rvs, weights, n_obs_nights):
         rvs_nightly[i], unc_nightly[i] = pcmath.weighted_combine(rr, ww, yerr=None, err_type="empirical")
             
     return rvs_nightly, unc_nightly
-          
+
+def combine_chunk_rvs(rvs, weights):
+    """Combines the RVs of several chunks of a single order for each observation. Each chunk has its own template and therefore its own arbitrary zero point, so the weighted mean of each chunk is removed before combining. The weighted mean of the chunk zero points is added back.
+
+    Args:
+        rvs (np.ndarray): The individual rvs array of shape (n_obs, n_chunks).
+        weights (np.ndarray): The weights, also of shape (n_obs, n_chunks).
+
+    Returns:
+        np.ndarray: The combined rvs of length n_obs.
+        np.ndarray: The corresponding uncertainties of length n_obs, from the weighted scatter of the chunks.
+    """
+
+    # Numbers
+    n_obs, n_chunks = rvs.shape
+
+    # Ignore bad rvs
+    weights = np.copy(weights)
+    bad = np.where(~np.isfinite(rvs) | ~np.isfinite(weights))
+    weights[bad] = 0
+
+    # Zero point of each chunk
+    offsets = np.full(n_chunks, np.nan)
+    for ichunk in range(n_chunks):
+        if np.sum(weights[:, ichunk]) > 0:
+            offsets[ichunk] = pcmath.weighted_mean(rvs[:, ichunk], weights[:, ichunk])
+    rvs_offset = rvs - offsets
+
+    # Combine the chunks for each observation
+    rvs_out = np.full(n_obs, np.nan)
+    unc_out = np.full(n_obs, np.nan)
+    for i in range(n_obs):
+        rvs_out[i], unc_out[i] = pcmath.weighted_combine(rvs_offset[i, :], weights[i, :], yerr=None, err_type="empirical")
+
+    # Restore the mean zero point
+    rvs_out += pcmath.weighted_mean(offsets, np.sum(weights, axis=0))
+
+    return rvs_out, unc_out
+
 def compute_nightly_rvs_from_all(rvs, weights, n_obs_nights, flag_outliers=False, thresh=5):
     """Computes nightly RVs for a single order.
 
@@ -571,7 +612,7 @@ def combine_rvs_weighted_mean(rvs, weights, n_obs_nights):
     for i in range(n_obs):
         rr = rvs_offset[:, i, :].flatten()
         ww = weights[:, i, :].flatten()
-        rvs_single_out[i], rvs_single_out[i] = pcmath.weighted_combine(rr, ww)
+        rvs_single_out[i], unc_single_out[i] = pcmath.weighted_combine(rr, ww)
         
     for i, f, l in pcutils.nightly_iteration(n_obs_nights):
         rr = rvs_offset[:, f:l, :].flatten()
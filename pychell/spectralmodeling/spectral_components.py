@@ -4,6 +4,13 @@ import glob
 # Maths
 import numpy as np
 from scipy.special import eval_legendre
+from scipy import constants as cs
+
+# Pytorch, only needed for the differentiable build_torch methods
+try:
+    import torch
+except:
+    pass
 
 # pychell
 import pychell.maths as pcmath
@@ -172,6 +179,9 @@ class PolyContinuum(Continuum):
         
         # The polynomial order
         self.poly_order = poly_order
+        
+        # Basis matrix on the model grid, set in initialize
+        self.basis = None
             
         # Parameter names
         for i in range(self.n_poly_pars):
@@ -209,9 +219,38 @@ class PolyContinuum(Continuum):
         poly_pars = np.array([pars[self.par_names[i]].value for i in range(self.poly_order + 1)])
         
         # Build polynomial
-        poly_cont = np.polyval(poly_pars[::-1], wave_final - self.wave_mid)
+        if self.basis is not None and pcmath.same_values(wave_final, self.basis_wave):
+            poly_cont = self.basis @ poly_pars
+        else:
+            poly_cont = np.polyval(poly_pars[::-1], wave_final - self.wave_mid)
         
         return poly_cont
+    
+    def build_torch(self, pars, wave_final):
+        x = wave_final - self.wave_mid
+        poly_cont = torch.zeros_like(x)
+        for i in range(self.poly_order, -1, -1):
+            poly_cont = poly_cont * x + pars[self.par_names[i]]
+        return poly_cont
+    
+    
+    ####################
+    #### INITIALIZE ####
+    ####################
+    
+    def initialize(self, spectral_model, iter_index=None):
+        self.wave_mid = spectral_model.sregion.midwave()
+        self.basis_wave = pcmath.readonly_copy(spectral_model.model_wave)
+        self.basis = np.vander(self.basis_wave - self.wave_mid, N=self.n_poly_pars, increasing=True)
+    
+    
+    ###############
+    #### MISC. ####
+    ###############
+    
+    @property
+    def n_poly_pars(self):
+        return self.poly_order + 1
 
 class SplineContinuum(Continuum):
     """  Blaze transmission model through a polynomial and/or splines, ideally used after a flat field correction or after remove_continuum but not required.
@@ -239,6 +278,9 @@ class SplineContinuum(Continuum):
         
         # The range for each spline
         self.spline = spline
+        
+        # Basis matrix from the knots to the model grid, set in initialize
+        self.basis = None
 
         # Set the spline parameter names and knots
         for i in range(self.n_splines+1):
@@ -266,10 +308,27 @@ class SplineContinuum(Continuum):
         spline_pars = np.array([pars[self.par_names[i]].value for i in range(self.n_splines + 1)], dtype=np.float64)
 
         # Build
-        spline_cont = pcmath.cspline_interp(self.spline_wave_set_points, spline_pars, wave_final)
+        if self.basis is not None and pcmath.same_values(wave_final, self.basis_wave):
+            spline_cont = self.basis @ spline_pars
+        else:
+            spline_cont = pcmath.cspline_interp(self.spline_wave_set_points, spline_pars, wave_final)
         
         return spline_cont
     
+    def build_torch(self, pars, wave_final):
+        
+        # Get the spline parameters
+        spline_pars = torch.stack([pars[self.par_names[i]] for i in range(self.n_splines + 1)])
+        
+        # The continuum is linear in the spline parameters, the model grid may be passed as a tensor
+        wave = wave_final.detach().numpy() if torch.is_tensor(wave_final) else wave_final
+        if self.basis is not None and pcmath.same_values(wave, self.basis_wave):
+            basis = self.basis
+        else:
+            basis = pcmath.cspline_basis(self.spline_wave_set_points, wave)
+        
+        return pcmath.basis_matmul_torch(basis, spline_pars)
+    
     
     ####################
     #### INITIALIZE ####
@@ -277,6 +336,8 @@ class SplineContinuum(Continuum):
     
     def initialize(self, spectral_model, iter_index=None):
         self.spline_wave_set_points = np.linspace(spectral_model.sregion.wavemin, spectral_model.sregion.wavemax, num=self.n_splines + 1)
+        self.basis_wave = pcmath.readonly_copy(spectral_model.model_wave)
+        self.basis = pcmath.cspline_basis(self.spline_wave_set_points, self.basis_wave)
 
 
 #########################
@@ -298,6 +359,9 @@ class GasCell(TemplateMult):
         
         self.input_file = input_file
         
+        # Spline interpolator from the template grid to the model grid, set in initialize
+        self.interpolator = None
+        
     def _init_template(self, data, sregion, model_dl):
         print('Loading Gas Cell Template', flush=True)
         pad = 5
@@ -308,6 +372,14 @@ class GasCell(TemplateMult):
         flux /= pcmath.weighted_median(flux, percentile=0.999)
         template = np.array([wave, flux]).T
         return template
+    
+    
+    ####################
+    #### INITIALIZE ####
+    ####################
+    
+    def initialize(self, spectral_model, iter_index=None):
+        self.interpolator = pcmath.CubicSplineInterp(spectral_model.templates_dict["gas_cell"][:, 0], spectral_model.model_wave)
 
 class DynamicGasCell(GasCell):
     """A dynamic gas cell model allowing for a depth and shift.
@@ -353,9 +425,16 @@ class DynamicGasCell(GasCell):
 
     def build(self, pars, template, wave_final):
         wave, flux = template[:, 0], template[:, 1]
-        wave = wave + pars[self.par_names[0]].value
+        shift = pars[self.par_names[0]].value
         flux = flux ** pars[self.par_names[1]].value
-        return pcmath.cspline_interp(wave, flux, wave_final)
+        if self.interpolator is not None and pcmath.same_values(wave, self.interpolator.x):
+            # Shifting the template grid is equivalent to shifting the target grid
+            return self.interpolator(flux, wave_final - shift)
+        return pcmath.cspline_interp(wave + shift, flux, wave_final)
+    
+    def build_torch(self, pars, template, wave_final):
+        flux = _template_pow_torch(template[:, 1], pars[self.par_names[1]])
+        return self.interpolator.interp_torch(flux, wave_final - pars[self.par_names[0]])
 
 class PerfectGasCell(GasCell):
     """A perfect gas cell model (no modifications).
@@ -369,7 +448,12 @@ class PerfectGasCell(GasCell):
 
     def build(self, pars, template, wave_final):
         wave, flux = template[:, 0], template[:, 1]
+        if self.interpolator is not None and pcmath.same_values(wave, self.interpolator.x) and pcmath.same_values(wave_final, self.interpolator.xnew):
+            return self.interpolator(flux)
         return pcmath.cspline_interp(wave, flux, wave_final)
+    
+    def build_torch(self, pars, template, wave_final):
+        return self.interpolator.interp_torch(torch.from_numpy(np.ascontiguousarray(template[:, 1])), wave_final)
 
 
 #####################
@@ -401,6 +485,9 @@ class AugmentedStar(Star):
         
         # Whether or not the star is from a synthetic source
         self.from_flat = True if self.input_file is None else False
+        
+        # Spline interpolator from the template grid, set in initialize
+        self.interpolator = None
 
         # Pars
         self.base_par_names += ['_vel']
@@ -439,6 +526,11 @@ class AugmentedStar(Star):
         wave, flux = template[:, 0], template[:, 1]
         flux = pcmath.doppler_shift(wave, pars[self.par_names[0]].value, wave_out=wave_final, flux=flux, interp='cspline')
         return flux
+    
+    def build_torch(self, pars, template, wave_final):
+        # Shifting the template grid is equivalent to evaluating the template on the unshifted target grid
+        flux = torch.from_numpy(np.ascontiguousarray(template[:, 1]))
+        return self.interpolator.interp_torch(flux, wave_final * torch.exp(-1 * pars[self.par_names[0]] / cs.c))
 
 
     ####################
@@ -446,6 +538,8 @@ class AugmentedStar(Star):
     ####################
     
     def initialize(self, spectral_model, iter_index=None):
+        if "star" in spectral_model.templates_dict:
+            self.interpolator = pcmath.CubicSplineInterp(spectral_model.templates_dict["star"][:, 0])
         if iter_index == 0 and self.from_flat:
             spectral_model.p0[self.par_names[0]].vary = False
         elif iter_index == 1 and self.from_flat:
@@ -473,7 +567,7 @@ class TelluricsTAPAS(Tellurics):
     #### CONSTRUCTOR + HELPERS ####
     ###############################
 
-    def __init__(self, input_path, location_tag, feature_depth=0.02, vel=[-300, 50, 300], water_depth=[0.05, 1.1, 5.0], airmass_depth=[0.8, 1.1, 3.0]):
+    def __init__(self, input_path, location_tag, feature_depth=0.02, vel=[-300, 50, 300], water_depth=[0.05, 1.1, 5.0], airmass_depth=[0.8, 1.1, 3.0], fast=False):
         """Initiate a TAPAS telluric model.
 
         Args:
@@ -483,8 +577,10 @@ class TelluricsTAPAS(Tellurics):
             vel (list, optional): The lower bound, starting value, and upper bound for the telluric shift in m/s. Defaults to [-300, 50, 300].
             water_depth (list, optional): The lower bound, starting value, and upper bound for the water depth. Defaults to [0.05, 1.1, 5.0].
             airmass_depth (list, optional): The lower bound, starting value, and upper bound for the species which correlate well with airmass (everything but water). Defaults to [0.8, 1.1, 3.0].
+            fast (bool, optional): Whether or not to interpolate the log of the templates, whose spline slopes are computed once in initialize. Each build is then a depth weighted sum of the log templates and their slopes, one spline evaluation at the shifted model grid, and one exp. Defaults to False.
         """
         super().__init__()
+        self.fast = fast
         self.input_path = input_path
         self.location_tag = location_tag
         self.vel = vel
@@ -497,6 +593,9 @@ class TelluricsTAPAS(Tellurics):
         
         # Input files
         self.species_input_files = {species: f"{self.input_path}telluric_{species}_tapas_{self.location_tag}.npz" for species in self.species}
+        
+        # Spline interpolator from the template grid, set in initialize
+        self.interpolator = None
 
     def _init_parameters(self, data):
         
@@ -560,6 +659,8 @@ class TelluricsTAPAS(Tellurics):
     ##################
 
     def build(self, pars, templates, wave_final):
+        if self.fast:
+            return self.build_fast(pars, wave_final)
         vel = pars[self.par_names[0]].value
         flux = np.ones(templates[:, 0].size)
         if self.has_water_features:
@@ -581,6 +682,44 @@ class TelluricsTAPAS(Tellurics):
             depth = pars[self.par_names[2]].value
             flux = templates[:, 2]**depth
         return flux
+    
+    def build_fast(self, pars, wave_final):
+        
+        # Depth scaling in log space, the slopes are linear in the log templates
+        log_flux = np.zeros(self.interpolator.x.size)
+        log_slopes = np.zeros(self.interpolator.x.size)
+        if self.has_water_features:
+            log_flux += pars[self.par_names[1]].value * self.log_templates[:, 0]
+            log_slopes += pars[self.par_names[1]].value * self.log_slopes[:, 0]
+        if self.has_airmass_features:
+            log_flux += pars[self.par_names[2]].value * self.log_templates[:, 1]
+            log_slopes += pars[self.par_names[2]].value * self.log_slopes[:, 1]
+        
+        # Doppler shift by evaluating the unshifted spline at the unshifted wavelengths
+        wave_rest = wave_final * np.exp(-1 * pars[self.par_names[0]].value / cs.c)
+        return np.exp(self.interpolator(log_flux, wave_rest, s=log_slopes))
+    
+    def build_torch(self, pars, templates, wave_final):
+        flux = torch.ones(templates[:, 0].size, dtype=torch.float64)
+        if self.has_water_features:
+            flux = flux * _template_pow_torch(templates[:, 1], pars[self.par_names[1]])
+        if self.has_airmass_features:
+            flux = flux * _template_pow_torch(templates[:, 2], pars[self.par_names[2]])
+        return self.interpolator.interp_torch(flux, wave_final * torch.exp(-1 * pars[self.par_names[0]] / cs.c))
+    
+    
+    ####################
+    #### INITIALIZE ####
+    ####################
+    
+    def initialize(self, spectral_model, iter_index=None):
+        templates = spectral_model.templates_dict["tellurics"]
+        self.interpolator = pcmath.CubicSplineInterp(templates[:, 0])
+        
+        # Log templates and their spline slopes for build_fast, saturated or missing flux is floored to 1E-8
+        if self.fast:
+            self.log_templates = np.log(np.clip(np.nan_to_num(templates[:, 1:3], nan=1), 1E-8, None))
+            self.log_slopes = np.array([self.interpolator.slopes(self.log_templates[:, i]) for i in range(2)]).T
         
 # class TelluricsDev(Tellurics):
 #     pass
@@ -610,20 +749,31 @@ class LSF(SpectralComponent):
 
         # Call super method
         super().__init__()
+        
+        # Convolution engine for the model grid, set in initialize
+        self.convolver = None
 
     ##################
     #### BUILDERS ####
     ################## 
 
-    def convolve_flux(self, raw_flux, pars=None, lsf=None, interp=False):
+    def convolve_flux(self, raw_flux, pars=None, lsf=None, interp=False, out=None):
         if lsf is None and pars is None:
             raise ValueError("Cannot construct LSF with no parameters")
         if lsf is None:
             lsf = self.build(pars)
+        if self.convolver is not None and not interp and raw_flux.size == self.convolver.nx and lsf.size <= self.convolver.nk:
+            return self.convolver.convolve(raw_flux, lsf, out=out)
         convolved_flux = pcmath.convolve_flux(None, raw_flux, R=None, width=None, interp=interp, lsf=lsf, croplsf=False)
         #convolved_flux = pcmath._convolve(raw_flux, lsf)
+        if out is not None:
+            out[:] = convolved_flux
+            return out
 
         return convolved_flux
+    
+    def convolve_flux_torch(self, raw_flux, pars):
+        return self.convolver.convolve_torch(raw_flux, self.build_torch(pars))
             
 class HermiteLSF(LSF):
     """A Hermite Gaussian LSF model. The model is a sum of Gaussians of constant width with Hermite Polynomial coefficients to enforce orthogonality. See Arfken et al. for more details.
@@ -635,13 +785,14 @@ class HermiteLSF(LSF):
     #### CONSTRUCTOR + HELPERS ####
     ###############################
 
-    def __init__(self, hermdeg=0, width=None, hermcoeff=[-0.1, 0.01, 0.1]):
+    def __init__(self, hermdeg=0, width=None, hermcoeff=[-0.1, 0.01, 0.1], truncate_tol=None):
         """Initate a Hermite LSF model.
 
         Args:
             hermdeg (int, optional): The degree of the Hermite polynomials. Defaults to 0, which is identical to a standard Gaussian.
             width (float, optional): The lower bound, starting value, and upper bound of the LSF width in Angstroms. Defaults to None.
             hermcoeff (list, optional): The lower bound, starting value, and upper bound for each Hermite polynomial coefficient. Defaults to [-0.1, 0.01, 0.1].
+            truncate_tol (float, optional): If set, the tails of the LSF below truncate_tol relative to its peak are removed (symmetrically) to shorten the convolution. Defaults to None.
         """
 
         # Call super
@@ -651,6 +802,11 @@ class HermiteLSF(LSF):
         self.hermdeg = hermdeg
         self.width = width
         self.hermcoeff = hermcoeff
+        self.truncate_tol = truncate_tol
+        
+        # Hermite functions for the most recent width
+        self.herm = None
+        self.herm_width = None
 
         # Width
         self.base_par_names = ['_width']
@@ -677,7 +833,8 @@ class HermiteLSF(LSF):
     def initialize(self, spectral_model, iter_index=None):
         nx = spectral_model.data.flux.size
         self.x = np.arange(int(-nx / 2), int(nx / 2) + 1)
-        lsf_init = self.build(spectral_model.p0)
+        self.herm_width = None
+        lsf_init = self.build_full(spectral_model.p0)
         lsf_init /= np.nanmax(lsf_init) # norm to max
         good = np.where(lsf_init > 1E-10)[0]
         x_min, x_max = good.min(), good.max()
@@ -685,23 +842,106 @@ class HermiteLSF(LSF):
         if nx % 2 == 0:
             nx += 1
         self.x = np.arange(int(-nx / 2), int(nx / 2) + 1) * spectral_model.model_dl
+        self.herm_width = None
         self.n_pad_model = int(np.floor(self.x.size / 2))
+        self.convolver = pcmath.FluxConvolver(spectral_model.model_wave.size, self.x.size, dtype=spectral_model.flux_dtype)
     
     ##################
     #### BUILDERS ####
     ##################
 
     def build(self, pars):
+        lsf = self.build_full(pars)
+        if self.truncate_tol is not None:
+            lsf = self.truncate(lsf)
+        return lsf
+    
+    def build_full(self, pars):
+        
+        # The Hermite functions only depend on the width
         width = pars[self.par_names[0]].value
-        herm = pcmath.hermfun(self.x / width, self.hermdeg)
-        if self.hermdeg == 0:  # just a Gaussian
-            lsf = herm
-        else:
-            lsf = herm[:, 0]
+        if width != self.herm_width:
+            self.herm = pcmath.hermfun(self.x / width, self.hermdeg).reshape(self.x.size, self.hermdeg + 1)
+            self.herm_width = width
+        
+        # Sum of the Hermite functions, the coefficient of the Gaussian is 1
+        coeffs = np.ones(self.hermdeg + 1)
         for i in range(self.hermdeg):
-            lsf += pars[self.par_names[i+1]].value * herm[:, i+1]
+            coeffs[i+1] = pars[self.par_names[i+1]].value
+        lsf = self.herm @ coeffs
         lsf /= np.nansum(lsf)
         return lsf
+    
+    def truncate(self, lsf, tol=None):
+        k = self.truncate_half_width(lsf, tol=tol)
+        if k is None:
+            return lsf
+        n_pad = int(lsf.size / 2)
+        lsf = lsf[n_pad - k:n_pad + k + 1]
+        lsf /= np.nansum(lsf)
+        return lsf
+    
+    def truncate_half_width(self, lsf, tol=None):
+        
+        # Symmetric about the center so the kernel stays centered and odd
+        if tol is None:
+            tol = self.truncate_tol
+        n_pad = int(lsf.size / 2)
+        good = np.where(np.abs(lsf) >= tol * np.nanmax(np.abs(lsf)))[0]
+        if good.size == 0:
+            return None
+        return np.max(np.abs(good - n_pad))
+    
+    def build_operator(self, pars, wave_in, wave_out):
+        """Builds a banded operator which convolves flux on the uniform grid wave_in with the LSF and samples the result at wave_out. The LSF is only evaluated at the offsets of each wave_out from its neighboring points on wave_in, which are the points within the support of the LSF (see truncate, or 1E-10 relative to the peak if truncate_tol is not set). Flux beyond wave_in is padded with the edge values as in convolve_flux.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+            wave_in (np.ndarray): The uniform grid of the flux to convolve.
+            wave_out (np.ndarray): The wavelengths to sample.
+
+        Returns:
+            np.ndarray: The indices into wave_in for each point in wave_out; shape=(len(wave_out), n_band).
+            np.ndarray: The corresponding weights, each row sums to 1. Rows outside of wave_in are nan.
+        """
+        
+        # Support of the LSF in grid points
+        n_half = int(self.truncate(self.build_full(pars), tol=self.truncate_tol if self.truncate_tol is not None else 1E-10).size / 2)
+        
+        # Fractional position of each output on the grid
+        dl = wave_in[1] - wave_in[0]
+        good = (wave_out >= wave_in[0]) & (wave_out <= wave_in[-1])
+        pos = np.where(good, (wave_out - wave_in[0]) / dl, 0)
+        
+        # LSF at the offsets from the neighboring grid points
+        coeffs = np.ones(self.hermdeg + 1)
+        for i in range(self.hermdeg):
+            coeffs[i+1] = pars[self.par_names[i+1]].value
+        inds, weights = pcmath.hermite_band_operator(pos, n_half, dl / pars[self.par_names[0]].value, coeffs)
+        weights[~good] = np.nan
+        
+        return np.clip(inds, 0, wave_in.size - 1), weights
+    
+    def build_torch(self, pars):
+        x = torch.from_numpy(self.x) / pars[self.par_names[0]]
+        herm0 = np.pi**-0.25 * torch.exp(-0.5 * x**2)
+        herm1 = np.sqrt(2) * herm0 * x
+        lsf = herm0
+        herm_prev, herm = herm0, herm1
+        for k in range(1, self.hermdeg + 1):
+            if k > 1:
+                herm_prev, herm = herm, np.sqrt(2 / k) * (x * herm - np.sqrt((k - 1) / 2) * herm_prev)
+            lsf = lsf + pars[self.par_names[k]] * herm
+        lsf = lsf / torch.sum(lsf)
+        
+        # Truncate as in build, the cut is not differentiable so it is taken from the values
+        if self.truncate_tol is not None:
+            k = self.truncate_half_width(lsf.detach().numpy())
+            if k is not None:
+                n_pad = int(self.x.size / 2)
+                lsf = lsf[n_pad - k:n_pad + k + 1]
+                lsf = lsf / torch.sum(lsf)
+        return lsf
 
 class PerfectLSF(LSF):
     """A model for a perect LSF (known a priori).
@@ -712,9 +952,9 @@ class PerfectLSF(LSF):
     def build(self, pars=None):
         return self.default_lsf
     
-    def convolve_flux(self, raw_flux, pars=None, lsf=None):
-        lsf = build(pars=pars)
-        return super().convolve_flux(raw_flux, lsf=lsf)     
+    def convolve_flux(self, raw_flux, pars=None, lsf=None, out=None):
+        lsf = self.build(pars=pars)
+        return super().convolve_flux(raw_flux, lsf=lsf, out=out)     
 
 
 ####################
@@ -775,25 +1015,28 @@ class PolyWavelengthSolution(WavelengthSolution):
 
     def build(self, pars):
         
-        # The detector grid
-        pixel_grid = np.arange(self.nx)
-        
         # The number of parameters
         n_pars = self.poly_order + 1
             
         # Offsets for each Lagrange point
         poly_lagrange_pars = np.array([pars[self.par_names[i]].value for i in range(n_pars)])
         
-        # Get the coefficients
-        V = np.vander(self.poly_pixel_lagrange_points, N=n_pars)
-        Vinv = np.linalg.inv(V)
-        coeffs = np.dot(Vinv, self.poly_wave_lagrange_zero_points + poly_lagrange_pars)
-    
-        # Build full polynomial
-        poly_wave = np.polyval(coeffs, pixel_grid)
+        # Build full polynomial through the Lagrange points
+        poly_wave = self.basis_offset + self.basis @ poly_lagrange_pars
         
         return poly_wave
     
+    def build_torch(self, pars):
+        pixel_grid = torch.arange(self.nx, dtype=torch.float64)
+        n_pars = self.poly_order + 1
+        poly_lagrange_pars = torch.stack([pars[self.par_names[i]] for i in range(n_pars)])
+        Vinv = torch.from_numpy(np.linalg.inv(np.vander(self.poly_pixel_lagrange_points, N=n_pars)).astype(np.float64))
+        coeffs = Vinv @ (torch.from_numpy(self.poly_wave_lagrange_zero_points.astype(np.float64)) + poly_lagrange_pars)
+        poly_wave = torch.zeros_like(pixel_grid)
+        for i in range(n_pars):
+            poly_wave = poly_wave * pixel_grid + coeffs[i]
+        return poly_wave
+    
     ####################
     #### INITIALIZE ####
     ####################
@@ -805,6 +1048,11 @@ class PolyWavelengthSolution(WavelengthSolution):
         wls_estimate = spectral_model.data.parser.estimate_wavelength_solution(spectral_model.data)
         self.nx = len(wls_estimate)
         self.poly_wave_lagrange_zero_points = wls_estimate[self.poly_pixel_lagrange_points]
+        
+        # Basis matrix from the values at the Lagrange points to the detector grid
+        Vinv = np.linalg.inv(np.vander(self.poly_pixel_lagrange_points, N=self.poly_order + 1))
+        self.basis = np.vander(np.arange(self.nx), N=self.poly_order + 1) @ Vinv
+        self.basis_offset = self.basis @ self.poly_wave_lagrange_zero_points
 
 class SplineWavelengthSolution(WavelengthSolution):
     """A cubic spline wavelength solution model.
@@ -830,6 +1078,10 @@ class SplineWavelengthSolution(WavelengthSolution):
         # The number of spline knots is n_splines + 1
         self.n_splines = n_splines
         self.spline = spline
+        
+        # Basis matrix from the knots to the detector grid, set in initialize
+        self.basis = None
+        self.basis_offset = None
 
         # Set the spline parameter names and knots
         for i in range(self.n_splines + 1):
@@ -851,19 +1103,18 @@ class SplineWavelengthSolution(WavelengthSolution):
 
     def build(self, pars):
         
-        # The detector grid
-        pixel_grid = np.arange(self.nx)
-
         # Get the spline parameters
         spline_pars = np.array([pars[self.par_names[i]].value for i in range(self.n_splines + 1)], dtype=np.float64)
         
         # Build the spline model
-        spline_wave = pcmath.cspline_interp(self.spline_pixel_lagrange_points,
-                                            spline_pars + self.spline_wave_lagrange_zero_points,
-                                            pixel_grid)
+        spline_wave = self.basis_offset + self.basis @ spline_pars
         
         return spline_wave
     
+    def build_torch(self, pars):
+        spline_pars = torch.stack([pars[self.par_names[i]] for i in range(self.n_splines + 1)])
+        return torch.from_numpy(self.basis_offset) + pcmath.basis_matmul_torch(self.basis, spline_pars)
+    
     ####################
     #### INITIALIZE ####
     ####################
@@ -875,6 +1126,10 @@ class SplineWavelengthSolution(WavelengthSolution):
         wls_estimate = spectral_model.data.parser.estimate_wavelength_solution(spectral_model.data)
         self.nx = len(wls_estimate)
         self.spline_wave_lagrange_zero_points = wls_estimate[self.spline_pixel_lagrange_points]
+        
+        # Basis matrix from the values at the Lagrange points to the detector grid
+        self.basis = pcmath.cspline_basis(self.spline_pixel_lagrange_points, np.arange(self.nx))
+        self.basis_offset = self.basis @ self.spline_wave_lagrange_zero_points
 
 class LegPolyWavelengthSolution(WavelengthSolution):
     """A Legendre polynomial wavelength solution model.
@@ -956,6 +1211,9 @@ class PerfectWavelengthSolution(WavelengthSolution):
     def build(self, pars):
         return self.data.apriori_wave_grid
     
+    def build_torch(self, pars):
+        return torch.from_numpy(self.data.apriori_wave_grid)
+    
     ####################
     #### INITIALIZE ####
     ####################
@@ -1013,3 +1271,29 @@ class FPCavityFringing(EmpiricalMult):
         theta = (2 * np.pi / wave_final) * d
         fringing = 1 / (1 + fin * np.sin(theta / 2)**2)
         return fringing
+    
+    def build_torch(self, pars, wave_final):
+        d = torch.exp(pars[self.par_names[0]])
+        fin = pars[self.par_names[1]]
+        theta = (2 * np.pi / wave_final) * d
+        fringing = 1 / (1 + fin * torch.sin(theta / 2)**2)
+        return fringing
+
+
+###############
+#### MISC. ####
+###############
+
+def _template_pow_torch(flux, depth):
+    """Computes flux**depth for a template, with finite gradients with respect to depth where the flux is zero.
+
+    Args:
+        flux (np.ndarray): The template flux.
+        depth (torch.Tensor): The exponent.
+
+    Returns:
+        torch.Tensor: The template raised to depth.
+    """
+    flux = torch.from_numpy(np.ascontiguousarray(flux))
+    positive = flux > 0
+    return torch.where(positive, torch.where(positive, flux, torch.ones_like(flux))**depth, torch.zeros_like(flux))
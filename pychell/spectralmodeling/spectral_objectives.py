@@ -1,6 +1,16 @@
+# Base Python
+import copy
+import warnings
+
 # Maths
 import numpy as np
 
+# Pytorch, only needed for compute_obj_and_grad
+try:
+    import torch
+except:
+    pass
+
 # Pychell deps
 import pychell.maths as pcmath
 
@@ -35,11 +45,17 @@ class WeightedSpectralUncRMS(SpectralObjectiveFunction):
 
     def compute_obj(self, pars):
         
+        # Parameter bounds, rejected before building the model
+        # Ranks above any in-bounds result (at most 1E6), use actual number to create a crude gradient
+        n_out_of_bounds = pars.num_out_of_bounds
+        if n_out_of_bounds > 0:
+            return 1E6 + n_out_of_bounds * 1E2
+        
         # Alias the data
         data = self.spectral_model.data
 
         # Generate the forward model
-        wave_model, flux_model = self.spectral_model.build(pars)
+        wave_model, flux_model = self.spectral_model.build(pars, use_workspace=True)
 
         # Weights are prop. to 1 / unc^2
         weights = data.mask / data.flux_unc**2
@@ -47,20 +63,192 @@ class WeightedSpectralUncRMS(SpectralObjectiveFunction):
         # Compute rms ignoring bad pixels
         rms = pcmath.rmsloss(data.flux, flux_model, weights=weights, flag_worst=self.flag_n_worst_pixels, remove_edges=self.remove_edges)
         
-        # Force LSF to be positive everywhere.
-        if np.min(self.spectral_model.lsf.build(pars)) < 0:
+        # Force LSF to be positive everywhere, with the LSF from build if it was built
+        lsf = self.spectral_model.lsf_last
+        if lsf is None:
+            lsf = self.spectral_model.lsf.build(pars)
+        if np.min(lsf) < 0:
             rms += 1E2
-            
-        # Parameter bounds
-        # Use actual number to create a crude gradient
-        rms += pars.num_out_of_bounds * 1E2
         
-        # Check for infinity or nan
-        if not np.isfinite(rms):
+        # Check for infinity or nan, capped below the bounds penalty
+        if not np.isfinite(rms) or rms > 1E6:
             rms = 1E6
 
         # Return final rms
         return rms
     
+    def compute_obj_and_grad(self, pars):
+        """Computes the objective and its exact gradient with the differentiable build_torch path of the spectral model. The penalties are the same as in compute_obj and do not contribute to the gradient. If a component of the spectral model has no build_torch method, the gradient is computed with forward differences of compute_obj instead (see compute_obj_and_fd_grad).
+
+        Args:
+            pars (BoundedParameters): The parameters.
+
+        Returns:
+            float: The objective.
+            np.ndarray: The gradient with respect to each parameter, in the order of pars.
+        """
+        
+        # Parameter bounds, rejected before building the model as in compute_obj
+        n_out_of_bounds = pars.num_out_of_bounds
+        if n_out_of_bounds > 0:
+            return 1E6 + n_out_of_bounds * 1E2, np.zeros(len(pars))
+        
+        # No differentiable path
+        missing = self.spectral_model.missing_torch_components()
+        if len(missing) > 0:
+            warnings.warn(f"{', '.join(missing)} cannot be built with pytorch, using forward differences for the gradient")
+            return self.compute_obj_and_fd_grad(pars)
+        
+        # Alias the data
+        data = self.spectral_model.data
+        
+        # Parameters as torch scalars
+        par_names = list(pars.keys())
+        values = torch.tensor([pars[pname].value for pname in par_names], dtype=torch.float64, requires_grad=True)
+        pars_torch = {pname: values[i] for i, pname in enumerate(par_names)}
+
+        # Generate the forward model
+        wave_model, flux_model = self.spectral_model.build_torch(pars_torch)
+
+        # Weights are prop. to 1 / unc^2
+        weights = data.mask / data.flux_unc**2
+
+        # Compute rms ignoring bad pixels
+        rms = pcmath.rmsloss_torch(data.flux, flux_model, weights=weights, flag_worst=self.flag_n_worst_pixels, remove_edges=self.remove_edges)
+        rms.backward()
+        grad = values.grad.numpy()
+        rms = rms.item()
+        
+        # Force LSF to be positive everywhere.
+        if np.min(self.spectral_model.lsf.build(pars)) < 0:
+            rms += 1E2
+        
+        # Check for infinity or nan, capped below the bounds penalty
+        if not np.isfinite(rms) or rms > 1E6 or not np.all(np.isfinite(grad)):
+            rms = 1E6
+            grad = np.zeros(len(par_names))
+
+        # Return final rms and gradient
+        return rms, grad
+    
+    def compute_obj_and_fd_grad(self, pars, fd_step=1E-6):
+        """Computes the objective and its gradient with forward differences of compute_obj, for spectral models which cannot be built with pytorch.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+            fd_step (float, optional): The finite difference step relative to the range of the bounds of each parameter, or to max(|value|, 1) if unbounded. The step is taken backwards if it would leave the bounds. Defaults to 1E-6.
+
+        Returns:
+            float: The objective.
+            np.ndarray: The gradient with respect to each parameter, in the order of pars.
+        """
+        rms = self.compute_obj(pars)
+        par_names = list(pars.keys())
+        grad = np.zeros(len(par_names))
+        pars_step = copy.deepcopy(pars)
+        for i, pname in enumerate(par_names):
+            v = pars[pname].value
+            h = pars[pname].upper_bound - pars[pname].lower_bound
+            h = fd_step * (h if np.isfinite(h) else max(np.abs(v), 1))
+            if v + h > pars[pname].upper_bound:
+                h *= -1
+            pars_step[pname].value = v + h
+            grad[i] = (self.compute_obj(pars_step) - rms) / h
+            pars_step[pname].value = v
+        return rms, grad
+
+    def compute_residual_pixels(self, pars):
+        """Determines the pixels used by compute_obj for these parameters, after flagging the worst pixels and removing the edges as in pcmath.rmsloss.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+
+        Returns:
+            np.ndarray: The indices of the pixels contributing to the rms.
+            float: The normalization of the rms, the sum of the weights of the unflagged pixels.
+        """
+
+        # Alias the data
+        data = self.spectral_model.data
+
+        # Generate the forward model
+        wave_model, flux_model = self.spectral_model.build(pars, use_workspace=True)
+
+        # Weights are prop. to 1 / unc^2
+        weights = data.mask / data.flux_unc**2
+
+        # Good pixels, see pcmath.rmsloss
+        good = np.where((weights > 0) & np.isfinite(flux_model))[0]
+        diffs2 = weights[good] * (data.flux[good] - flux_model[good])**2
+        keep = np.ones(good.size, dtype=bool)
+        if self.flag_n_worst_pixels > 0 and good.size > 0:
+            k = good.size - np.min([self.flag_n_worst_pixels, good.size])
+            keep[np.argpartition(diffs2, k)[k:]] = False
+        norm = np.sum(weights[good][keep])
+        if self.remove_edges > 0:
+            keep[0:self.remove_edges] = False
+            keep[-self.remove_edges:] = False
+
+        return good[keep], norm
+
+    def compute_residuals(self, pars, pixels, norm):
+        """Computes the residual vector, the weighted residuals of each pixel normalized such that the sum of their squares is the squared rms of compute_obj (without penalties) for the same pixels.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+            pixels (np.ndarray): The pixels to use, see compute_residual_pixels.
+            norm (float): The normalization, see compute_residual_pixels.
+
+        Returns:
+            np.ndarray: The residuals.
+        """
+
+        # Alias the data
+        data = self.spectral_model.data
+
+        # Generate the forward model
+        wave_model, flux_model = self.spectral_model.build(pars, use_workspace=True)
+
+        # Weighted residuals
+        return np.sqrt(data.mask[pixels] / data.flux_unc[pixels]**2 / norm) * (data.flux[pixels] - flux_model[pixels])
+
+    def compute_residuals_and_jacobian(self, pars, pixels, norm, par_names):
+        """Computes the residual vector and its Jacobian, see compute_residuals and IterativeSpectralForwardModel.build_jacobian.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+            pixels (np.ndarray): The pixels to use, see compute_residual_pixels.
+            norm (float): The normalization, see compute_residual_pixels.
+            par_names (list): The names of the parameters to differentiate with respect to.
+
+        Returns:
+            np.ndarray: The residuals.
+            np.ndarray: The Jacobian of the residuals; shape=(n_pixels, n_pars).
+        """
+
+        # Alias the data
+        data = self.spectral_model.data
+
+        # Generate the forward model and its Jacobian
+        wave_model, flux_model, jac = self.spectral_model.build_jacobian(pars, par_names)
+
+        # Weighted residuals
+        sqrt_weights = np.sqrt(data.mask[pixels] / data.flux_unc[pixels]**2 / norm)
+        residuals = sqrt_weights * (data.flux[pixels] - flux_model[pixels])
+        jac = -1 * sqrt_weights[:, None] * jac[pixels, :]
+
+        return residuals, jac
+
+    def is_valid(self, pars):
+        """Whether or not the parameters are within their bounds and the LSF is positive, otherwise compute_obj is penalized.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+
+        Returns:
+            bool: True if not penalized.
+        """
+        return pars.num_out_of_bounds == 0 and np.min(self.spectral_model.lsf.build(pars)) >= 0
+
     def __repr__(self):
         return "Spectral objective function: RMS weighted by 1 / flux_unc^2"
\ No newline at end of file
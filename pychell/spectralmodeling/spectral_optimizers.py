@@ -0,0 +1,136 @@
+# Base Python
+import copy
+
+# Maths
+import numpy as np
+
+class LevenbergMarquardt:
+    """A bounded Levenberg-Marquardt (damped Gauss-Newton trust region) optimizer for spectral objectives which expose a residual vector and its Jacobian, such as WeightedSpectralUncRMS. Steps are clipped to the parameter bounds, and steps which would make the LSF negative are rejected. The worst pixels flagged by the objective are re-determined after each sub-fit, so the fit is repeated until the flagged pixels no longer change or n_iterations is reached.
+    """
+
+    def __init__(self, n_iterations=3, max_steps=50, lambda0=1E-3, ftol=1E-8, xtol=1E-8):
+        """Initiate a Levenberg-Marquardt optimizer.
+
+        Args:
+            n_iterations (int, optional): The maximum number of sub-fits, each with a fixed set of pixels. Defaults to 3.
+            max_steps (int, optional): The maximum number of accepted steps per sub-fit. Defaults to 50.
+            lambda0 (float, optional): The initial damping relative to the diagonal of J^T J. Defaults to 1E-3.
+            ftol (float, optional): The relative decrease in the objective below which a sub-fit has converged. Defaults to 1E-8.
+            xtol (float, optional): The step size relative to the parameters below which a sub-fit has converged. Defaults to 1E-8.
+        """
+        self.n_iterations = n_iterations
+        self.max_steps = max_steps
+        self.lambda0 = lambda0
+        self.ftol = ftol
+        self.xtol = xtol
+
+    def initialize(self, obj):
+        self.obj = obj
+
+    ##################
+    #### OPTIMIZE ####
+    ##################
+
+    def optimize(self):
+        """Runs the optimizer from the initial parameters of the objective.
+
+        Returns:
+            dict: The results with keys pbest (BoundedParameters), fbest (float), fcalls (int, the number of model builds excluding Jacobians), and jcalls (int, the number of Jacobians).
+        """
+
+        # Varied parameters
+        pars = copy.deepcopy(self.obj.p0)
+        par_names = [pname for pname in pars if pars[pname].vary]
+        lower_bounds = np.array([pars[pname].lower_bound for pname in par_names], dtype=float)
+        upper_bounds = np.array([pars[pname].upper_bound for pname in par_names], dtype=float)
+        self.fcalls, self.jcalls = 0, 0
+
+        # Sub-fits with a fixed set of pixels
+        pixels = None
+        for _ in range(self.n_iterations):
+            pixels_new, norm = self.obj.compute_residual_pixels(pars)
+            self.fcalls += 1
+            if pixels is not None and np.array_equal(pixels, pixels_new):
+                break
+            pixels = pixels_new
+            self.optimize_pixels(pars, par_names, pixels, norm, lower_bounds, upper_bounds)
+
+        # Final objective
+        fbest = self.obj.compute_obj(pars)
+        self.fcalls += 1
+
+        return dict(pbest=pars, fbest=fbest, fcalls=self.fcalls, jcalls=self.jcalls)
+
+    def optimize_pixels(self, pars, par_names, pixels, norm, lower_bounds, upper_bounds):
+        """Minimizes the sum of the squared residuals for a fixed set of pixels, updating pars in place.
+
+        Args:
+            pars (BoundedParameters): The starting parameters, updated to the best fit parameters.
+            par_names (list): The names of the varied parameters.
+            pixels (np.ndarray): The pixels to use.
+            norm (float): The normalization of the residuals.
+            lower_bounds (np.ndarray): The lower bounds of the varied parameters.
+            upper_bounds (np.ndarray): The upper bounds of the varied parameters.
+        """
+
+        # Current values
+        x = np.array([pars[pname].value for pname in par_names], dtype=float)
+        residuals, jac = self.obj.compute_residuals_and_jacobian(pars, pixels, norm, par_names)
+        self.jcalls += 1
+        f = np.sum(residuals**2)
+        damping = self.lambda0
+
+        for _ in range(self.max_steps):
+
+            # Normal equations, scaled by their diagonal (Marquardt)
+            good = np.all(np.isfinite(jac), axis=1) & np.isfinite(residuals)
+            A = jac[good].T @ jac[good]
+            g = jac[good].T @ residuals[good]
+            diag = np.diag(A).copy()
+            diag[diag <= 0] = 1E-12 * np.max(diag)
+
+            # Increase the damping until a step decreases the objective
+            accepted = False
+            while damping < 1E10:
+                try:
+                    step = np.linalg.solve(A + damping * np.diag(diag), -g)
+                except np.linalg.LinAlgError:
+                    damping *= 10
+                    continue
+                x_new = np.clip(x + step, lower_bounds, upper_bounds)
+                self.set_values(pars, par_names, x_new)
+                if self.obj.is_valid(pars):
+                    residuals_new = self.obj.compute_residuals(pars, pixels, norm)
+                    self.fcalls += 1
+                    f_new = np.sum(residuals_new**2)
+                    if np.isfinite(f_new) and f_new < f:
+                        accepted = True
+                        break
+                damping *= 10
+
+            # No step decreases the objective
+            if not accepted:
+                self.set_values(pars, par_names, x)
+                break
+
+            # Accept
+            damping = max(damping / 10, 1E-12)
+            x_step = x_new - x
+            f_decrease = f - f_new
+            x, f = x_new, f_new
+
+            # Converged
+            if f_decrease <= self.ftol * f or np.all(np.abs(x_step) <= self.xtol * (np.abs(x) + self.xtol)):
+                break
+
+            # Jacobian at the new parameters
+            residuals, jac = self.obj.compute_residuals_and_jacobian(pars, pixels, norm, par_names)
+            self.jcalls += 1
+
+    @staticmethod
+    def set_values(pars, par_names, x):
+        for i, pname in enumerate(par_names):
+            pars[pname].value = x[i]
+
+    def __repr__(self):
+        return f"Levenberg-Marquardt optimizer: {self.n_iterations} iterations"
@@ -0,0 +1,243 @@
+# Base Python
+import os
+import glob
+import json
+
+# Maths
+import numpy as np
+
+###################
+#### UTILITIES ####
+###################
+
+def pack_parameters(opt_results, par_names):
+    """Packs the best fit parameters of an array of optimize results into dense arrays.
+
+    Args:
+        opt_results (np.ndarray): The optimize results (dicts with a pbest key), any entry may be None or lack pbest.
+        par_names (list): The names of the parameters.
+
+    Returns:
+        np.ndarray: The values; shape=opt_results.shape + (n_pars,).
+        np.ndarray: The lower bounds.
+        np.ndarray: The upper bounds.
+        np.ndarray: Whether or not each parameter was varied.
+    """
+    shape = opt_results.shape + (len(par_names),)
+    values = np.full(shape, np.nan)
+    lower_bounds = np.full(shape, np.nan)
+    upper_bounds = np.full(shape, np.nan)
+    vary = np.zeros(shape, dtype=bool)
+    for ind in np.ndindex(opt_results.shape):
+        opt_result = opt_results[ind]
+        if opt_result is None or "pbest" not in opt_result:
+            continue
+        pars = opt_result["pbest"]
+        for k, pname in enumerate(par_names):
+            if pname in pars:
+                values[ind + (k,)] = pars[pname].value
+                lower_bounds[ind + (k,)] = pars[pname].lower_bound
+                upper_bounds[ind + (k,)] = pars[pname].upper_bound
+                vary[ind + (k,)] = bool(pars[pname].vary)
+    return values, lower_bounds, upper_bounds, vary
+
+def pack_fit_metrics(opt_results):
+    """Packs the fit metric, number of function calls, and wall time of an array of optimize results into dense arrays.
+
+    Args:
+        opt_results (np.ndarray): The optimize results (dicts), any entry may be None.
+
+    Returns:
+        np.ndarray: The fit metrics (fbest), nan where missing.
+        np.ndarray: The number of function calls (fcalls), nan where missing.
+        np.ndarray: The wall times of the fits in seconds (walltime), nan where missing.
+    """
+    fbest = np.full(opt_results.shape, np.nan)
+    fcalls = np.full(opt_results.shape, np.nan)
+    walltime = np.full(opt_results.shape, np.nan)
+    for ind in np.ndindex(opt_results.shape):
+        if opt_results[ind] is not None:
+            fbest[ind] = opt_results[ind].get("fbest", np.nan)
+            fcalls[ind] = opt_results[ind].get("fcalls", np.nan)
+            walltime[ind] = opt_results[ind].get("walltime", np.nan)
+    return fbest, fcalls, walltime
+
+def pack_ragged(arrs):
+    """Packs an object array of equally shaped arrays into a single dense array.
+
+    Args:
+        arrs (np.ndarray): The object array, any entry may be None.
+
+    Returns:
+        np.ndarray: The dense array; shape=arrs.shape + shape of each entry, nan where missing. None if all entries are missing.
+    """
+    entry = next((arr for arr in arrs.flat if arr is not None), None)
+    if entry is None:
+        return None
+    out = np.full(arrs.shape + np.shape(entry), np.nan)
+    for ind in np.ndindex(arrs.shape):
+        if arrs[ind] is not None:
+            out[ind] = arrs[ind]
+    return out
+
+################
+#### WRITER ####
+################
+
+def write_results(specrvprob, path):
+    """Writes the results of an IterativeSpectralRVProb to a directory of .npy files, one per array, which can be read individually (and memory mapped) with SpectralRVResults. Per-observation arrays are indexed by (spectrum, iteration), or (spectrum, chunk, iteration) for the chunks of a chunked problem. The stored arrays are:
+
+        par_values, par_lower_bounds, par_upper_bounds, par_vary: The best fit parameters; shape=(n_spec, n_iterations, n_pars), or (n_spec, n_chunks, n_iterations, n_pars) for chunked problems.
+        fbest, fcalls, walltime: The fit metric, number of function calls, and wall time of each fit in seconds; shape=(n_spec, n_iterations).
+        fbest_chunks, fcalls_chunks, walltime_chunks: The same for each chunk; shape=(n_spec, n_chunks, n_iterations).
+        Every numeric array of rvs_dict under the same name, with the CCFs (xcorrs, xcorrs_chunks) packed into dense arrays with a trailing axis of (vel, ccf).
+        stellar_template_iter{k} (or stellar_template_chunk{i}_iter{k}): The stellar template used in each iteration; shape=(n, 2).
+
+    The scalar information and the parameter names are stored in meta.json.
+
+    Args:
+        specrvprob (IterativeSpectralRVProb): The problem.
+        path (str): The output directory, created if necessary. Existing arrays are overwritten.
+    """
+
+    # Output directory
+    os.makedirs(path, exist_ok=True)
+
+    def save(key, arr):
+        if arr is not None:
+            np.save(f"{path}{key}.npy", arr)
+
+    # Parameters, the same for all chunks
+    par_names = list(specrvprob.chunks[0].p0.keys())
+    if specrvprob.n_chunks == 1:
+        opt_results = specrvprob.opt_results
+    else:
+        opt_results = np.empty((specrvprob.n_spec, specrvprob.n_chunks, specrvprob.n_iterations), dtype=dict)
+        for ichunk, chunk in enumerate(specrvprob.chunks):
+            opt_results[:, ichunk, :] = chunk.opt_results
+        fbest, fcalls, walltime = pack_fit_metrics(opt_results)
+        save("fbest_chunks", fbest)
+        save("fcalls_chunks", fcalls)
+        save("walltime_chunks", walltime)
+    values, lower_bounds, upper_bounds, vary = pack_parameters(opt_results, par_names)
+    save("par_values", values)
+    save("par_lower_bounds", lower_bounds)
+    save("par_upper_bounds", upper_bounds)
+    save("par_vary", vary)
+
+    # Fit metrics of the full order
+    fbest, fcalls, walltime = pack_fit_metrics(specrvprob.opt_results)
+    save("fbest", fbest)
+    save("fcalls", fcalls)
+    save("walltime", walltime)
+
+    # RVs, CCFs, and bisectors
+    for key, arr in specrvprob.rvs_dict.items():
+        arr = np.asarray(arr)
+        if arr.dtype == object:
+            save(key, pack_ragged(arr))
+        else:
+            save(key, arr)
+
+    # Templates
+    for ichunk, chunk in enumerate(specrvprob.chunks):
+        for iter_index in range(specrvprob.n_iterations):
+            key = f"stellar_template_iter{iter_index + 1}" if specrvprob.n_chunks == 1 else f"stellar_template_chunk{ichunk + 1}_iter{iter_index + 1}"
+            save(key, chunk.stellar_templates[iter_index])
+
+    # Metadata
+    meta = dict(spectrograph=specrvprob.spectrograph, tag=specrvprob.tag, star_name=specrvprob.target_dict["name"],
+                order_num=int(specrvprob.order_num), n_spec=int(specrvprob.n_spec), n_nights=int(specrvprob.n_nights),
+                n_iterations=int(specrvprob.n_iterations), n_chunks=int(specrvprob.n_chunks), par_names=par_names)
+    with open(f"{path}meta.json", 'w') as f:
+        f.write(json.dumps(meta, indent=4))
+
+################
+#### READER ####
+################
+
+class SpectralRVResults:
+    """Read only access to the results written by write_results. Arrays are only read from disk when first accessed with results[key].
+    """
+
+    def __init__(self, path, mmap_mode=None):
+        """Initiate a reader.
+
+        Args:
+            path (str): The results directory.
+            mmap_mode (str, optional): Passed to np.load, e.g. 'r' to memory map the arrays. Defaults to None.
+        """
+        self.path = path if path.endswith(os.sep) else path + os.sep
+        self.mmap_mode = mmap_mode
+        with open(f"{self.path}meta.json", 'r') as f:
+            self.meta = json.load(f)
+        self.cache = {}
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            fname = f"{self.path}{key}.npy"
+            if not os.path.exists(fname):
+                raise KeyError(f"{key} is not stored in {self.path}")
+            self.cache[key] = np.load(fname, mmap_mode=self.mmap_mode)
+        return self.cache[key]
+
+    def __contains__(self, key):
+        return os.path.exists(f"{self.path}{key}.npy")
+
+    def keys(self):
+        return sorted(os.path.basename(fname)[:-4] for fname in glob.glob(f"{self.path}*.npy"))
+
+    def par_index(self, par_name):
+        return self.par_names.index(par_name)
+
+    def parameter(self, par_name):
+        """The best fit values of a single parameter.
+
+        Args:
+            par_name (str): The name of the parameter.
+
+        Returns:
+            np.ndarray: The values; shape=(n_spec, n_iterations), or (n_spec, n_chunks, n_iterations) for chunked problems.
+        """
+        return self["par_values"][..., self.par_index(par_name)]
+
+    def stellar_template(self, iter_index, ichunk=None):
+        """The stellar template used in an iteration.
+
+        Args:
+            iter_index (int): The iteration index.
+            ichunk (int, optional): The chunk index for chunked problems. Defaults to None.
+
+        Returns:
+            np.ndarray: The template; shape=(n, 2).
+        """
+        if ichunk is None:
+            return self[f"stellar_template_iter{iter_index + 1}"]
+        return self[f"stellar_template_chunk{ichunk + 1}_iter{iter_index + 1}"]
+
+    @property
+    def par_names(self):
+        return self.meta["par_names"]
+
+    @property
+    def order_num(self):
+        return self.meta["order_num"]
+
+    @property
+    def n_spec(self):
+        return self.meta["n_spec"]
+
+    @property
+    def n_nights(self):
+        return self.meta["n_nights"]
+
+    @property
+    def n_iterations(self):
+        return self.meta["n_iterations"]
+
+    @property
+    def n_chunks(self):
+        return self.meta["n_chunks"]
+
+    def __repr__(self):
+        return f"Spectral RV Results: Order {self.order_num}, {self.n_spec} spectra, {self.n_iterations} iterations ({self.path})"
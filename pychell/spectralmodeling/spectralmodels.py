@@ -1,10 +1,18 @@
 # Base Python
 import copy
 import os
+import warnings
+from collections import OrderedDict
 
 # Maths
 import numpy as np
 
+# Pytorch, only needed for build_torch
+try:
+    import torch
+except:
+    pass
+
 # pychell
 import pychell
 import pychell.maths as pcmath
@@ -75,6 +83,32 @@ class SpectralRegion:
     def __repr__(self):
         return f"Spectral Region: Pix: ({self.pixmin}, {self.pixmax}) Wave: ({self.wavemin}, {self.wavemax})"
 
+###################
+#### WORKSPACE ####
+###################
+
+class BuildWorkspace:
+    """Preallocated buffers for the intermediate stages of IterativeSpectralForwardModel.build, so that steady state builds allocate nothing beyond the outputs of the components (which may be memoized, see cached_build).
+    """
+    
+    __slots__ = ['model_flux', 'model_flux_conv', 'slopes', 'model_flux_lr']
+    
+    def __init__(self, n_model, n_data, flux_dtype=np.float64):
+        """Initiate a build workspace.
+
+        Args:
+            n_model (int): The number of points on the model grid.
+            n_data (int): The number of points on the data grid.
+            flux_dtype (type, optional): The precision of the flux on the model grid. Defaults to np.float64.
+        """
+        self.model_flux = np.empty(n_model, dtype=flux_dtype)
+        self.model_flux_conv = np.empty(n_model, dtype=flux_dtype)
+        self.slopes = np.empty(n_model)
+        self.model_flux_lr = np.empty(n_data)
+        
+    def __repr__(self):
+        return f"Build Workspace: Model: {self.model_flux.size} ({self.model_flux.dtype}) Data: {self.model_flux_lr.size}"
+
 ##################################
 #### COMPOSITE SPECTRAL MODEL ####
 ##################################
@@ -95,7 +129,10 @@ class IterativeSpectralForwardModel(Model):
                  order_num=None,
                  n_iterations=10,
                  model_resolution=8,
-                 crop_pix=[200, 200]):
+                 crop_pix=[200, 200],
+                 flux_dtype=np.float64,
+                 cache_size=0,
+                 convolve_and_sample=False):
         """Initiate an iterative spectral forward model object.
 
         Args:
@@ -110,6 +147,9 @@ class IterativeSpectralForwardModel(Model):
             n_iterations (int, optional): The number of iterations, or number of times to augment the template(s). Defaults to 10.
             model_resolution (int, optional): The oversample factor of the model relative to the data, which is important for proper convolution. Defaults to 8.
             crop_pix (list, optional): How many pixels to crop on the left and right of the observation when ordered accordibg to wavelength. Defaults to [200, 200].
+            flux_dtype (type, optional): The precision of the flux, LSF, and continuum products on the model grid, e.g. np.float32 to halve the memory traffic of the multiply-convolve-interpolate chain. Wavelength grids and the final model on the data grid are always float64. Defaults to np.float64.
+            cache_size (int, optional): The number of outputs of each component to memoize in build, keyed on the values of the parameters of that component. Defaults to 0 (no memoization).
+            convolve_and_sample (bool, optional): Whether or not build convolves the model with the LSF only at the data wavelengths with the banded operator from lsf.build_operator, rather than convolving the full model grid and interpolating. The renormalization and continuum are then applied on the data grid. build_jacobian and build_torch always use the two stage path. Defaults to False.
         """
         
         # The order number
@@ -124,6 +164,19 @@ class IterativeSpectralForwardModel(Model):
         # Number of pixels to crop
         self.crop_pix = crop_pix
         
+        # Flux precision on the model grid
+        self.flux_dtype = np.dtype(flux_dtype)
+        
+        # Memoization of component outputs in build
+        self.cache_size = cache_size
+        self.reset_cache()
+        
+        # Convolve and sample in one step
+        self.convolve_and_sample = convolve_and_sample
+        
+        # Buffers for build, set in initialize
+        self.workspace = None
+        
         # Model components
         self.wavelength_solution = wavelength_solution
         self.continuum = continuum
@@ -133,6 +186,11 @@ class IterativeSpectralForwardModel(Model):
         self.gas_cell = gas_cell
         self.fringing = fringing
         
+        # The one step path needs the banded operator of the LSF
+        if self.convolve_and_sample and not hasattr(self.lsf, "build_operator"):
+            warnings.warn(f"{self.lsf.__class__.__name__} has no build_operator method, using the two stage convolve and interpolate path")
+            self.convolve_and_sample = False
+        
     def _init_templates(self, data):
         data_wave_grid = data[0].parser.estimate_wavelength_solution(data[0])
         good = np.where(data[0].mask == 1)[0]
@@ -141,6 +199,10 @@ class IterativeSpectralForwardModel(Model):
         self.sregion = SpectralRegion(pixmin=good[0], pixmax=good[-1], wavemin=data_wave_grid[good[0]], wavemax=data_wave_grid[good[-1]])
         self.model_dl = (1 / self.sregion.pix_per_wave()) / self.model_resolution
         self.model_wave = np.arange(self.sregion.wavemin, self.sregion.wavemax, self.model_dl)
+
+        # arange may step past wavemax from rounding, where the spline continuum and wavelength solution are undefined
+        self.model_wave = self.model_wave[self.model_wave <= self.sregion.wavemax]
+        self.model_interpolator = pcmath.CubicSplineInterp(self.model_wave)
         self.templates_dict = {}
         if self.star is not None and not self.star.from_flat:
             self.templates_dict["star"] = self.star._init_template(data, self.sregion, self.model_dl)
@@ -193,6 +255,12 @@ class IterativeSpectralForwardModel(Model):
             self.gas_cell.initialize(self, iter_index)
         if self.fringing is not None:
             self.fringing.initialize(self, iter_index)
+        
+        # Components and templates may have changed
+        self.reset_cache()
+        
+        # Buffers for build
+        self.workspace = BuildWorkspace(self.model_wave.size, self.data.flux.size, flux_dtype=self.flux_dtype)
             
         # Determine initial stellar vel if necessary
         if iter_index == 0 and not self.star.from_flat:
@@ -203,56 +271,342 @@ class IterativeSpectralForwardModel(Model):
     #### BUILDERS ####
     ##################
         
-    def build(self, pars, wave_final=None):
+    def build(self, pars, wave_final=None, use_workspace=False):
+        """Builds the model on the data grid (or wave_final).
+
+        Args:
+            pars (BoundedParameters): The parameters.
+            wave_final (np.ndarray, optional): The wavelengths to sample the model at. Defaults to None (the wavelength solution of the data).
+            use_workspace (bool, optional): Whether or not to return the model in the workspace buffer instead of a new array. The buffer is overwritten by the next build with use_workspace=True, so this is only for callers which are done with the model before building again (e.g. objectives). Defaults to False.
+
+        Returns:
+            np.ndarray: The wavelength solution.
+            np.ndarray: The model.
+        """
         
         # Alias model wave grid
         model_wave = self.model_wave
         
+        # Alias models and templates dicts
+        templates_dict = self.templates_dict
+        
+        # Buffers for the intermediate stages
+        ws = self.workspace if wave_final is None else None
+            
+        # Init a model
+        if ws is not None:
+            model_flux = ws.model_flux
+            model_flux.fill(1)
+        else:
+            model_flux = np.ones(model_wave.size, dtype=self.flux_dtype)
+
+        # Star
+        if self.star is not None:
+            model_flux *= self.cached_build("star", pars, self.star.par_names, lambda: self.star.build(pars, templates_dict['star'], model_wave))
+        
+        # Gas Cell
+        if self.gas_cell is not None:
+            model_flux *= self.cached_build("gas_cell", pars, self.gas_cell.par_names, lambda: self.gas_cell.build(pars, templates_dict['gas_cell'], model_wave))
+            
+        # All tellurics
+        if self.tellurics is not None:
+            model_flux *= self.cached_build("tellurics", pars, self.tellurics.par_names, lambda: self.tellurics.build(pars, templates_dict['tellurics'], model_wave))
+        
+        # Fringing from who knows what
+        if self.fringing is not None:
+            model_flux *= self.cached_build("fringing", pars, self.fringing.par_names, lambda: self.fringing.build(pars, model_wave))
+            
+        # Convolve, the LSF is kept so the objective can check it without rebuilding
+        if self.lsf is not None and not self.convolve_and_sample:
+            self.lsf_last = self.cached_build("lsf", pars, self.lsf.par_names, lambda: self.lsf.build(pars))
+            model_flux = self.lsf.convolve_flux(model_flux, pars, lsf=self.lsf_last, out=ws.model_flux_conv if ws is not None else None)
+            
+            # Renormalize model to remove degeneracy between blaze and lsf
+            model_flux /= pcmath.weighted_median(model_flux, percentile=0.99)
+            
+        # Continuum
+        if self.continuum is not None and not self.convolve_and_sample:
+            model_flux *= self.cached_build("continuum", pars, self.continuum.par_names, lambda: self.continuum.build(pars, model_wave))
+
+        # Generate the wavelength solution of the data, the same array is returned for the same parameters so the interpolation weights are reused
+        if self.wavelength_solution is not None:
+            data_wave = self.cached_build("wavelength_solution", pars, self.wavelength_solution.par_names, lambda: self.wavelength_solution.build(pars))
+            
+        # Convolve and sample onto the data grid in one step
+        if self.convolve_and_sample:
+            model_flux_lr = self.convolve_and_sample_flux(model_flux, pars, data_wave if wave_final is None else wave_final)
+            return data_wave, model_flux_lr
+
+        # Interpolate high res model onto data grid
+        if ws is not None and data_wave.size == ws.model_flux_lr.size:
+            model_flux_lr = self.model_interpolator(model_flux, data_wave, out=ws.model_flux_lr if use_workspace else None, work=ws.slopes)
+        elif wave_final is None:
+            model_flux_lr = self.model_interpolator(model_flux, data_wave)
+        else:
+            model_flux_lr = self.model_interpolator(model_flux, wave_final)
+        
+        # Return
+        return data_wave, model_flux_lr
+    
+    def convolve_and_sample_flux(self, model_flux, pars, wave_out):
+        """Convolves the model with the LSF at wave_out only, then renormalizes and applies the continuum on wave_out. This replaces the convolution, continuum, and interpolation of build.
+
+        Args:
+            model_flux (np.ndarray): The product of the multiplicative components on the model grid.
+            pars (BoundedParameters): The parameters.
+            wave_out (np.ndarray): The wavelengths to sample.
+
+        Returns:
+            np.ndarray: The model at wave_out.
+        """
+        
+        # Banded convolve and sample operator
+        inds, weights = self.lsf.build_operator(pars, self.model_wave, wave_out)
+        model_flux_lr = np.einsum('ij,ij->i', model_flux[inds], weights)
+        
+        # Renormalize model to remove degeneracy between blaze and lsf
+        model_flux_lr /= pcmath.weighted_median(model_flux_lr, percentile=0.99)
+        
+        # Continuum
+        if self.continuum is not None:
+            model_flux_lr *= self.continuum.build(pars, wave_out)
+            
+        return model_flux_lr
+    
+    def missing_torch_components(self):
+        """Determines which components of the model have no build_torch method (or an LSF with no convolver), and therefore no differentiable path.
+
+        Returns:
+            list: The class names of those components.
+        """
+        components = [self.star, self.gas_cell, self.tellurics, self.fringing, self.lsf, self.continuum, self.wavelength_solution]
+        missing = [component.__class__.__name__ for component in components if component is not None and not hasattr(component, "build_torch")]
+        if self.lsf is not None and hasattr(self.lsf, "build_torch") and getattr(self.lsf, "convolver", None) is None:
+            missing.append(self.lsf.__class__.__name__)
+        return missing
+    
+    def build_torch(self, pars, wave_final=None):
+        """Differentiable equivalent of build using pytorch (cpu only). The flux is computed in float64, and the stellar, gas cell, and telluric products must be finite on the model grid. If a component has no build_torch method (see missing_torch_components), a warning is issued and the model from build is returned as tensors instead, which has no gradient.
+
+        Args:
+            pars (dict): The parameter values as torch scalars, keyed by the parameter names.
+            wave_final (np.ndarray, optional): The wavelength grid to interpolate the model onto. Defaults to the wavelength solution.
+
+        Returns:
+            torch.Tensor: The wavelength solution.
+            torch.Tensor: The model on the data grid.
+        """
+        
+        # Fall back to build if a component has no differentiable path
+        missing = self.missing_torch_components()
+        if len(missing) > 0:
+            warnings.warn(f"{', '.join(missing)} cannot be built with pytorch, using build instead (no gradient)")
+            pars_numpy = copy.deepcopy(self.p0)
+            for pname in pars:
+                pars_numpy[pname].value = float(pars[pname])
+            data_wave, model_flux_lr = self.build(pars_numpy, wave_final=wave_final)
+            return torch.from_numpy(data_wave), torch.from_numpy(model_flux_lr)
+        
+        # Alias model wave grid
+        model_wave = torch.from_numpy(self.model_wave)
+        
         # Alias models and templates dicts
         templates_dict = self.templates_dict
             
         # Init a model
-        model_flux = np.ones_like(model_wave)
+        model_flux = torch.ones(model_wave.numel(), dtype=torch.float64)
 
         # Star
         if self.star is not None:
-            model_flux *= self.star.build(pars, templates_dict['star'], model_wave)
+            model_flux = model_flux * self.star.build_torch(pars, templates_dict['star'], model_wave)
         
         # Gas Cell
         if self.gas_cell is not None:
-            model_flux *= self.gas_cell.build(pars, templates_dict['gas_cell'], model_wave)
+            model_flux = model_flux * self.gas_cell.build_torch(pars, templates_dict['gas_cell'], model_wave)
             
         # All tellurics
         if self.tellurics is not None:
-            model_flux *= self.tellurics.build(pars, templates_dict['tellurics'], model_wave)
+            model_flux = model_flux * self.tellurics.build_torch(pars, templates_dict['tellurics'], model_wave)
         
         # Fringing from who knows what
         if self.fringing is not None:
-            model_flux *= self.fringing.build(pars, model_wave)
+            model_flux = model_flux * self.fringing.build_torch(pars, model_wave)
             
         # Convolve
         if self.lsf is not None:
-            model_flux = self.lsf.convolve_flux(model_flux, pars)
+            model_flux = self.lsf.convolve_flux_torch(model_flux, pars)
             
             # Renormalize model to remove degeneracy between blaze and lsf
-            model_flux /= pcmath.weighted_median(model_flux, percentile=0.99)
+            model_flux = model_flux / pcmath.weighted_median_torch(model_flux, percentile=0.99)
             
         # Continuum
         if self.continuum is not None:
-            model_flux *= self.continuum.build(pars, model_wave)
+            model_flux = model_flux * self.continuum.build_torch(pars, model_wave)
 
         # Generate the wavelength solution of the data
         if self.wavelength_solution is not None:
-            data_wave = self.wavelength_solution.build(pars)
+            data_wave = self.wavelength_solution.build_torch(pars)
 
         # Interpolate high res model onto data grid
         if wave_final is None:
-            model_flux_lr = pcmath.cspline_interp(model_wave, model_flux, data_wave)
+            model_flux_lr = self.model_interpolator.interp_torch(model_flux, data_wave)
         else:
-            model_flux_lr = pcmath.cspline_interp(model_wave, model_flux, wave_final)
+            model_flux_lr = self.model_interpolator.interp_torch(model_flux, torch.as_tensor(wave_final, dtype=torch.float64))
         
         # Return
         return data_wave, model_flux_lr
+
+    def build_jacobian(self, pars, par_names=None, fd_step=1E-6):
+        """Builds the model on the data grid and its Jacobian with respect to each parameter. The continuum and wavelength solution are linear in their parameters, so their columns are exact (each continuum column is the convolved model times that parameter's column of the continuum basis matrix, and each wavelength solution column is the slope of the model times that parameter's column of the wavelength solution basis matrix). The remaining columns are forward differences which only rebuild the perturbed template or the convolution.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+            par_names (list, optional): The names of the parameters to differentiate with respect to. Defaults to all parameters.
+            fd_step (float, optional): The finite difference step relative to the range of the bounds of each parameter, or to max(|value|, 1) if unbounded. Steps in velocity must not be too small compared with the precision of the shifted wavelengths. Defaults to 1E-6.
+
+        Returns:
+            np.ndarray: The wavelength solution.
+            np.ndarray: The model on the data grid.
+            np.ndarray: The Jacobian; shape=(n_data_pixels, n_pars).
+        """
+
+        # Alias model wave grid
+        model_wave = self.model_wave
+
+        # Alias models and templates dicts
+        templates_dict = self.templates_dict
+
+        # Parameters
+        if par_names is None:
+            par_names = list(pars.keys())
+
+        # Each multiplicative factor before the convolution
+        mult_builders = {}
+        if self.star is not None:
+            mult_builders["star"] = lambda: self.star.build(pars, templates_dict['star'], model_wave)
+        if self.gas_cell is not None:
+            mult_builders["gas_cell"] = lambda: self.gas_cell.build(pars, templates_dict['gas_cell'], model_wave)
+        if self.tellurics is not None:
+            mult_builders["tellurics"] = lambda: self.tellurics.build(pars, templates_dict['tellurics'], model_wave)
+        if self.fringing is not None:
+            mult_builders["fringing"] = lambda: self.fringing.build(pars, model_wave)
+        factors = {key: builder() for key, builder in mult_builders.items()}
+
+        # Convolve and renormalize the product of the factors, see build
+        def convolve_factors(factors):
+            model_flux = np.ones(model_wave.size, dtype=self.flux_dtype)
+            for factor in factors.values():
+                model_flux *= factor
+            if self.lsf is not None:
+                model_flux = self.lsf.convolve_flux(model_flux, pars)
+                model_flux /= pcmath.weighted_median(model_flux, percentile=0.99)
+            return model_flux
+
+        # Nominal model
+        model_flux_conv = convolve_factors(factors)
+        continuum = self.continuum.build(pars, model_wave) if self.continuum is not None else 1
+        model_flux = model_flux_conv * continuum
+        data_wave = self.wavelength_solution.build(pars)
+        model_flux_lr = self.model_interpolator(model_flux, data_wave)
+
+        # Jacobian
+        jac = np.zeros((data_wave.size, len(par_names)))
+        model_flux_slope = None
+        for i, pname in enumerate(par_names):
+            v = pars[pname].value
+
+            # Continuum, from its basis matrix or otherwise a unit step which is exact
+            if self.continuum is not None and pname in self.continuum.par_names:
+                if getattr(self.continuum, "basis", None) is not None:
+                    basis = self.continuum.basis[:, self.continuum.par_names.index(pname)]
+                else:
+                    pars[pname].value = v + 1
+                    basis = self.continuum.build(pars, model_wave) - continuum
+                    pars[pname].value = v
+                jac[:, i] = self.model_interpolator(model_flux_conv * basis, data_wave)
+
+            # Wavelength solution, from its basis matrix or otherwise a unit step which is exact
+            elif pname in self.wavelength_solution.par_names:
+                if model_flux_slope is None:
+                    model_flux_slope = self.model_interpolator.derivative(model_flux, data_wave)
+                if getattr(self.wavelength_solution, "basis", None) is not None:
+                    dwave = self.wavelength_solution.basis[:, self.wavelength_solution.par_names.index(pname)]
+                else:
+                    pars[pname].value = v + 1
+                    dwave = self.wavelength_solution.build(pars) - data_wave
+                    pars[pname].value = v
+                jac[:, i] = model_flux_slope * dwave
+
+            # Forward difference
+            else:
+                h = pars[pname].upper_bound - pars[pname].lower_bound
+                h = fd_step * (h if np.isfinite(h) else max(np.abs(v), 1))
+                pars[pname].value = v + h
+                factors_step = dict(factors)
+                for key, builder in mult_builders.items():
+                    if pname in getattr(self, key).par_names:
+                        factors_step[key] = builder()
+                model_flux_step = convolve_factors(factors_step) * continuum
+                pars[pname].value = v
+                jac[:, i] = (self.model_interpolator(model_flux_step, data_wave) - model_flux_lr) / h
+
+        # Return
+        return data_wave, model_flux_lr, jac
+
+    ##############
+    #### MEMO ####
+    ##############
+    
+    def cached_build(self, key, pars, par_names, builder):
+        """Returns the output of a component from a least recently used cache keyed on the values of its parameters, otherwise calls builder. Cached outputs are read-only copies, so they can't be modified in place by the caller.
+
+        Args:
+            key (str): The name of the cache.
+            pars (BoundedParameters): The parameters.
+            par_names (list): The names of the parameters of this component.
+            builder (callable): Builds the component with no arguments.
+
+        Returns:
+            object: The output of builder.
+        """
+        if self.cache_size <= 0:
+            return builder()
+        if key not in self.cache:
+            self.cache[key] = OrderedDict()
+            self.cache_stats[key] = dict(hits=0, misses=0)
+        cache = self.cache[key]
+        par_values = tuple(pars[pname].value for pname in par_names)
+        if par_values in cache:
+            cache.move_to_end(par_values)
+            self.cache_stats[key]["hits"] += 1
+            return cache[par_values]
+        out = builder()
+        if isinstance(out, np.ndarray):
+            out = pcmath.readonly_copy(out)
+        cache[par_values] = out
+        if len(cache) > self.cache_size:
+            cache.popitem(last=False)
+        self.cache_stats[key]["misses"] += 1
+        return out
+    
+    def reset_cache(self):
+        """Clears the memoized component outputs, the hit counters, and the LSF of the last build.
+        """
+        self.cache = {}
+        self.cache_stats = {}
+        self.lsf_last = None
+    
+    def cache_summary(self):
+        """Summarizes the hit rate of each component cache since the last initialize.
+
+        Returns:
+            str: The summary.
+        """
+        s = ""
+        for key, stats in self.cache_stats.items():
+            n = stats["hits"] + stats["misses"]
+            s += f"  {key}: {stats['hits']} / {n} hits ({round(100 * stats['hits'] / n, 1)}%)\n"
+        return s
     
     ###############
     #### MISC. ####
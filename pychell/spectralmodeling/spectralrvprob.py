@@ -3,6 +3,10 @@ import importlib
 import copy
 import pickle
 import os
+import json
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 # Maths
 import numpy as np
@@ -16,7 +20,8 @@ import pychell.maths as pcmath
 import pychell.spectralmodeling.rvcalc as pcrvcalc
 import pychell.utils as pcutils
 from pychell.data.spectraldata import SpecData1d
-from pychell.spectralmodeling.spectralmodels import IterativeSpectralForwardModel
+from pychell.spectralmodeling.spectralmodels import IterativeSpectralForwardModel, SpectralRegion
+from pychell.spectralmodeling.spectral_results import write_results
 
 # Plots
 import matplotlib.pyplot as plt
@@ -36,6 +41,9 @@ class IterativeSpectralRVProb(OptProblem):
     """The primary container for a spectral forward model problem where the goal is to provide precise RVs.
     """
     
+    # The stages of each iteration in order, see compute_rvs_for_target
+    stages = ["fit", "ccf", "augment"]
+    
     ###############################
     #### CONSTRUCTOR + HELPERS ####
     ###############################
@@ -47,7 +55,10 @@ class IterativeSpectralRVProb(OptProblem):
                  tag, output_path, target_dict,
                  bc_corrs=None,
                  optimizer=None, obj=None,
-                 n_cores=1, verbose=True):
+                 n_chunks=1, chunk_overlap=50,
+                 checkpoint_every=None,
+                 plot_every=1, plot_worst=0,
+                 n_cores=1, persistent_pool=False, verbose=True):
         """Initiate the top level iterative spectral rv problem object.
 
         Args:
@@ -62,16 +73,40 @@ class IterativeSpectralRVProb(OptProblem):
             bc_corrs (np.ndarray, optional): The barycenter corrections may be passed manually as a two column numpy array; shape=(n_observations, 2). Defaults to None and the barycenter correcitons are computed with barycorrpy from information pulled form Simbad.
             optimizer (Optimizer, optional): The optimizer to use. Defaults to None.
             obj (SpectralObjective, optional): The objective function to ultimiately extremize. Defaults to None.
+            n_chunks (int, optional): The number of overlapping sub-order chunks to split the order into. Each chunk is fit independently with its own copy of spectral_model, so the components of spectral_model (e.g. the number of continuum and wavelength solution knots) should describe a single chunk. The RVs of the chunks are combined for each observation. Defaults to 1 (fit the full order).
+            chunk_overlap (int, optional): The number of pixels shared by neighboring chunks. Defaults to 50.
+            checkpoint_every (int, optional): The number of fits between checkpoints within an iteration, see compute_rvs_for_target. The fits are submitted in batches of this size. Defaults to None (only checkpoint after each stage).
+            plot_every (int, optional): Plot the forward model of every plot_every-th observation after each fit stage, see plot_spectral_models. Defaults to 1 (plot all observations). 0 plots none.
+            plot_worst (int, optional): Also plot the forward models of the plot_worst observations with the largest fit metric in each chunk. Defaults to 0.
             n_cores (int, optional): The number of cores to use. Defaults to 1.
+            persistent_pool (bool, optional): Whether or not to fit the observations with a FitWorkerPool when n_cores > 1, which ships the spectral model, data, objective, and optimizer to each worker once per run instead of with every fit. Defaults to False (joblib).
             verbose (bool, optional): Whether or not to print additional diagnostics ater each fit. This should be False for long runs. Defaults to True.
         """
         
         # The number of cores
         self.n_cores = n_cores
         
+        # Workers for fitting, started in optimize_all_observations
+        self.persistent_pool = persistent_pool
+        self.worker_pool = None
+        
         # Verbose
         self.verbose = verbose
         
+        # Chunks
+        self.n_chunks = n_chunks
+        self.chunk_overlap = chunk_overlap
+        
+        # Checkpoints
+        self.checkpoint_every = checkpoint_every
+        self.progress = None
+        
+        # Plots, rendered by a background process started in plot_spectral_models
+        self.plot_every = plot_every
+        self.plot_worst = plot_worst
+        self.plot_executor = None
+        self.plot_futures = []
+        
         # Input path
         self.data_input_path = data_input_path
         self.filelist = filelist
@@ -104,6 +139,9 @@ class IterativeSpectralRVProb(OptProblem):
         self._init_spectral_model()
         self.p0cp = copy.deepcopy(self.p0)
         
+        # Initialize the chunks
+        self._init_chunks()
+        
         # The target dictionary
         self.target_dict = target_dict
         
@@ -151,6 +189,29 @@ class IterativeSpectralRVProb(OptProblem):
             self.stellar_templates[0] = np.copy(self.spectral_model.templates_dict["star"])
         self.spectral_model._init_parameters(self.data)
 
+    def _init_chunks(self):
+        
+        # The full order is a single chunk
+        if self.n_chunks == 1:
+            self.chunks = [self]
+            return
+        
+        # Split the good region of the order into overlapping chunks of equal length
+        sregion = self.spectral_model.sregion
+        chunk_len = (sregion.pix_len() + (self.n_chunks - 1) * self.chunk_overlap) / self.n_chunks
+        if chunk_len <= self.chunk_overlap:
+            raise ValueError(f"Chunks of {round(chunk_len)} pixels must be longer than the overlap of {self.chunk_overlap} pixels")
+        wave_grid = self.parser.estimate_wavelength_solution(self.data[0])
+        self.chunks = []
+        for ichunk in range(self.n_chunks):
+            pixmin = sregion.pixmin + int(np.round(ichunk * (chunk_len - self.chunk_overlap)))
+            if ichunk == self.n_chunks - 1:
+                pixmax = sregion.pixmax
+            else:
+                pixmax = np.min([pixmin + int(np.round(chunk_len)) - 1, sregion.pixmax])
+            chunk_sregion = SpectralRegion(pixmin=pixmin, pixmax=pixmax, wavemin=wave_grid[pixmin], wavemax=wave_grid[pixmax], label=f"chunk{ichunk + 1}")
+            self.chunks.append(SpectralRVChunk(self, chunk_sregion, f"{self.tag}_chunk{ichunk + 1}"))
+
     def _init_rvs(self, bc_corrs=None):
         
         # Get the spectrograph observatory
@@ -196,12 +257,22 @@ class IterativeSpectralRVProb(OptProblem):
         # xc grid info
         self.rvs_dict['xcorrs'] = np.empty(shape=(self.n_spec, self.n_iterations), dtype=np.ndarray)
         
+        # Individual RVs for each chunk
+        if self.n_chunks > 1:
+            self.rvs_dict["rvsfwm_chunks"] = np.full((self.n_spec, self.n_chunks, self.n_iterations), np.nan)
+            self.rvs_dict["rvsxc_chunks"] = np.full((self.n_spec, self.n_chunks, self.n_iterations), np.nan)
+            self.rvs_dict["uncxc_chunks"] = np.full((self.n_spec, self.n_chunks, self.n_iterations), np.nan)
+            self.rvs_dict["bis_chunks"] = np.full((self.n_spec, self.n_chunks, self.n_iterations), np.nan)
+            self.rvs_dict["xcorrs_chunks"] = np.empty(shape=(self.n_spec, self.n_chunks, self.n_iterations), dtype=np.ndarray)
+        
     def _print_init_summary(self):
         print("***************************************", flush=True)
         print(f"** Target: {self.target_dict['name'].replace('_', ' ')}", flush=True)
         print(f"** Spectrograph: {self.spec_module.observatory['name']} / {self.spectrograph}", flush=True)
         print(f"** Observations: {self.n_spec} spectra, {self.n_nights} nights", flush=True)
         print(f"** Image Order: {self.order_num}", flush=True)
+        if self.n_chunks > 1:
+            print(f"** Chunks: {self.n_chunks}", flush=True)
         print(f"** Tag: {self.tag}", flush=True)
         print(f"** Iterations: {self.n_iterations}", flush=True)
         print(f"** N Cores: {self.n_cores}", flush=True)
@@ -211,125 +282,268 @@ class IterativeSpectralRVProb(OptProblem):
     #### OPTIMIZE ####
     ##################
     
-    def compute_rvs_for_target(self):
-        """The main function to run for a given target to compute the RVs for iterative spectral rv problems.
+    def compute_rvs_for_target(self, resume=False):
+        """The main function to run for a given target to compute the RVs for iterative spectral rv problems. A checkpoint is written after each stage of each iteration (fitting, cross correlating, and augmenting the templates), see save_checkpoint.
+
+        Args:
+            resume (bool, optional): Whether or not to resume from the checkpoint of a previous run of the same problem. Completed stages are skipped, and observations which were already fit in a partially finished iteration are not refit. Defaults to False.
         """
 
         # Start the main clock!
         stopwatch = pcutils.StopWatch()
         stopwatch.lap(name='ti_main')
+        
+        # Restore the last checkpoint
+        self.progress = None
+        if resume:
+            self.load_checkpoint()
                 
-        # Iterate over remaining stellar template generations
-        for iter_index in range(self.n_iterations):
+        try:
             
-            if iter_index == 0 and hasattr(self.spectral_model, "star") and self.spectral_model.star is not None and self.spectral_model.star.from_flat:
+            # Iterate over remaining stellar template generations
+            for iter_index in range(self.n_iterations):
+                
+                # Already completed
+                if self.stage_completed(iter_index, "augment") or (iter_index == self.n_iterations - 1 and self.stage_completed(iter_index, "ccf")):
+                    print(f"Skipping Iteration {iter_index + 1} of {self.n_iterations} (checkpoint)", flush=True)
+                    continue
                 
-                print(f"Starting Iteration {iter_index + 1} of {self.n_iterations} (flat template, no RVs) ...", flush=True)
-                stopwatch.lap(name='ti_iter')
+                if iter_index == 0 and hasattr(self.spectral_model, "star") and self.spectral_model.star is not None and self.spectral_model.star.from_flat:
+                    
+                    print(f"Starting Iteration {iter_index + 1} of {self.n_iterations} (flat template, no RVs) ...", flush=True)
+                    stopwatch.lap(name='ti_iter')
+                    
+                    # Fit all observations
+                    if not self.stage_completed(iter_index, "fit"):
+                        self.optimize_all_observations(0)
+                        self.plot_spectral_models(0)
+                        self.save_checkpoint(iter_index, "fit")
+                    
+                    print(f"Finished Iteration {iter_index + 1} in {round(stopwatch.time_since(name='ti_iter')/3600, 2)} hours", flush=True)
+                    
+                    # Augment the template
+                    if iter_index < self.n_iterations - 1:
+                        self.augment_templates(iter_index)
+                        self.save_checkpoint(iter_index, "augment")
                 
-                # Fit all observations
-                self.optimize_all_observations(0)
+                else:
+                    
+                    print(f"Starting Iteration {iter_index + 1} of {self.n_iterations} ...", flush=True)
+                    stopwatch.lap(name='ti_iter')
+
+                    # Run the fit for all spectra and do a cross correlation analysis as well.
+                    if not self.stage_completed(iter_index, "fit"):
+                        self.optimize_all_observations(iter_index)
+                        self.plot_spectral_models(iter_index)
+                        self.save_checkpoint(iter_index, "fit")
+                    
+                    if not self.stage_completed(iter_index, "ccf"):
                 
-                print(f"Finished Iteration {iter_index + 1} in {round(stopwatch.time_since(name='ti_iter')/3600, 2)} hours", flush=True)
+                        # Run the ccf for all spectra
+                        self.cross_correlate_spectra(iter_index)
                 
-                # Augment the template
-                if iter_index < self.n_iterations - 1:
-                    self.augment_templates(iter_index)
-            
-            else:
+                        # Generate the rvs for each observation
+                        self.gen_nightly_rvs(iter_index)
                 
-                print(f"Starting Iteration {iter_index + 1} of {self.n_iterations} ...", flush=True)
-                stopwatch.lap(name='ti_iter')
-
-                # Run the fit for all spectra and do a cross correlation analysis as well.
-                self.optimize_all_observations(iter_index)
-            
-                # Run the ccf for all spectra
-                self.cross_correlate_spectra(iter_index)
-            
-                # Generate the rvs for each observation
-                self.gen_nightly_rvs(iter_index)
-            
-                # Plot the rvs
-                self.plot_rvs(iter_index)
-            
-                # Save the rvs each iteration
-                self.save_rvs()
+                        # Plot the rvs
+                        self.plot_rvs(iter_index)
                 
-                print(f"Finished Iteration {iter_index + 1} in {round(stopwatch.time_since(name='ti_iter')/3600, 2)} hours", flush=True)
-
-                # Print RV Diagnostics
-                if self.n_spec >= 1:
-                    rvs_std = np.nanstd(self.rvs_dict['rvsfwm'][:, iter_index])
-                    print(f"  Stddev of all fwm RVs: {round(rvs_std, 4)} m/s", flush=True)
-                    rvs_std = np.nanstd(self.rvs_dict['rvsxc'][:, iter_index])
-                    print(f"  Stddev of all xc RVs: {round(rvs_std, 4)} m/s", flush=True)
-                if self.n_nights > 1:
-                    rvs_std = np.nanstd(self.rvs_dict['rvsfwm_nightly'][:, iter_index])
-                    print(f"  Stddev of all fwm nightly RVs: {round(rvs_std, 4)} m/s", flush=True)
-                    rvs_std = np.nanstd(self.rvs_dict['rvsxc_nightly'][:, iter_index])
-                    print(f"  Stddev of all xc nightly RVs: {round(rvs_std, 4)} m/s", flush=True)
+                        # Save the rvs each iteration
+                        self.save_rvs()
+                        self.save_checkpoint(iter_index, "ccf")
                     
-                # Augment the template
-                if iter_index < self.n_iterations - 1:
-                    self.augment_templates(iter_index)
-                
+                    print(f"Finished Iteration {iter_index + 1} in {round(stopwatch.time_since(name='ti_iter')/3600, 2)} hours", flush=True)
+
+                    # Print RV Diagnostics
+                    if self.n_spec >= 1:
+                        rvs_std = np.nanstd(self.rvs_dict['rvsfwm'][:, iter_index])
+                        print(f"  Stddev of all fwm RVs: {round(rvs_std, 4)} m/s", flush=True)
+                        rvs_std = np.nanstd(self.rvs_dict['rvsxc'][:, iter_index])
+                        print(f"  Stddev of all xc RVs: {round(rvs_std, 4)} m/s", flush=True)
+                    if self.n_nights > 1:
+                        rvs_std = np.nanstd(self.rvs_dict['rvsfwm_nightly'][:, iter_index])
+                        print(f"  Stddev of all fwm nightly RVs: {round(rvs_std, 4)} m/s", flush=True)
+                        rvs_std = np.nanstd(self.rvs_dict['rvsxc_nightly'][:, iter_index])
+                        print(f"  Stddev of all xc nightly RVs: {round(rvs_std, 4)} m/s", flush=True)
+                        
+                    # Augment the template
+                    if iter_index < self.n_iterations - 1:
+                        self.augment_templates(iter_index)
+                        self.save_checkpoint(iter_index, "augment")
+
+        finally:
+            
+            # Stop the workers and the plotting process, also when the run fails so no processes or template files are left behind
+            self.shutdown_workers()
 
         # Save forward model outputs
         print("Saving results ... ", flush=True)
+        self.save_results()
         self.save_to_pickle()
         
         # End the clock!
         print(f"Completed order {self.order_num} Runtime: {round(stopwatch.time_since(name='ti_main') / 3600, 2)} hours", flush=True)
         
+    def shutdown_workers(self):
+        """Stops the fit workers (removing their template files) and waits for the remaining plots to be rendered. Plots which failed to render are reported.
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+            self.worker_pool = None
+        if self.plot_executor is not None:
+            self.plot_executor.shutdown(wait=True)
+            self.plot_executor = None
+            for fname, future in self.plot_futures:
+                if future.exception() is not None:
+                    print(f"Could not render {fname}: {future.exception()!r}", flush=True)
+            self.plot_futures = []
+        
     def optimize_all_observations(self, iter_index):
             
         # Timer
         stopwatch = pcutils.StopWatch()
-
-        # Parallel fitting
-        if self.n_cores > 1:
-            
+        
+        # All observations of all chunks are fit independently, observations with results (from a checkpoint) are not refit
+        tasks = [(ichunk, ispec) for ichunk in range(self.n_chunks) for ispec in range(self.n_spec) if self.chunks[ichunk].opt_results[ispec, iter_index] is None]
+        
+        # Get the initial parameters for each spectrum and chunk, further modified later on before optimizing
+        p0s = []
+        for ichunk, ispec in tasks:
             if iter_index == 0:
-                p0s = [self.p0] * self.n_spec
+                p0s.append(self.chunks[ichunk].p0)
             else:
-                p0s = []
-                for ispec in range(self.n_spec):
-                    p0s.append(self.opt_results[ispec, iter_index - 1]["pbest"])
-            
-            # Call the parallel job via joblib.
-            self.opt_results[:, iter_index] = Parallel(n_jobs=self.n_cores, verbose=0, batch_size=1)(delayed(self.optimize_and_plot_observation)(p0s[ispec], self.data[ispec], self.spectral_model, self.obj, self.optimizer, iter_index, self.output_path, self.tag, self.target_dict["name"], self.verbose) for ispec in range(self.n_spec))
+                p0s.append(self.chunks[ichunk].opt_results[ispec, iter_index - 1]["pbest"])
+        
+        # Submit the longest fits first so the last fits to finish are short
+        if self.n_cores > 1 and len(tasks) > 1:
+            ss = np.argsort(-1 * self.gen_task_costs(tasks, iter_index), kind="stable")
+            tasks, p0s = [tasks[i] for i in ss], [p0s[i] for i in ss]
+        
+        # Workers which persist for the run, the templates for this iteration are shared through files
+        if self.n_cores > 1 and self.persistent_pool:
+            if self.worker_pool is None:
+                self.worker_pool = FitWorkerPool(self)
+                
+                # Measured once, pickling the full spectral model is expensive
+                if self.verbose and len(tasks) > 0:
+                    ichunk, ispec = tasks[0]
+                    bytes_joblib = len(pickle.dumps((p0s[0], self.chunks[ichunk].data[ispec], self.chunks[ichunk].spectral_model, self.obj, self.optimizer, iter_index, self.verbose)))
+                    bytes_pool = len(pickle.dumps((ichunk, ispec, iter_index, p0s[0])))
+                    print(f"Serialization per fit: {round(bytes_pool / 1E3, 1)} KB (vs. {round(bytes_joblib / 1E3, 1)} KB without the worker pool)", flush=True)
+            self.worker_pool.sync_templates(iter_index)
+        
+        # Fit in batches with a checkpoint after each
+        stopwatch.lap(name='ti_fit')
+        batch_size = max(len(tasks) if self.checkpoint_every is None else self.checkpoint_every, 1)
+        for i0 in range(0, len(tasks), batch_size):
+            batch = range(i0, min(i0 + batch_size, len(tasks)))
 
-        else:
+            # Persistent workers
+            if self.n_cores > 1 and self.persistent_pool:
+                opt_results = self.worker_pool.map([tasks[i] for i in batch], [p0s[i] for i in batch], iter_index)
 
-            # Fit one observation at a time
-            for ispec in range(self.n_spec):
+            # Parallel fitting
+            elif self.n_cores > 1:
                 
-                # Get the initial parameters for this spectrum and chunk, further modified later on before optimizing
-                if iter_index == 0:
-                    p0 = self.p0
-                else:
-                    p0 = self.opt_results[ispec, iter_index - 1]["pbest"]
+                # Call the parallel job via joblib.
+                opt_results = Parallel(n_jobs=self.n_cores, verbose=0, batch_size=1)(delayed(self.optimize_observation)(p0s[i], self.chunks[tasks[i][0]].data[tasks[i][1]], self.chunks[tasks[i][0]].spectral_model, self.obj, self.optimizer, iter_index, self.verbose) for i in batch)
+
+            else:
 
-                # Optimize and plot all chunks, store results
-                self.opt_results[ispec, iter_index] = self.optimize_and_plot_observation(p0, self.data[ispec], self.spectral_model,
-                                                                                         self.obj, self.optimizer, iter_index,
-                                                                                         self.output_path,
-                                                                                         self.tag, self.target_dict["name"], self.verbose)
+                # Fit one observation at a time
+                opt_results = []
+                for i in batch:
+                    ichunk, ispec = tasks[i]
+                    
+                    # Optimize, store results
+                    opt_results.append(self.optimize_observation(p0s[i], self.chunks[ichunk].data[ispec], self.chunks[ichunk].spectral_model, self.obj, self.optimizer, iter_index, self.verbose))
+            
+            # Store results
+            for i, opt_result in zip(batch, opt_results):
+                ichunk, ispec = tasks[i]
+                self.chunks[ichunk].opt_results[ispec, iter_index] = opt_result
+            
+            # Checkpoint the fits so far
+            if self.checkpoint_every is not None:
+                self.save_checkpoint()
         
         # Store rvs
-        rvsfwm = np.full(self.n_spec, np.nan)
+        rvsfwm = np.full((self.n_spec, self.n_chunks), np.nan)
+        for ichunk, chunk in enumerate(self.chunks):
+            for ispec in range(self.n_spec):
+                pbest = chunk.opt_results[ispec, iter_index]["pbest"]
+                true_star_vel_tdb = pbest[chunk.spectral_model.star.par_names[0]].value + self.data[ispec].bc_vel
+                rvsfwm[ispec, ichunk] = true_star_vel_tdb
+        
+        # Combine the chunks
+        if self.n_chunks == 1:
+            self.rvs_dict["rvsfwm"][:, iter_index] = rvsfwm[:, 0]
+        else:
+            self.combine_chunk_fits(iter_index)
+            self.rvs_dict["rvsfwm_chunks"][:, :, iter_index] = rvsfwm
+            self.rvs_dict["rvsfwm"][:, iter_index], _ = pcrvcalc.combine_chunk_rvs(rvsfwm, self.gen_chunk_weights(iter_index))
+        
+        # Print finished, the core utilization is the fraction of the time the cores spent fitting
+        if len(tasks) > 0:
+            walltimes = np.array([self.chunks[ichunk].opt_results[ispec, iter_index].get("walltime", np.nan) for ichunk, ispec in tasks], dtype=float)
+            utilization = np.nansum(walltimes) / (min(self.n_cores, len(tasks)) * stopwatch.time_since(name='ti_fit'))
+            print(f"Fitting Finished in {round((stopwatch.time_since())/60, 3)} min, core utilization: {round(100 * utilization, 1)}%", flush=True)
+        else:
+            print(f"Fitting Finished in {round((stopwatch.time_since())/60, 3)} min ", flush=True)
+        
+    def gen_task_costs(self, tasks, iter_index):
+        """The expected cost of each fit, used to order the fits. The cost is the wall time of the same fit in the previous iteration. If that is unavailable for any fit (e.g. in the first iteration), the cost is the number of good pixels instead. Observations which are not good are not fit and cost nothing.
+
+        Args:
+            tasks (list): The (chunk index, spectrum index) of each fit.
+            iter_index (int): The iteration index.
+
+        Returns:
+            np.ndarray: The cost of each fit.
+        """
+        good = np.array([self.chunks[ichunk].data[ispec].is_good for ichunk, ispec in tasks], dtype=bool)
+        costs = np.full(len(tasks), np.nan)
+        if iter_index > 0:
+            for i, (ichunk, ispec) in enumerate(tasks):
+                costs[i] = self.chunks[ichunk].opt_results[ispec, iter_index - 1].get("walltime", np.nan)
+        if not np.all(np.isfinite(costs[good])):
+            for i, (ichunk, ispec) in enumerate(tasks):
+                costs[i] = np.nansum(self.chunks[ichunk].data[ispec].mask)
+        costs[~good] = 0
+        return costs
+    
+    def combine_chunk_fits(self, iter_index):
+        """Stores the combined fit of all chunks for each observation in opt_results. The fit metric is the rms of the chunk fit metrics, and fcalls and walltime are summed over chunks. There are no best fit parameters for the full order, see the chunks for those.
+
+        Args:
+            iter_index (int): The iteration index.
+        """
         for ispec in range(self.n_spec):
-            pbest = self.opt_results[ispec, iter_index]["pbest"]
-            true_star_vel_tdb = pbest[self.spectral_model.star.par_names[0]].value + self.data[ispec].bc_vel
-            rvsfwm[ispec] = true_star_vel_tdb
-        self.rvs_dict["rvsfwm"][:, iter_index] = rvsfwm
+            fbests = np.array([chunk.opt_results[ispec, iter_index]["fbest"] for chunk in self.chunks], dtype=float)
+            fcalls = np.array([chunk.opt_results[ispec, iter_index]["fcalls"] for chunk in self.chunks], dtype=float)
+            walltimes = np.array([chunk.opt_results[ispec, iter_index].get("walltime", np.nan) for chunk in self.chunks], dtype=float)
+            if np.any(np.isfinite(fbests)):
+                self.opt_results[ispec, iter_index] = dict(fbest=np.sqrt(np.nanmean(fbests**2)), fcalls=np.nansum(fcalls), walltime=np.nansum(walltimes))
+            else:
+                self.opt_results[ispec, iter_index] = dict(fbest=np.nan, fcalls=np.nan, walltime=np.nan)
         
-        # Print finished
-        print(f"Fitting Finished in {round((stopwatch.time_since())/60, 3)} min ", flush=True)
+    def gen_chunk_weights(self, iter_index):
+        """The weights of each chunk for each observation, the inverse of the fit metric squared.
+
+        Args:
+            iter_index (int): The iteration index.
+
+        Returns:
+            np.ndarray: The weights; shape=(n_spec, n_chunks).
+        """
+        weights = np.full((self.n_spec, self.n_chunks), np.nan)
+        for ichunk, chunk in enumerate(self.chunks):
+            for ispec in range(self.n_spec):
+                weights[ispec, ichunk] = 1 / chunk.opt_results[ispec, iter_index]["fbest"]**2
+        return weights
             
     @staticmethod
-    def optimize_and_plot_observation(p0, data, spectral_model, obj, optimizer, iter_index, output_path, tag, star_name, verbose):
+    def optimize_observation(p0, data, spectral_model, obj, optimizer, iter_index, verbose):
         
         if data.is_good:
             
@@ -353,18 +567,18 @@ class IterativeSpectralRVProb(OptProblem):
             
             # Fit the observation
             opt_result = optimizer.optimize()
+            opt_result["walltime"] = stopwatch.time_since()
             
             # Print diagnostics
-            print(f"Fit spectrum {data.spec_num} in {round((stopwatch.time_since())/60, 2)} min", flush=True)
+            print(f"Fit spectrum {data.spec_num} in {round(opt_result['walltime']/60, 2)} min", flush=True)
             if verbose:
                 print(f" RMS = {round(opt_result['fbest'], 3)}", flush=True)
                 print(f" Best Fit Parameters:\n{spectral_model.summary(opt_result['pbest'])}", flush=True)
-
-            # Plot
-            IterativeSpectralRVProb.plot_spectral_model(opt_result["pbest"], data, spectral_model, iter_index, output_path, tag, star_name)
+                if spectral_model.cache_size > 0:
+                    print(f" Build Cache:\n{spectral_model.cache_summary()}", flush=True)
             
         else:
-            opt_result = dict(pbest=p0.gen_nan_pars(), fbest=np.nan, fcalls=np.nan)
+            opt_result = dict(pbest=p0.gen_nan_pars(), fbest=np.nan, fcalls=np.nan, walltime=np.nan)
         
         # Return result
         return opt_result
@@ -373,19 +587,120 @@ class IterativeSpectralRVProb(OptProblem):
     #### PLOTS ####
     ###############
     
-    @staticmethod
-    def plot_spectral_model(pars, data, spectral_model, iter_index, output_path, tag, star_name):
+    def plot_spectral_models(self, iter_index):
+        """Renders the forward models of the observations selected by plot_every and plot_worst for each chunk. The arrays are generated in this process from the best fit parameters, and the figures are rendered and saved by a separate low priority process while the run continues.
+
+        Args:
+            iter_index (int): The iteration index.
+        """
         
-        # Figure dims for 1 chunk
-        fig_width, fig_height = 2000, 720
-        dpi = 200
-        figsize = int(fig_width / dpi), int(fig_height / dpi)
+        for chunk in self.chunks:
+            
+            # Which observations
+            plot_inds = self.select_plots(chunk, iter_index)
+            if len(plot_inds) == 0:
+                continue
+            
+            # Background process for rendering
+            if self.plot_executor is None:
+                self.plot_executor = ProcessPoolExecutor(max_workers=1, initializer=_init_plot_worker)
+            
+            # Generate the arrays with a copy of the model so the model sent to the workers is unchanged
+            spectral_model = self.copy_spectral_model(chunk)
+            for ispec in plot_inds:
+                plot_arrays, fname, title = self.gen_observation_plot(chunk, ispec, iter_index, spectral_model)
+                self.plot_futures.append((fname, self.plot_executor.submit(self.render_spectral_model, plot_arrays, fname, title)))
+                
+    def plot_observation(self, ispec, iter_index, ichunk=0):
+        """Plots the forward model of a single observation on demand from the stored best fit parameters. The figure is rendered in this process.
+
+        Args:
+            ispec (int): The spectrum index.
+            iter_index (int): The iteration index.
+            ichunk (int, optional): The chunk index. Defaults to 0.
+        """
+        chunk = self.chunks[ichunk]
+        self.render_spectral_model(*self.gen_observation_plot(chunk, ispec, iter_index, self.copy_spectral_model(chunk)))
         
-        # Create subplot
-        fig = plt.figure(figsize=figsize, dpi=dpi)
+    @staticmethod
+    def copy_spectral_model(chunk, templates=True):
+        """Deep copies the spectral model of a chunk without copying the template arrays.
+
+        Args:
+            chunk (IterativeSpectralRVProb or SpectralRVChunk): The chunk.
+            templates (bool, optional): Whether the copy shares the template arrays of the chunk, otherwise the copy has no templates. Defaults to True.
+
+        Returns:
+            IterativeSpectralForwardModel: The copy.
+        """
+        templates_dict = chunk.spectral_model.templates_dict
+        chunk.spectral_model.templates_dict = {}
+        try:
+            spectral_model = copy.deepcopy(chunk.spectral_model)
+        finally:
+            chunk.spectral_model.templates_dict = templates_dict
+        if templates:
+            spectral_model.templates_dict = dict(templates_dict)
+        return spectral_model
+                
+    def gen_observation_plot(self, chunk, ispec, iter_index, spectral_model):
+        """Generates the arrays to plot the forward model of an observation from the stored best fit parameters.
+
+        Args:
+            chunk (IterativeSpectralRVProb or SpectralRVChunk): The chunk.
+            ispec (int): The spectrum index.
+            iter_index (int): The iteration index.
+            spectral_model (IterativeSpectralForwardModel): A copy of the spectral model of the chunk (see copy_spectral_model), which is initialized for this observation.
+
+        Returns:
+            dict: The arrays to plot, see gen_spectral_model_plot.
+            str: The full path of the figure.
+            str: The title.
+        """
+        data = chunk.data[ispec]
+        pars = chunk.opt_results[ispec, iter_index]["pbest"]
+        spectral_model.initialize(copy.deepcopy(pars), data, None)
+        plot_arrays = self.gen_spectral_model_plot(pars, spectral_model, self.obj, iter_index)
+        fname = f"{self.output_path}Order{data.order_num}{os.sep}ForwardModels{os.sep}{chunk.tag}_data_model_spec{data.spec_num}_ord{data.order_num}_iter{iter_index + 1}.png"
+        title = f"{self.target_dict['name'].replace('_', ' ')}, Order {data.order_num}, Iteration {iter_index + 1}"
+        return plot_arrays, fname, title
+                
+    def select_plots(self, chunk, iter_index):
+        """The observations of a chunk to plot for an iteration, every plot_every-th observation and the plot_worst observations with the largest fit metric.
+
+        Args:
+            chunk (IterativeSpectralRVProb or SpectralRVChunk): The chunk.
+            iter_index (int): The iteration index.
+
+        Returns:
+            np.ndarray: The spectrum indices.
+        """
+        inds = []
+        if self.plot_every > 0:
+            inds += list(range(0, self.n_spec, self.plot_every))
+        if self.plot_worst > 0:
+            fbests = np.array([chunk.opt_results[ispec, iter_index]["fbest"] for ispec in range(self.n_spec)], dtype=float)
+            good = np.where(np.isfinite(fbests))[0]
+            inds += list(good[np.argsort(fbests[good])[::-1][0:self.plot_worst]])
+        return np.array([ispec for ispec in np.unique(np.array(inds, dtype=int)) if chunk.data[ispec].is_good], dtype=int)
+    
+    @staticmethod
+    def gen_spectral_model_plot(pars, spectral_model, obj, iter_index):
+        """Generates the arrays to plot the forward model of an observation, see render_spectral_model.
+
+        Args:
+            pars (BoundedParameters): The parameters.
+            spectral_model (IterativeSpectralForwardModel): The spectral model, initialized for the observation.
+            obj (SpectralObjective): The objective, which determines the masked edges and flagged pixels.
+            iter_index (int): The iteration index.
+
+        Returns:
+            dict: The arrays to plot, all on the data grid except for xlim.
+        """
         
         # Build the model
         wave_data, model_lr = spectral_model.build(pars)
+        wave_data, model_lr = np.copy(wave_data), np.copy(model_lr)
         wave_data_nm = wave_data / 10
         
         # The residuals for this iteration
@@ -398,35 +713,25 @@ class IterativeSpectralRVProb(OptProblem):
         residuals[mask == 0] = np.nan
         
         # Change edges to nans
-        if spectral_model.obj.remove_edges > 0:
+        if obj.remove_edges > 0:
             good = np.where(mask == 1)[0]
-            mask[good[0:spectral_model.obj.remove_edges]] = 0
-            mask[good[-spectral_model.obj.remove_edges:]] = 0
+            mask[good[0:obj.remove_edges]] = 0
+            mask[good[-obj.remove_edges:]] = 0
             residuals[mask == 0] = np.nan
             
         # Now check which bad pixels were also flagged
-        if spectral_model.obj.flag_n_worst_pixels > 1:
+        flagged_inds = np.array([], dtype=int)
+        if obj.flag_n_worst_pixels > 1:
             ss = np.argsort(np.abs(residuals))
             k = np.max(np.where(np.isfinite(residuals[ss]))[0])
-            flagged_inds = ss[k-1*spectral_model.obj.flag_n_worst_pixels - 1:k]
+            flagged_inds = ss[k-1*obj.flag_n_worst_pixels - 1:k]
     
         # Left and right padding
         good = np.where(mask == 1)[0]
         pad = 0.01 * (wave_data_nm[good][-1] - wave_data_nm[good][0])
         
-        # Data
-        plt.plot(wave_data_nm, spectral_model.data.flux, color=(0, 114/255, 189/255), lw=0.8, label="Data")
-        
-        # Model
-        plt.plot(wave_data_nm, model_lr, color=(217/255, 83/255, 25/255), lw=0.8, label="Model")
-        
-        # Zero line and -0.1 line
-        plt.plot(wave_data_nm, np.zeros_like(wave_data_nm), color=(89/255, 23/255, 130/255), lw=0.8, linestyle=':')
-        plt.plot(wave_data_nm, np.zeros_like(wave_data_nm) - 0.2, color=(89/255, 23/255, 130/255), lw=0.8, linestyle=':')
-        
-        # Residuals and worst pixels which were flagged
-        plt.plot(wave_data_nm, residuals, color=(255/255, 169/255, 22/255), lw=0.8, label="Residuals")
-        plt.plot(wave_data_nm[flagged_inds], residuals[flagged_inds], color="maroon", alpha=0.8, marker='X', markersize=4, lw=0)
+        plot_arrays = dict(wave_data_nm=wave_data_nm, flux=np.copy(spectral_model.data.flux), model=model_lr, residuals=residuals, flagged_inds=flagged_inds,
+                           xlim=(spectral_model.sregion.wavemin / 10 - pad, spectral_model.sregion.wavemax / 10 + pad))
         
         # LSF
         lsf = spectral_model.lsf.build(pars=pars)
@@ -440,31 +745,80 @@ class IterativeSpectralRVProb(OptProblem):
                 star_flux = spectral_model.star.initial_template[:, 1]
                 star_flux = pcmath.doppler_shift(star_wave, pars[spectral_model.star.par_names[0]].value, wave_out=spectral_model.model_wave, flux=star_flux, interp="cspline", kind="exp")
                 star_flux = spectral_model.lsf.convolve_flux(star_flux, lsf=lsf)
-                star_flux = pcmath.cspline_interp(spectral_model.model_wave, star_flux, wave_data)
-                plt.plot(wave_data_nm, star_flux - 1.2, label='Initial Star', lw=0.8, color='aqua', alpha=0.5)
+                plot_arrays["star_initial"] = pcmath.cspline_interp(spectral_model.model_wave, star_flux, wave_data)
             
             # Current star
             star_flux = spectral_model.star.build(pars, spectral_model.templates_dict['star'], spectral_model.model_wave)
             star_flux = spectral_model.lsf.convolve_flux(star_flux, lsf=lsf)
-            star_flux = pcmath.cspline_interp(spectral_model.model_wave, star_flux, wave_data)
-            plt.plot(wave_data_nm, star_flux - 1.2, label='Current Star', lw=0.8, color='deeppink', alpha=0.8)
+            plot_arrays["star"] = pcmath.cspline_interp(spectral_model.model_wave, star_flux, wave_data)
         
         # Tellurics
         if spectral_model.tellurics is not None:
             tell_flux = spectral_model.tellurics.build(pars, spectral_model.templates_dict['tellurics'], spectral_model.model_wave)
             tell_flux = spectral_model.lsf.convolve_flux(tell_flux, lsf=lsf)
-            tell_flux = pcmath.cspline_interp(spectral_model.model_wave, tell_flux, wave_data)
-            plt.plot(wave_data_nm, tell_flux - 1.2, label='Tellurics', lw=0.8, color='indigo', alpha=0.2)
+            plot_arrays["tellurics"] = pcmath.cspline_interp(spectral_model.model_wave, tell_flux, wave_data)
         
         # Gas Cell
         if spectral_model.gas_cell is not None:
             gas_flux = spectral_model.gas_cell.build(pars, spectral_model.templates_dict['gas_cell'], spectral_model.model_wave)
             gas_flux = spectral_model.lsf.convolve_flux(gas_flux, lsf=lsf)
-            gas_flux = pcmath.cspline_interp(spectral_model.model_wave, gas_flux, wave_data)
-            plt.plot(wave_data_nm, gas_flux - 1.2, label='Gas Cell', lw=0.8, color='green', alpha=0.2)
+            plot_arrays["gas_cell"] = pcmath.cspline_interp(spectral_model.model_wave, gas_flux, wave_data)
+            
+        return plot_arrays
+    
+    @staticmethod
+    def render_spectral_model(plot_arrays, fname, title):
+        """Renders and saves the forward model of an observation from gen_spectral_model_plot.
+
+        Args:
+            plot_arrays (dict): The arrays from gen_spectral_model_plot.
+            fname (str): The full path of the figure.
+            title (str): The title.
+        """
+        
+        # Figure dims for 1 chunk
+        fig_width, fig_height = 2000, 720
+        dpi = 200
+        figsize = int(fig_width / dpi), int(fig_height / dpi)
+        
+        # Create subplot
+        fig = plt.figure(figsize=figsize, dpi=dpi)
+        
+        # Aliases
+        wave_data_nm = plot_arrays["wave_data_nm"]
+        residuals = plot_arrays["residuals"]
+        flagged_inds = plot_arrays["flagged_inds"]
+        
+        # Data
+        plt.plot(wave_data_nm, plot_arrays["flux"], color=(0, 114/255, 189/255), lw=0.8, label="Data")
+        
+        # Model
+        plt.plot(wave_data_nm, plot_arrays["model"], color=(217/255, 83/255, 25/255), lw=0.8, label="Model")
+        
+        # Zero line and -0.1 line
+        plt.plot(wave_data_nm, np.zeros_like(wave_data_nm), color=(89/255, 23/255, 130/255), lw=0.8, linestyle=':')
+        plt.plot(wave_data_nm, np.zeros_like(wave_data_nm) - 0.2, color=(89/255, 23/255, 130/255), lw=0.8, linestyle=':')
+        
+        # Residuals and worst pixels which were flagged
+        plt.plot(wave_data_nm, residuals, color=(255/255, 169/255, 22/255), lw=0.8, label="Residuals")
+        plt.plot(wave_data_nm[flagged_inds], residuals[flagged_inds], color="maroon", alpha=0.8, marker='X', markersize=4, lw=0)
+        
+        # Star
+        if "star_initial" in plot_arrays:
+            plt.plot(wave_data_nm, plot_arrays["star_initial"] - 1.2, label='Initial Star', lw=0.8, color='aqua', alpha=0.5)
+        if "star" in plot_arrays:
+            plt.plot(wave_data_nm, plot_arrays["star"] - 1.2, label='Current Star', lw=0.8, color='deeppink', alpha=0.8)
+        
+        # Tellurics
+        if "tellurics" in plot_arrays:
+            plt.plot(wave_data_nm, plot_arrays["tellurics"] - 1.2, label='Tellurics', lw=0.8, color='indigo', alpha=0.2)
+        
+        # Gas Cell
+        if "gas_cell" in plot_arrays:
+            plt.plot(wave_data_nm, plot_arrays["gas_cell"] - 1.2, label='Gas Cell', lw=0.8, color='green', alpha=0.2)
         
         # X and Y limits
-        plt.xlim(spectral_model.sregion.wavemin / 10 - pad, spectral_model.sregion.wavemax / 10 + pad)
+        plt.xlim(*plot_arrays["xlim"])
         plt.ylim(-1.2, 1.1)
             
         # The legend for each chunk
@@ -479,17 +833,14 @@ class IterativeSpectralRVProb(OptProblem):
         plt.ylabel("Norm. flux", fontsize=10)
         
         # The title of each chunk
-        plt.title(f"{star_name.replace('_', ' ')}, Order {data.order_num}, Iteration {iter_index + 1}", fontsize=10)
+        plt.title(title, fontsize=10)
         
         # Tight layout
         plt.tight_layout()
         
         # Save figure
-        fname = f"{output_path}Order{data.order_num}{os.sep}ForwardModels{os.sep}{tag}_data_model_spec{data.spec_num}_ord{data.order_num}_iter{iter_index + 1}.png"
         fig.savefig(fname)
         plt.close()
-            
-        return fig
     
     ###########################
     #### Radial Velocities ####
@@ -506,40 +857,49 @@ class IterativeSpectralRVProb(OptProblem):
         
         print("Cross Correlating Spectra ... ", flush=True)
 
+        # All observations of all chunks
+        tasks = [(ichunk, ispec) for ichunk in range(self.n_chunks) for ispec in range(self.n_spec)]
+        p0s = [self.chunks[ichunk].opt_results[ispec, iter_index]["pbest"] for ichunk, ispec in tasks]
+
         # Perform xcorr in series or parallel
         if self.n_cores > 1:
-            
-            p0s = []
-            for ispec in range(self.n_spec):
-                p0s.append(self.opt_results[ispec, iter_index]["pbest"])
 
             # Run in parallel
-            ccf_results = Parallel(n_jobs=self.n_cores, verbose=0, batch_size=1)(delayed(self.cross_correlate_observation)(p0s[ispec], self.data[ispec], self.spectral_model, iter_index) for ispec in range(self.n_spec))
-            
-            for ispec in range(self.n_spec):
-                if np.isfinite(ccf_results[ispec][0]):
-                    self.rvs_dict['rvsxc'][ispec, iter_index] = ccf_results[ispec][0]
-                    self.rvs_dict['uncxc'][ispec, iter_index] = ccf_results[ispec][1]
-                    self.rvs_dict['bis'][ispec, iter_index] = ccf_results[ispec][2]
-                    self.rvs_dict['xcorrs'][ispec, iter_index] = np.array([ccf_results[ispec][3], ccf_results[ispec][4]]).T
-                else:
-                    self.data[ispec].is_good = False
+            ccf_results = Parallel(n_jobs=self.n_cores, verbose=0, batch_size=1)(delayed(self.cross_correlate_observation)(p0s[i], self.chunks[ichunk].data[ispec], self.chunks[ichunk].spectral_model, iter_index) for i, (ichunk, ispec) in enumerate(tasks))
             
         else:
             
             # Run in series
-            for ispec in range(self.n_spec):
-                
-                p0 = self.opt_results[ispec, iter_index]["pbest"]
-                    
-                ccf_results = self.cross_correlate_observation(p0, self.data[ispec], self.spectral_model, iter_index)
-                if np.isfinite(ccf_results[0]):
-                    self.rvs_dict['rvsxc'][ispec, iter_index] = ccf_results[0]
-                    self.rvs_dict['uncxc'][ispec, iter_index] = ccf_results[1]
-                    self.rvs_dict['bis'][ispec, iter_index] = ccf_results[2]
-                    self.rvs_dict['xcorrs'][ispec, iter_index] = np.array([ccf_results[3], ccf_results[4]]).T
-                else:
-                    self.data[ispec].is_good = False
+            ccf_results = [self.cross_correlate_observation(p0s[i], self.chunks[ichunk].data[ispec], self.chunks[ichunk].spectral_model, iter_index) for i, (ichunk, ispec) in enumerate(tasks)]
+        
+        # Unpack
+        rvsxc = np.full((self.n_spec, self.n_chunks), np.nan)
+        uncxc = np.full((self.n_spec, self.n_chunks), np.nan)
+        bis = np.full((self.n_spec, self.n_chunks), np.nan)
+        xcorrs = np.empty((self.n_spec, self.n_chunks), dtype=np.ndarray)
+        for i, (ichunk, ispec) in enumerate(tasks):
+            if np.isfinite(ccf_results[i][0]):
+                rvsxc[ispec, ichunk] = ccf_results[i][0]
+                uncxc[ispec, ichunk] = ccf_results[i][1]
+                bis[ispec, ichunk] = ccf_results[i][2]
+                xcorrs[ispec, ichunk] = np.array([ccf_results[i][3], ccf_results[i][4]]).T
+            else:
+                self.chunks[ichunk].data[ispec].is_good = False
+        
+        # Combine the chunks
+        if self.n_chunks == 1:
+            self.rvs_dict['rvsxc'][:, iter_index] = rvsxc[:, 0]
+            self.rvs_dict['uncxc'][:, iter_index] = uncxc[:, 0]
+            self.rvs_dict['bis'][:, iter_index] = bis[:, 0]
+            self.rvs_dict['xcorrs'][:, iter_index] = xcorrs[:, 0]
+        else:
+            self.rvs_dict['rvsxc_chunks'][:, :, iter_index] = rvsxc
+            self.rvs_dict['uncxc_chunks'][:, :, iter_index] = uncxc
+            self.rvs_dict['bis_chunks'][:, :, iter_index] = bis
+            self.rvs_dict['xcorrs_chunks'][:, :, iter_index] = xcorrs
+            weights = self.gen_chunk_weights(iter_index)
+            self.rvs_dict['rvsxc'][:, iter_index], self.rvs_dict['uncxc'][:, iter_index] = pcrvcalc.combine_chunk_rvs(rvsxc, weights)
+            self.rvs_dict['bis'][:, iter_index], _ = pcrvcalc.combine_chunk_rvs(bis, weights)
                 
         print('Cross Correlation Finished in ' + str(round((stopwatch.time_since())/60, 3)) + ' min ', flush=True)
     
@@ -661,11 +1021,14 @@ class IterativeSpectralRVProb(OptProblem):
     
     def augment_templates(self, iter_index):
         
-        # Augment the templates
-        self.augmenter.augment_templates(self, iter_index)
+        # Each chunk has its own templates
+        for chunk in self.chunks:
         
-        # Stellar template
-        self.stellar_templates[iter_index + 1] = np.copy(self.spectral_model.templates_dict["star"])
+            # Augment the templates
+            self.augmenter.augment_templates(chunk, iter_index)
+            
+            # Stellar template
+            chunk.stellar_templates[iter_index + 1] = np.copy(chunk.spectral_model.templates_dict["star"])
     
 
     ###############
@@ -741,8 +1104,264 @@ class IterativeSpectralRVProb(OptProblem):
         # Save in a .npz file for easy access later
         np.savez(fname, **self.rvs_dict)
     
+    def save_results(self):
+        """Saves the parameters, fit metrics, RVs, CCFs, and templates as individual arrays which can be read without unpickling the problem, see spectral_results.write_results and spectral_results.SpectralRVResults.
+        """
+        write_results(self, f"{self.output_path}Order{self.order_num}{os.sep}{self.tag}_results_ord{self.order_num}{os.sep}")
+    
     def save_to_pickle(self):
         fname = f"{self.output_path}Order{self.order_num}{os.sep}{self.tag}_spectralrvprob_ord{self.order_num}.pkl"
         with open(fname, 'wb') as f:
             pickle.dump(self, f)
-    
\ No newline at end of file
+    
+    ####################
+    #### CHECKPOINT ####
+    ####################
+    
+    @property
+    def checkpoint_fname(self):
+        return f"{self.output_path}Order{self.order_num}{os.sep}{self.tag}_checkpoint_ord{self.order_num}.pkl"
+    
+    def stage_completed(self, iter_index, stage):
+        """Whether or not a stage of an iteration was completed according to the last checkpoint.
+
+        Args:
+            iter_index (int): The iteration index.
+            stage (str): The stage, one of "fit", "ccf", or "augment".
+
+        Returns:
+            bool: True if the stage was completed.
+        """
+        return self.progress is not None and (iter_index, self.stages.index(stage)) <= self.progress
+    
+    def save_checkpoint(self, iter_index=None, stage=None):
+        """Saves the state needed to resume compute_rvs_for_target: the fit results, stellar templates, and good data flags of each chunk, the RVs, and the last completed stage. The file is replaced atomically.
+
+        Args:
+            iter_index (int, optional): The iteration index of the completed stage. Defaults to None (the last completed stage is unchanged).
+            stage (str, optional): The completed stage, one of "fit", "ccf", or "augment". Defaults to None.
+        """
+        if stage is not None:
+            self.progress = (iter_index, self.stages.index(stage))
+        checkpoint = {}
+        checkpoint["progress"] = self.progress
+        checkpoint["opt_results"] = self.opt_results
+        checkpoint["rvs_dict"] = self.rvs_dict
+        checkpoint["chunks"] = [dict(opt_results=chunk.opt_results, stellar_templates=chunk.stellar_templates, is_good=[data.is_good for data in chunk.data]) for chunk in self.chunks]
+        fname = self.checkpoint_fname
+        with open(fname + ".tmp", 'wb') as f:
+            pickle.dump(checkpoint, f)
+        os.replace(fname + ".tmp", fname)
+        
+    def load_checkpoint(self):
+        """Restores the state from the checkpoint of a previous run of the same problem, see save_checkpoint. The stellar template of each chunk is set to the most recently augmented template.
+        """
+        fname = self.checkpoint_fname
+        if not os.path.exists(fname):
+            print(f"No checkpoint found at {fname}, starting from the beginning", flush=True)
+            return
+        with open(fname, 'rb') as f:
+            checkpoint = pickle.load(f)
+        if len(checkpoint["chunks"]) != self.n_chunks or checkpoint["opt_results"].shape != self.opt_results.shape:
+            raise ValueError(f"The checkpoint {fname} does not match this problem")
+        self.progress = checkpoint["progress"]
+        self.opt_results = checkpoint["opt_results"]
+        self.rvs_dict = checkpoint["rvs_dict"]
+        for chunk, chunk_checkpoint in zip(self.chunks, checkpoint["chunks"]):
+            chunk.opt_results = chunk_checkpoint["opt_results"]
+            chunk.stellar_templates = chunk_checkpoint["stellar_templates"]
+            for data, is_good in zip(chunk.data, chunk_checkpoint["is_good"]):
+                data.is_good = is_good
+            for iter_index in range(self.n_iterations - 1, -1, -1):
+                if chunk.stellar_templates[iter_index] is not None:
+                    chunk.spectral_model.templates_dict["star"] = np.copy(chunk.stellar_templates[iter_index])
+                    break
+        if self.progress is None:
+            print(f"Resuming from checkpoint {fname} (no completed stages)", flush=True)
+        else:
+            print(f"Resuming from checkpoint {fname} (completed {self.stages[self.progress[1]]} of iteration {self.progress[0] + 1})", flush=True)
+    
+
+#####################
+#### WORKER POOL ####
+#####################
+
+# The state of a FitWorkerPool worker process, set once by _init_fit_worker
+_fit_worker_state = None
+
+def _init_fit_worker(state):
+    global _fit_worker_state
+    _fit_worker_state = state
+    _fit_worker_state["iter_index"] = None
+
+def _fit_worker_task(ichunk, ispec, iter_index, p0):
+    state = _fit_worker_state
+    
+    # Load the templates of a new iteration, memory mapped and copy on write
+    if state["iter_index"] != iter_index:
+        with open(f"{state['template_path']}manifest_iter{iter_index + 1}.json", 'r') as f:
+            manifest = json.load(f)
+        for jchunk, fnames in enumerate(manifest):
+            for key, fname in fnames.items():
+                state["spectral_models"][jchunk].templates_dict[key] = np.load(fname, mmap_mode='c')
+        state["iter_index"] = iter_index
+    
+    # Fit
+    return IterativeSpectralRVProb.optimize_observation(p0, state["data"][ichunk][ispec], state["spectral_models"][ichunk], state["obj"], state["optimizer"], iter_index, state["verbose"])
+
+def _init_plot_worker():
+    
+    # Render at a lower priority than the fits
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+class FitWorkerPool:
+    """A pool of worker processes for fitting the observations of an IterativeSpectralRVProb. The spectral model (without its templates), data, objective, and optimizer of each chunk are shipped to each worker once when the pool starts. The templates are written to .npy files once per iteration (only those which changed) and memory mapped by the workers, so each fit only sends the chunk and spectrum indices, the iteration index, and the initial parameters.
+    """
+    
+    def __init__(self, specrvprob):
+        """Start the workers.
+
+        Args:
+            specrvprob (IterativeSpectralRVProb): The problem, with n_cores workers.
+        """
+        self.specrvprob = specrvprob
+        self.template_path = tempfile.mkdtemp(prefix=f"{specrvprob.tag}_templates_") + os.sep
+        self.template_fnames = [{} for _ in specrvprob.chunks]
+        
+        # Everything but the templates, which change between iterations
+        spectral_models = [IterativeSpectralRVProb.copy_spectral_model(chunk, templates=False) for chunk in specrvprob.chunks]
+        state = dict(spectral_models=spectral_models, data=[chunk.data for chunk in specrvprob.chunks],
+                     obj=specrvprob.obj, optimizer=specrvprob.optimizer, verbose=specrvprob.verbose,
+                     template_path=self.template_path)
+        self.executor = ProcessPoolExecutor(max_workers=specrvprob.n_cores, initializer=_init_fit_worker, initargs=(state,))
+        
+    def sync_templates(self, iter_index):
+        """Writes the templates which changed since the last iteration and the list of template files for this iteration.
+
+        Args:
+            iter_index (int): The iteration index.
+        """
+        manifest = []
+        for ichunk, chunk in enumerate(self.specrvprob.chunks):
+            for key, template in chunk.spectral_model.templates_dict.items():
+                fname = self.template_fnames[ichunk].get(key)
+                if fname is None or not np.array_equal(np.load(fname, mmap_mode='r'), template):
+                    fname = f"{self.template_path}chunk{ichunk + 1}_{key}_iter{iter_index + 1}.npy"
+                    np.save(fname, template)
+                    self.template_fnames[ichunk][key] = fname
+            manifest.append(dict(self.template_fnames[ichunk]))
+        with open(f"{self.template_path}manifest_iter{iter_index + 1}.json", 'w') as f:
+            f.write(json.dumps(manifest))
+            
+    def map(self, tasks, p0s, iter_index):
+        """Fits observations with the workers. Observations which are not good are handled in this process.
+
+        Args:
+            tasks (list): The (chunk index, spectrum index) of each fit.
+            p0s (list): The initial parameters of each fit.
+            iter_index (int): The iteration index.
+
+        Returns:
+            list: The optimize results in the order of tasks.
+        """
+        futures = []
+        for (ichunk, ispec), p0 in zip(tasks, p0s):
+            if self.specrvprob.chunks[ichunk].data[ispec].is_good:
+                futures.append(self.executor.submit(_fit_worker_task, ichunk, ispec, iter_index, p0))
+            else:
+                futures.append(None)
+        opt_results = []
+        for (ichunk, ispec), p0, future in zip(tasks, p0s, futures):
+            if future is None:
+                opt_results.append(dict(pbest=p0.gen_nan_pars(), fbest=np.nan, fcalls=np.nan, walltime=np.nan))
+            else:
+                opt_results.append(future.result())
+        return opt_results
+    
+    def shutdown(self):
+        """Stops the workers and removes the template files.
+        """
+        self.executor.shutdown()
+        shutil.rmtree(self.template_path, ignore_errors=True)
+
+
+################
+#### CHUNKS ####
+################
+
+class SpectralRVChunk:
+    """A sub-order chunk of an IterativeSpectralRVProb. Each chunk is fit independently with its own copy of the spectral model, and therefore its own templates and parameters. The data of a chunk is cropped outside its spectral region. Chunks provide the same attributes as IterativeSpectralRVProb used to fit the observations and augment the templates.
+    """
+    
+    def __init__(self, specrvprob, sregion, tag):
+        """Initiate a chunk.
+
+        Args:
+            specrvprob (IterativeSpectralRVProb): The parent problem.
+            sregion (SpectralRegion): The region of the order (detector pixels) for this chunk.
+            tag (str): The tag for the outputs of this chunk.
+        """
+        
+        # The parent problem
+        self.specrvprob = specrvprob
+        
+        # The region and tag
+        self.sregion = sregion
+        self.tag = tag
+        
+        # The data cropped to this region
+        self.data = [self.crop_data(data, sregion) for data in specrvprob.data]
+        
+        # The spectral model restricted to this region
+        self.spectral_model = copy.deepcopy(specrvprob.spectral_model)
+        self.spectral_model._init_templates(self.data)
+        self.spectral_model._init_parameters(self.data)
+        
+        # Optimize results
+        self.opt_results = np.empty(shape=(self.n_spec, self.n_iterations), dtype=dict)
+        self.stellar_templates = np.empty(self.n_iterations, dtype=np.ndarray)
+        if self.spectral_model.star is not None and not self.spectral_model.star.from_flat:
+            self.stellar_templates[0] = np.copy(self.spectral_model.templates_dict["star"])
+    
+    @staticmethod
+    def crop_data(data, sregion):
+        """Shallow copies an observation with the flux masked outside of a region.
+
+        Args:
+            data (SpecData1d): The observation.
+            sregion (SpectralRegion): The region to keep.
+
+        Returns:
+            SpecData1d: The cropped observation.
+        """
+        data_chunk = copy.copy(data)
+        data_chunk.flux = np.copy(data.flux)
+        data_chunk.flux_unc = np.copy(data.flux_unc)
+        data_chunk.mask = np.copy(data.mask)
+        bad = np.where((np.arange(len(data.flux)) < sregion.pixmin) | (np.arange(len(data.flux)) > sregion.pixmax))[0]
+        data_chunk.flux[bad] = np.nan
+        data_chunk.flux_unc[bad] = np.nan
+        data_chunk.mask[bad] = 0
+        return data_chunk
+    
+    @property
+    def p0(self):
+        return self.spectral_model.p0
+    
+    @property
+    def n_spec(self):
+        return len(self.data)
+    
+    @property
+    def n_nights(self):
+        return self.specrvprob.n_nights
+    
+    @property
+    def n_iterations(self):
+        return self.spectral_model.n_iterations
+    
+    def __repr__(self):
+        return f"Chunk {self.sregion.label}: {self.sregion}"
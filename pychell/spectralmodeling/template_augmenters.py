@@ -172,7 +172,6 @@ class WeightedMedian(TemplateAugmenter):
 
         # Storage arrays
         nx  = len(current_stellar_template[:, 0])
-        residuals_median = np.zeros(nx)
         residuals = np.zeros(shape=(nx, specrvprob.n_spec), dtype=float)
         weights = np.zeros(shape=(nx, specrvprob.n_spec), dtype=float)
 
@@ -224,18 +223,13 @@ class WeightedMedian(TemplateAugmenter):
         # 1. If all weights at a given pixel are zero, set median value to zero.
         # 2. If there's more than one spectrum, compute the weighted median
         # 3. If there's only one spectrum, use those residuals, unless it's nan.
-        for ix in range(nx):
-            ww, rr = weights[ix, :], residuals[ix, :]
-            if np.nansum(ww) == 0:
-                residuals_median[ix] = 0
-            else:
-                good = np.where((ww > 0) & np.isfinite(ww))[0]
-                if good.size == 0:
-                    residuals_median[ix] = 0
-                elif good.size == 1:
-                    residuals_median[ix] = rr[good[0]]
-                else:
-                    residuals_median[ix] = pcmath.weighted_median(rr, weights=ww)
+        good = (weights > 0) & np.isfinite(weights)
+        n_good = np.sum(good, axis=1)
+        residuals_median = pcmath.weighted_percentile(residuals, weights, q=0.5, axis=1)
+        single = np.where(n_good == 1)[0]
+        if single.size > 0:
+            residuals_median[single] = residuals[single, np.argmax(good[single, :], axis=1)]
+        residuals_median[(np.nansum(weights, axis=1) == 0) | (n_good == 0)] = 0
 
         # Change any nans to zero just in case
         bad = np.where(~np.isfinite(residuals_median))[0]
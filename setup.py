@@ -20,7 +20,7 @@ setuptools.setup(
     description="Toolkit from raw echelle spectra through orbit fitting.",
     long_description=long_description,
     long_description_content_type="text/x-rst",
-    packages = setuptools.find_packages(),
+    packages = setuptools.find_packages(exclude=["tests", "tests.*"]),
     include_package_data=True,
     install_requires=install_requires,
     url="https://github.com/astrobc1/pychell",
@@ -0,0 +1,326 @@
+# Base Python
+import copy
+
+# Maths
+import numpy as np
+import scipy.interpolate
+
+# Pychell deps
+import pychell.maths as pcmath
+import pychell.utils as pcutils
+import pychell.spectralmodeling.rvcalc as pcrvcalc
+
+# The previous implementations which the tests compare against, copied from the code they were replaced by.
+# Functions with bugs which make a comparison meaningless are also given with only those bugs fixed (marked "Fixed").
+
+###############
+#### MATHS ####
+###############
+
+def weighted_median_baseline(data, weights=None, percentile=0.5):
+    if weights is None:
+        weights = np.ones(shape=data.shape, dtype=np.float64)
+    bad = np.where(~np.isfinite(data))
+    if bad[0].size == data.size:
+        return np.nan
+    if bad[0].size > 0:
+        weights[bad] = 0
+    data = data.flatten()
+    weights = weights.flatten()
+    inds = np.argsort(data)
+    data_s = data[inds]
+    weights_s = weights[inds]
+    percentile = percentile * np.nansum(weights)
+    if np.any(weights > percentile):
+        good = np.where(weights == np.nanmax(weights))[0][0]
+        w_median = data[good]
+    else:
+        cs_weights = np.nancumsum(weights_s)
+        idx = np.where(cs_weights <= percentile)[0][-1]
+        if weights_s[idx] == percentile:
+            w_median = np.nanmean(data_s[idx:idx+2])
+        else:
+            w_median = data_s[idx+1]
+    return w_median
+
+def weighted_mean_baseline(x, w):
+    return np.nansum(x * w) / np.nansum(w)
+
+def weighted_stddev_baseline(x, w):
+    weights = w / np.nansum(w)
+    wm = weighted_mean_baseline(x, w)
+    dev = x - wm
+    bias_estimator = 1.0 - np.nansum(weights ** 2) / np.nansum(weights) ** 2
+    var = np.nansum(dev ** 2 * weights) / bias_estimator
+    return np.sqrt(var)
+
+def rolling_clip_baseline(x, y, weights=None, width=None, method='median', n_sigma=3):
+
+    # Mask must be the length of x
+    mask = np.ones_like(x)
+
+    # Create a mask and weights
+    if weights is None:
+        weights = np.ones_like(x)
+    good = np.where(np.isfinite(x) & np.isfinite(y) & np.isfinite(weights) & (weights >= 0))[0]
+    n_good = len(good)
+    xx, yy, ww = x[good], y[good], weights[good]
+
+    # Start and last x value
+    x_start = np.nanmin(x)
+    x_end = np.nanmax(x)
+    delta_x = x_start - x_end
+
+    # Want n_per_bin ~ 10
+    if width is None:
+        n_per_bin = 10
+        width = n_per_bin * delta_x / n_good
+
+    # Bins
+    n_bins = int(delta_x / width)
+    bins = np.linspace(x_end - width / 1000, x_start + width / 1000, num=n_bins + 1)
+
+    # Loop over bins and flag
+    for i in range(len(bins) - 1):
+        use = np.where((xx >= bins[i]) & (xx <= bins[i+1]))[0]
+        if use.size >= n_per_bin / 2:
+            if method == 'median':
+                wmed = weighted_median_baseline(yy[use], weights=ww[use], percentile=0.5)
+                wavg = wmed
+                meddev = weighted_median_baseline(yy[use] - wmed, weights=ww[use], percentile=0.5)
+                wstddev = meddev * 1.4826
+            else:
+                wavg = weighted_mean_baseline(yy[use], ww[use])
+                wstddev = weighted_stddev_baseline(yy[use], ww[use])
+
+            bad = np.where(np.abs(yy[use] - wavg) > n_sigma * wstddev)[0]
+            if bad.size > 0:
+                mask[use[bad]] = 0
+
+    return mask
+
+def rolling_clip_baseline_fixed(x, y, weights=None, width=None, method='median', n_sigma=3):
+
+    # Mask must be the length of x
+    mask = np.ones_like(x)
+
+    # Create a mask and weights
+    if weights is None:
+        weights = np.ones_like(x)
+    good = np.where(np.isfinite(x) & np.isfinite(y) & np.isfinite(weights) & (weights >= 0))[0]
+    n_good = len(good)
+    xx, yy, ww = x[good], y[good], weights[good]
+
+    # Start and last x value
+    x_start = np.nanmin(x)
+    x_end = np.nanmax(x)
+    delta_x = x_end - x_start # Fixed: was x_start - x_end
+
+    # Want n_per_bin ~ 10
+    n_per_bin = 10 # Fixed: was undefined if width is given
+    if width is None:
+        width = n_per_bin * delta_x / n_good
+
+    # Bins
+    n_bins = int(delta_x / width)
+    bins = np.linspace(x_start - width / 1000, x_end + width / 1000, num=n_bins + 1) # Fixed: was reversed
+
+    # Loop over bins and flag
+    for i in range(len(bins) - 1):
+        use = np.where((xx >= bins[i]) & (xx <= bins[i+1]))[0]
+        if use.size >= n_per_bin / 2:
+            if method == 'median':
+                wmed = weighted_median_baseline(yy[use], weights=ww[use], percentile=0.5)
+                wavg = wmed
+                meddev = weighted_median_baseline(np.abs(yy[use] - wmed), weights=ww[use], percentile=0.5) # Fixed: was signed
+                wstddev = meddev * 1.4826
+            else:
+                wavg = weighted_mean_baseline(yy[use], ww[use])
+                wstddev = weighted_stddev_baseline(yy[use], ww[use])
+
+            bad = np.where(np.abs(yy[use] - wavg) > n_sigma * wstddev)[0]
+            if bad.size > 0:
+                mask[good[use[bad]]] = 0 # Fixed: was indexed into the good points
+
+    return mask
+
+def rolling_fun_true_window_baseline(f, x, y, w):
+    output = np.empty(x.size, dtype=np.float64)
+
+    for i in range(output.size):
+        locs = np.where((x > x[i] - w/2) & (x <= x[i] + w/2))
+        if len(locs) == 0:
+            output[i] = np.nan
+        else:
+            output[i] = f(y[locs])
+
+    return output
+
+def convolve_flux_baseline(flux, lsf):
+
+    # Get good initial points
+    good = np.where(np.isfinite(flux))[0]
+    fluxlin = flux[good]
+    nlsf = lsf.size
+
+    # Ensure the lsf size is odd
+    assert lsf.size % 2 == 1
+
+    # Pad
+    fluxlinp = np.pad(fluxlin, pad_width=(int(nlsf / 2), int(nlsf / 2)), mode='constant', constant_values=(fluxlin[0], fluxlin[-1]))
+
+    # Convolve
+    fluxlinc = np.convolve(fluxlinp, lsf, mode='valid')
+
+    # Interpolate back to the default grid
+    if flux.size > fluxlinc.size:
+        fluxc = np.full(flux.size, fill_value=np.nan)
+        fluxc[good] = fluxlinc
+    else:
+        fluxc = fluxlinc
+
+    return fluxc
+
+def cspline_interp_baseline(x, y, xnew):
+    good = np.where(np.isfinite(x) & np.isfinite(y))[0]
+    return scipy.interpolate.CubicSpline(x[good], y[good], extrapolate=False)(xnew)
+
+def doppler_shift_baseline(wave, vel, wave_out=None, flux=None, interp='cspline', kind='exp'):
+
+    if wave_out is None:
+        wave_out = wave
+
+    if kind == 'exp':
+        wave_shifted = pcmath._dop_shift_exponential(wave, vel)
+    else:
+        wave_shifted = pcmath._dop_shift_SR(wave, vel)
+
+    if interp is None and flux is None:
+        return wave_shifted
+    good = np.where(np.isfinite(wave_shifted) & np.isfinite(flux))[0]
+    if interp == 'cspline':
+        flux_out = cspline_interp_baseline(wave_shifted, flux, wave_out)
+    elif interp == 'akima':
+        flux_out = scipy.interpolate.Akima1DInterpolator(wave_shifted[good], flux[good])(wave_out)
+    elif interp == 'pchip':
+        flux_out = scipy.interpolate.PchipInterpolator(wave_shifted[good], flux[good], extrapolate=False)(wave_out)
+    else:
+        flux_out = np.interp(wave_out, wave_shifted[good], flux[good], left=np.nan, right=np.nan)
+    return flux_out
+
+################
+#### RVCALC ####
+################
+
+def combine_rvs_weighted_mean_baseline(rvs, weights, n_obs_nights):
+    """Combines RVs considering the differences between all the data points.
+
+    Args:
+        rvs (np.ndarray): RVs of shape n_orders, n_obs, n_chunks
+        weights (np.ndarray): Corresponding uncertainties of the same shape.
+    """
+
+    # Numbers
+    n_orders, n_obs, n_chunks = rvs.shape
+    n_nights = len(n_obs_nights)
+
+    # Rephrase problem as n_quasi_orders = n_orders * n_chunks
+    n_tot_chunks = n_orders * n_chunks
+
+    # Output arrays
+    rvs_single_out = np.full(n_obs, fill_value=np.nan)
+    unc_single_out = np.full(n_obs, fill_value=np.nan)
+    rvs_nightly_out = np.full(n_nights, fill_value=np.nan)
+    unc_nightly_out = np.full(n_nights, fill_value=np.nan)
+
+    # Offset each order and chunk
+    rvs_offset = np.copy(rvs)
+    for o in range(n_orders):
+        for ichunk in range(n_chunks):
+            rvs_offset[o, :, ichunk] = rvs[o, :, ichunk] - pcmath.weighted_mean(rvs[o, :, ichunk], weights[o, :, ichunk])
+
+    for i in range(n_obs):
+        rr = rvs_offset[:, i, :].flatten()
+        ww = weights[:, i, :].flatten()
+        rvs_single_out[i], rvs_single_out[i] = pcmath.weighted_combine(rr, ww)
+
+    for i, f, l in pcutils.nightly_iteration(n_obs_nights):
+        rr = rvs_offset[:, f:l, :].flatten()
+        ww = weights[:, f:l, :].flatten()
+        rvs_nightly_out[i], unc_nightly_out[i] = pcmath.weighted_combine(rr, ww)
+
+    rvs_out = {"rvs": rvs_single_out, "unc": unc_single_out, "rvs_nightly": rvs_nightly_out, "unc_nightly" : unc_nightly_out}
+
+    return rvs_out
+
+#########################
+#### POST PROCESSING ####
+#########################
+
+def compute_rv_contents_baseline(specrvprobs, templates=None):
+
+    # The post processing needs the dependencies of the spectral models, so it is only imported by the tests which use it
+    import pychell.spectralmodeling.post_playground as pcpost
+
+    if templates is None:
+        templates = ["star"]
+
+    # Numbers
+    n_orders = len(specrvprobs)
+    n_spec = specrvprobs[0].n_spec
+    n_iterations = specrvprobs[0].n_iterations
+
+    # The RV contents, for each iteration (lower is "better")
+    rvcs = np.zeros((n_orders, n_iterations))
+
+    # The nightly S/N, for each iteration
+    nightly_snrs = pcpost.compute_nightly_snrs(specrvprobs)
+
+    # Compute RVC for each order and iteration
+    for o in range(n_orders):
+
+        # Original templates
+        templates_dictcp = copy.deepcopy(specrvprobs[o].spectral_model.templates_dict)
+
+        # Compute RVC for this iteration
+        for j in range(n_iterations):
+
+            # Use parameters for the first osbervation - Doesn't so much matter here.
+            pars = specrvprobs[o].opt_results[0, j]['pbest']
+
+            # Set the star in the templates dict
+            specrvprobs[o].spectral_model.templates_dict["star"] = np.copy(specrvprobs[o].stellar_templates[j])
+
+            # Alias the model wave grid
+            model_wave = specrvprobs[o].spectral_model.model_wave
+
+            # Data wave grid
+            data_wave = specrvprobs[o].spectral_model.wavelength_solution.build(pars)
+
+            # LSF
+            if specrvprobs[o].spectral_model.lsf is not None:
+                lsf = specrvprobs[o].spectral_model.lsf.build(pars)
+
+            # RV Content for each template individually
+            rvcs_per_template = np.zeros(len(templates))
+
+            # Loop over templates
+            for i, template_key in enumerate(templates):
+
+                # Build the high res template
+                template_flux = getattr(specrvprobs[o].spectral_model, template_key).build(pars, specrvprobs[o].spectral_model.templates_dict[template_key], model_wave)
+
+                # The S/N for this observation
+                snr = np.nanmedian(nightly_snrs[o, :, j])
+
+                # Compute content for this template
+                _, rvcs_per_template[i] = pcrvcalc.compute_rv_content(model_wave, template_flux, snr=snr, blaze=True, ron=0, wave_to_sample=data_wave)
+
+            # Add in quadrature
+            rvcs[o, j] = np.sqrt(np.nansum(rvcs_per_template**2))
+
+        # Reset templates dict
+        specrvprobs[o].spectral_model.templates_dict = templates_dictcp
+
+    # Return
+    return rvcs
@@ -0,0 +1,19 @@
+# Base Python
+import os
+
+# Testing
+import pytest
+
+@pytest.fixture
+def templates_path(tmp_path):
+    """Writes the synthetic stellar, gas cell, and TAPAS templates to the temporary directory of the test, see tests.synthetic_spectra.
+
+    Returns:
+        str: The path to the templates, ending in a separator.
+    """
+    
+    # The synthetic spectra need the dependencies of the spectral models, so they are only imported by the tests which use them
+    from tests.synthetic_spectra import write_templates
+    templates_path = str(tmp_path) + os.sep
+    write_templates(templates_path, tellurics=True)
+    return templates_path
@@ -0,0 +1,125 @@
+# Maths
+import numpy as np
+
+# Pychell deps
+import pychell.spectralmodeling.spectralmodels as pcsm
+from pychell.data.parser import DataParser
+from pychell.data.spectraldata import SpecData1d
+
+# Synthetic templates, spectra, and forward models shared by the tests. The templates are written by the
+# templates_path fixture (see conftest.py), the spectra and models are generated from its path, e.g.:
+# from tests.synthetic_spectra import synthetic_data, synthetic_model
+
+# Wavelength range of the synthetic spectra in Angstroms
+wave_min, wave_max = 22000.0, 22300.0
+
+# Location tag of the synthetic TAPAS templates
+tellurics_tag = "synthetic"
+
+def absorption_lines(wave, n_lines, max_depth, seed):
+    """Generates a spectrum of random Gaussian absorption lines (in optical depth) spanning slightly more than the synthetic wavelength range.
+
+    Args:
+        wave (np.ndarray): The wavelength grid.
+        n_lines (int): The number of lines.
+        max_depth (float): The maximum optical depth of a single line.
+        seed (int): The seed for the line centers, depths, and widths.
+
+    Returns:
+        np.ndarray: The normalized flux.
+    """
+    r = np.random.default_rng(seed)
+    centers = r.uniform(wave_min - 30, wave_max + 30, n_lines)
+    depths = r.uniform(0, max_depth, n_lines)
+    sigmas = r.uniform(0.03, 0.1, n_lines)
+    tau = np.zeros_like(wave)
+    for c, d, s in zip(centers, depths, sigmas):
+        use = np.where(np.abs(wave - c) < 6 * s)[0]
+        tau[use] += d * np.exp(-0.5 * ((wave[use] - c) / s)**2)
+    return np.exp(-tau)
+
+def write_templates(templates_path, tellurics=False):
+    """Writes the synthetic stellar (star.csv) and gas cell (gas_cell.npz) templates, and optionally the six TAPAS species.
+
+    Args:
+        templates_path (str): The directory to write the templates to, ending in a separator.
+        tellurics (bool, optional): Whether or not to also write the TAPAS templates with the location tag tellurics_tag. Defaults to False.
+    """
+    wave_template = np.arange(wave_min - 40, wave_max + 40, 0.005)
+    np.savetxt(templates_path + "star.csv", np.array([wave_template, absorption_lines(wave_template, 600, 0.5, 1)]).T, delimiter=",")
+    np.savez(templates_path + "gas_cell.npz", wave=wave_template, flux=absorption_lines(wave_template, 300, 0.4, 2))
+    if tellurics:
+        for i, species in enumerate(pcsm.TelluricsTAPAS.species):
+            max_depth = 2.0 if species == "water" else 0.3
+            np.savez(f"{templates_path}telluric_{species}_tapas_{tellurics_tag}.npz", wave=wave_template, flux=absorption_lines(wave_template, 100, max_depth, 10 + i))
+
+class SyntheticParser(DataParser):
+    """Generates a flat spectrum with a linear wavelength grid in place of reading a file. The tests overwrite the flux with a model.
+    """
+
+    def __init__(self, data_input_path, nx=2048, snr=200):
+        """Construct a synthetic parser.
+
+        Args:
+            data_input_path (str): The path to the templates.
+            nx (int, optional): The number of detector pixels. Defaults to 2048.
+            snr (float, optional): The signal to noise ratio which sets the flux uncertainty. Defaults to 200.
+        """
+        super().__init__(data_input_path)
+        self.nx = nx
+        self.snr = snr
+
+    def parse_spec1d(self, data):
+        data.apriori_wave_grid = np.linspace(wave_min - 10, wave_max + 10, self.nx)
+        data.flux = np.ones(self.nx)
+        data.flux_unc = np.full(self.nx, 1 / self.snr)
+        data.mask = np.ones(self.nx)
+        data.bc_vel = 0
+
+def synthetic_data(templates_path, n_spec=1, nx=2048, snr=200):
+    """Generates flat synthetic spectra with 100 cropped pixels on each end.
+
+    Args:
+        templates_path (str): The path to the templates.
+        n_spec (int, optional): The number of spectra. Defaults to 1.
+        nx (int, optional): The number of detector pixels. Defaults to 2048.
+        snr (float, optional): The signal to noise ratio. Defaults to 200.
+
+    Returns:
+        list: The SpecData1d objects.
+    """
+    parser = SyntheticParser(templates_path, nx=nx, snr=snr)
+    return [SpecData1d(f"synthetic_{i + 1}.fits", order_num=1, spec_num=i + 1, parser=parser, crop_pix=[100, 100]) for i in range(n_spec)]
+
+def synthetic_model(templates_path, data, gas_cell="dynamic", tellurics=False, truncate_tol=None, **kwargs):
+    """Constructs the forward model of the tests (spline wavelength solution and continuum, Hermite LSF, augmented star, and a gas cell) with its templates and parameters initialized.
+
+    Args:
+        templates_path (str): The path to the templates.
+        data (list): The SpecData1d objects.
+        gas_cell (str, optional): "dynamic" for a DynamicGasCell, "perfect" for a PerfectGasCell, or None for no gas cell. Defaults to "dynamic".
+        tellurics (bool, optional): Whether or not to include TelluricsTAPAS, or a dict of keyword arguments for it. Defaults to False.
+        truncate_tol (float, optional): The truncate_tol of the HermiteLSF. Defaults to None.
+        kwargs: Any additional keyword arguments for IterativeSpectralForwardModel.
+
+    Returns:
+        IterativeSpectralForwardModel: The forward model.
+    """
+    if gas_cell == "dynamic":
+        gas_cell = pcsm.DynamicGasCell(input_file=templates_path + "gas_cell.npz", shift=[-0.1, 0.01, 0.1], depth=[0.5, 1, 1.5])
+    elif gas_cell == "perfect":
+        gas_cell = pcsm.PerfectGasCell(input_file=templates_path + "gas_cell.npz")
+    if tellurics:
+        tellurics = pcsm.TelluricsTAPAS(input_path=templates_path, location_tag=tellurics_tag, **(tellurics if type(tellurics) is dict else {}))
+    else:
+        tellurics = None
+    spectral_model = pcsm.IterativeSpectralForwardModel(wavelength_solution=pcsm.SplineWavelengthSolution(n_splines=6),
+                                                        continuum=pcsm.SplineContinuum(n_splines=6),
+                                                        lsf=pcsm.HermiteLSF(hermdeg=2, width=[0.05, 0.08, 0.12], hermcoeff=[-0.1, 0.01, 0.1], truncate_tol=truncate_tol),
+                                                        star=pcsm.AugmentedStar(input_file=templates_path + "star.csv"),
+                                                        gas_cell=gas_cell,
+                                                        tellurics=tellurics,
+                                                        **kwargs)
+    spectral_model._init_templates(data)
+    spectral_model._init_parameters(data)
+    return spectral_model
@@ -0,0 +1,244 @@
+# Maths
+import numpy as np
+
+# Testing
+import pytest
+
+# Pychell deps
+import pychell.maths as pcmath
+
+# Previous implementations
+from tests.baselines import (weighted_median_baseline, rolling_clip_baseline, rolling_clip_baseline_fixed, rolling_fun_true_window_baseline,
+                             convolve_flux_baseline, cspline_interp_baseline, doppler_shift_baseline)
+
+########################
+#### MEDIAN FILTERS ####
+########################
+
+def random_filter_data(rng, shape):
+    """Random data with repeated values, nans (isolated and in a run longer than the filter widths), and infs.
+    """
+    x = rng.normal(0, 1, shape)
+    ties = rng.random(shape) < 0.1
+    x[ties] = np.round(x[ties], 1)
+    x[rng.random(shape) < 0.1] = np.nan
+    x[rng.random(shape) < 0.01] = np.inf
+    x[rng.random(shape) < 0.01] = -np.inf
+    x.reshape(-1)[100:120] = np.nan
+    return x
+
+@pytest.mark.parametrize("median_filter, shape", [(pcmath.median_filter1d, 2048), (pcmath.median_filter2d, (96, 128))])
+@pytest.mark.parametrize("width", range(1, 12))
+def test_median_filter_sorted_matches_generic(median_filter, shape, width):
+    """The compiled running median agrees exactly with scipy's generic_filter and fmedian, with nans in the same places.
+    """
+    rng = np.random.default_rng(42 + width)
+    for _ in range(5):
+        x = random_filter_data(rng, shape)
+        for preserve_nans in [True, False]:
+            out_sorted = median_filter(x, width, preserve_nans=preserve_nans, method="sorted")
+            out_generic = median_filter(x, width, preserve_nans=preserve_nans, method="generic")
+            assert np.array_equal(out_sorted, out_generic, equal_nan=True)
+
+#################
+#### ROLLING ####
+#################
+
+def random_rolling_data(rng, n):
+    """Random data with outliers, repeated values, nans in x and y, masked pixels (zero and nan weights), and unsorted x.
+    """
+    x = rng.uniform(0, 100, n)
+    if rng.random() < 0.5:
+        x = np.sort(x)
+    y = rng.normal(0, 1, n)
+    outliers = rng.random(n) < 0.05
+    y[outliers] += rng.choice([-1, 1], outliers.sum()) * rng.uniform(5, 20, outliers.sum())
+    ties = rng.random(n) < 0.2
+    y[ties] = np.round(y[ties], 1)
+    weights = rng.uniform(0.5, 2, n)
+    weights[rng.random(n) < 0.1] = 0
+    weights[rng.random(n) < 0.02] = np.nan
+    y[rng.random(n) < 0.05] = np.nan
+    x[rng.random(n) < 0.02] = np.nan
+    return x, y, weights
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("method", ["median", "mean"])
+def test_rolling_clip_matches_fixed_baseline(method):
+    """rolling_clip flags the same points as the previous implementation with its bugs fixed. The previous implementation itself never flags anything.
+    """
+    rng = np.random.default_rng(7)
+    n_flagged = 0
+    for _ in range(100):
+        x, y, weights = random_rolling_data(rng, rng.integers(50, 2000))
+        width = None if rng.random() < 0.5 else rng.uniform(1, 10)
+        mask = pcmath.rolling_clip(x, y, weights=np.copy(weights), width=width, method=method)
+        mask_fixed = rolling_clip_baseline_fixed(x, y, weights=np.copy(weights), width=width, method=method)
+        assert np.array_equal(mask, mask_fixed)
+        if width is None:
+            assert np.all(rolling_clip_baseline(x, y, weights=np.copy(weights), method=method) == 1)
+        n_flagged += np.sum(mask == 0)
+    assert n_flagged > 0
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+@pytest.mark.parametrize("f, tol", [(np.median, 0), (np.nanmedian, 0), (np.nanmean, 1E-12), (np.nanstd, 1E-12)])
+def test_rolling_fun_true_window_matches_baseline(f, tol):
+    """rolling_fun_true_window agrees with the previous implementation, exactly for the medians, with nans in the same places.
+    """
+    rng = np.random.default_rng(8)
+    for _ in range(50):
+        x, y, _ = random_rolling_data(rng, rng.integers(50, 1000))
+        w = rng.uniform(0.5, 10)
+        out = pcmath.rolling_fun_true_window(f, x, y, w)
+        out_baseline = rolling_fun_true_window_baseline(f, x, y, w)
+        assert np.array_equal(np.isnan(out), np.isnan(out_baseline))
+        if np.any(np.isfinite(out)):
+            assert np.nanmax(np.abs(out - out_baseline)) <= tol
+
+#########################
+#### WEIGHTED MEDIAN ####
+#########################
+
+def test_weighted_median_matches_sort():
+    """The O(n) selection of weighted_median agrees exactly with the sort and cumulative sum implementation, including the percentiles used in the code.
+    """
+    rng = np.random.default_rng(42)
+    for _ in range(5000):
+        x = rng.normal(0, 1, rng.integers(1, 50))
+        ties = rng.random(x.size) < 0.3
+        x[ties] = np.round(x[ties], 1)
+        x[rng.random(x.size) < 0.1] = np.nan
+        x[rng.random(x.size) < 0.05] = np.inf
+        percentile = rng.choice([0.5, 0.99, rng.random()])
+        wm_sort, wm_selection = weighted_median_baseline(x, percentile=percentile), pcmath.weighted_median(x, percentile=percentile)
+        assert wm_sort == wm_selection or (np.isnan(wm_sort) and np.isnan(wm_selection))
+
+#####################
+#### CONVOLUTION ####
+#####################
+
+def random_flux(rng, nx):
+    x = np.arange(nx)
+    flux = np.ones(nx)
+    for c in rng.uniform(0, nx, nx // 20):
+        flux *= 1 - rng.uniform(0, 0.5) * np.exp(-0.5 * ((x - c) / rng.uniform(1, 5))**2)
+    return flux + rng.normal(0, 1E-3, nx)
+
+def random_kernel(rng, nk):
+    x = np.arange(-(nk // 2), nk // 2 + 1) / rng.uniform(nk / 20, nk / 8)
+    herm = pcmath.hermfun(x, 2)
+    lsf = herm[:, 0] + rng.uniform(-0.1, 0.1) * herm[:, 1] + rng.uniform(-0.1, 0.1) * herm[:, 2]
+    return lsf / np.sum(lsf)
+
+@pytest.mark.parametrize("nx, nk", [(12000, 101), (12000, 1001), (12000, 2049), (500, 7)])
+@pytest.mark.parametrize("method", [None, "direct", "fft"])
+def test_flux_convolver_matches_convolve_flux(nx, nk, method):
+    """FluxConvolver agrees with the previous convolve_flux for a given kernel, for kernels shorter than the maximum and flux with nans.
+    """
+    rng = np.random.default_rng(3)
+    convolver = pcmath.FluxConvolver(nx, nk, method=method)
+    for _ in range(10):
+        flux = random_flux(rng, nx)
+        nk_trial = nk if rng.random() < 0.5 else 2 * rng.integers(0, nk // 2 + 1) + 1
+        if rng.random() < 0.3:
+            flux[rng.random(nx) < 0.01] = np.nan
+        lsf = random_kernel(rng, nk_trial)
+        fluxc = convolver.convolve(flux, lsf)
+        fluxc_baseline = convolve_flux_baseline(flux, lsf)
+        assert np.array_equal(np.isnan(fluxc), np.isnan(fluxc_baseline))
+        assert np.nanmax(np.abs(fluxc - fluxc_baseline)) < 1E-12
+
+@pytest.mark.parametrize("method", ["direct", "fft"])
+def test_flux_convolver_torch_matches_convolve(method):
+    """convolve_torch agrees with convolve, for kernels shorter than the maximum.
+    """
+    torch = pytest.importorskip("torch")
+    rng = np.random.default_rng(4)
+    nx, nk = 3000, 301
+    convolver = pcmath.FluxConvolver(nx, nk, method=method)
+    for nk_trial in [nk, 101, 1]:
+        flux = random_flux(rng, nx)
+        lsf = random_kernel(rng, nk_trial)
+        fluxc = convolver.convolve_torch(torch.from_numpy(flux), torch.from_numpy(lsf)).numpy()
+        assert fluxc.shape == (nx,)
+        assert np.max(np.abs(fluxc - convolver.convolve(flux, lsf))) < 1E-12
+
+#######################
+#### INTERPOLATION ####
+#######################
+
+def random_y(rng, x):
+    y = np.ones(x.size)
+    for c in rng.uniform(x[0], x[-1], x.size // 20):
+        y *= 1 - rng.uniform(0, 0.5) * np.exp(-0.5 * ((x - c) / rng.uniform(0.01, 0.05))**2)
+    return y
+
+def random_target(rng, x, n):
+    xnew = np.sort(rng.uniform(x[0] - 1, x[-1] + 1, n))
+    xnew[rng.integers(0, n)] = x[rng.integers(0, x.size)]
+    return xnew
+
+@pytest.mark.parametrize("grid", ["uniform", "non-uniform"])
+@pytest.mark.parametrize("target", ["fixed", "new"])
+def test_cubic_spline_interp_matches_cspline_interp(grid, target):
+    """CubicSplineInterp agrees with the previous cspline_interp for targets beyond the source grid and y with nans (the fallback).
+    """
+    rng = np.random.default_rng(5)
+    nx, nx_target = 12000, 1500
+    x = np.linspace(22000, 22300, nx) if grid == "uniform" else np.sort(rng.uniform(22000, 22300, nx))
+    xnew = random_target(rng, x, nx_target)
+    interp = pcmath.CubicSplineInterp(x, xnew)
+    for _ in range(20):
+        y = random_y(rng, x)
+        if rng.random() < 0.3:
+            y[rng.random(nx) < 0.01] = np.nan
+        if target == "new":
+            xnew = random_target(rng, x, nx_target)
+        ynew = interp(y, xnew)
+        ynew_baseline = cspline_interp_baseline(x, y, xnew)
+        assert np.array_equal(np.isnan(ynew), np.isnan(ynew_baseline))
+        assert np.nanmax(np.abs(ynew - ynew_baseline)) / np.nanmax(np.abs(y)) < 1E-12
+
+def test_cubic_spline_interp_target_modified_in_place():
+    """A target grid modified in place by the caller is not served the weights of its old values.
+    """
+    x = np.linspace(0, 10, 200)
+    y = np.sin(x)
+    xnew = np.linspace(0.5, 9.5, 1000)
+    interp = pcmath.CubicSplineInterp(x, xnew)
+    interp(y, xnew)
+    xnew += 0.05
+    assert np.nanmax(np.abs(interp(y, xnew) - pcmath.cspline_interp(x, y, xnew))) < 1E-12
+
+#######################
+#### DOPPLER SHIFT ####
+#######################
+
+@pytest.fixture(scope="module")
+def stellar_spectrum():
+    """A stellar template with masked points, and a data grid which extends beyond the shifted template for the largest velocities.
+    """
+    rng = np.random.default_rng(11)
+    wave = np.arange(22000, 22300, 0.005)
+    flux = np.ones(wave.size)
+    for c in rng.uniform(22000, 22300, 600):
+        flux *= 1 - rng.uniform(0, 0.5) * np.exp(-0.5 * ((wave - c) / rng.uniform(0.03, 0.1))**2)
+    flux[rng.random(wave.size) < 0.001] = np.nan
+    wave_out = np.linspace(21999.9, 22300, 1900)
+    return wave, flux, wave_out
+
+@pytest.mark.parametrize("kind", ["exp", "sr"])
+@pytest.mark.parametrize("interp", [None, "cspline", "akima", "pchip", "linear"])
+def test_doppler_shift_multi_matches_doppler_shift(stellar_spectrum, kind, interp):
+    """doppler_shift_multi agrees with a loop of the previous doppler_shift over the trial velocities of brute_force_ccf, with nans in the same places.
+    """
+    wave, flux, wave_out = stellar_spectrum
+    vels = np.arange(-2000, 2000, 10).astype(float) + 1234.5
+    if interp is None:
+        out = pcmath.doppler_shift_multi(wave, vels, kind=kind, interp=None)
+        out_baseline = np.array([doppler_shift_baseline(wave, vel, kind=kind, interp=None) for vel in vels])
+    else:
+        out = pcmath.doppler_shift_multi(wave, vels, wave_out=wave_out, flux=flux, interp=interp, kind=kind)
+        out_baseline = np.array([doppler_shift_baseline(wave, vel, wave_out=wave_out, flux=flux, interp=interp, kind=kind) for vel in vels])
+    assert np.array_equal(np.isnan(out), np.isnan(out_baseline))
+    assert np.nanmax(np.abs(out - out_baseline)) < 1E-9
@@ -0,0 +1,108 @@
+# Base Python
+import copy
+import os
+
+# Maths
+import numpy as np
+
+# Testing
+import pytest
+
+# The spectral models need optimize
+pytest.importorskip("optimize")
+
+# Pychell deps
+import pychell.spectralmodeling.rvcalc as pcrvcalc
+import pychell.spectralmodeling.post_playground as pcpost
+from pychell.spectralmodeling.spectralrvprob import IterativeSpectralRVProb
+
+# Synthetic spectra and previous implementations
+from tests.synthetic_spectra import synthetic_data, synthetic_model, SyntheticParser
+from tests.baselines import compute_rv_contents_baseline
+
+# The problems have two observations per night
+n_spec = 4
+n_iterations = 2
+
+@pytest.fixture(params=[1, 3], ids=["unchunked", "chunked"])
+def specrvprob(request, templates_path):
+    """A problem constructed without a spectrograph, whose fits are filled with perturbed starting parameters, all with the same fit metric.
+    The best fit parameters of a chunked problem are only stored by its chunks.
+    """
+    rng = np.random.default_rng(7)
+    n_chunks = request.param
+    data = synthetic_data(templates_path, n_spec=n_spec)
+    bjds = 2459000.7 + np.repeat(np.arange(n_spec // 2), 2) + np.tile([0, 0.01], n_spec // 2)
+    specrvprob = IterativeSpectralRVProb.__new__(IterativeSpectralRVProb)
+    specrvprob.data = data
+    specrvprob.parser = SyntheticParser(templates_path)
+    specrvprob.spectral_model = synthetic_model(templates_path, data, n_iterations=n_iterations)
+    specrvprob.tag = "synthetic"
+    specrvprob.n_chunks, specrvprob.chunk_overlap = n_chunks, 50
+    specrvprob.opt_results = np.empty(shape=(n_spec, n_iterations), dtype=dict)
+    specrvprob.stellar_templates = np.empty(n_iterations, dtype=np.ndarray)
+    specrvprob.stellar_templates[0] = np.copy(specrvprob.spectral_model.templates_dict["star"])
+    specrvprob._init_chunks()
+    specrvprob.rvs_dict = {"bjds": bjds}
+    specrvprob.rvs_dict["bjds_nightly"], specrvprob.rvs_dict["n_obs_nights"] = pcrvcalc.gen_nightly_jds(bjds)
+    specrvprob.rvs_dict["rvsfwm"] = rng.normal(0, 5, size=(n_spec, n_iterations))
+    for chunk in specrvprob.chunks:
+        for j in range(1, n_iterations):
+            chunk.stellar_templates[j] = np.copy(chunk.stellar_templates[0])
+        for ispec in range(n_spec):
+            for j in range(n_iterations):
+                pbest = copy.deepcopy(chunk.p0)
+                for pname in pbest:
+                    if pbest[pname].vary:
+                        width = pbest[pname].upper_bound - pbest[pname].lower_bound
+                        pbest[pname].value += 1E-3 * (width if np.isfinite(width) else 1) * rng.uniform(-1, 1)
+                chunk.opt_results[ispec, j] = dict(pbest=pbest, fbest=0.01, fcalls=100, walltime=1.0)
+    if n_chunks > 1:
+        for j in range(n_iterations):
+            specrvprob.combine_chunk_fits(j)
+    return specrvprob
+
+def test_parse_parameters(specrvprob):
+    """parse_parameters returns the best fit parameters of an unchunked problem with the original shape, and refuses a chunked problem.
+    """
+    if len(specrvprob.chunks) > 1:
+        with pytest.raises(ValueError, match="parse_chunk_parameters"):
+            pcpost.parse_parameters([specrvprob])
+        return
+    pars = pcpost.parse_parameters([specrvprob])
+    assert pars.shape == (1, n_spec, n_iterations)
+    for ispec in range(n_spec):
+        for j in range(n_iterations):
+            assert pars[0, ispec, j] is specrvprob.opt_results[ispec, j]["pbest"]
+
+def test_parse_chunk_parameters(specrvprob):
+    """parse_chunk_parameters returns the best fit parameters of each chunk, always with a chunk axis.
+    """
+    chunks = specrvprob.chunks
+    pars = pcpost.parse_chunk_parameters([specrvprob])
+    assert pars.shape == (1, n_spec, len(chunks), n_iterations)
+    for ichunk, chunk in enumerate(chunks):
+        for ispec in range(n_spec):
+            for j in range(n_iterations):
+                assert pars[0, ispec, ichunk, j] is chunk.opt_results[ispec, j]["pbest"]
+
+def test_compute_rv_contents(specrvprob):
+    """compute_rv_contents equals the previous compute_rv_contents of each chunk as a problem on its own, combined in inverse quadrature.
+    For an unchunked problem this is the previous compute_rv_contents.
+    """
+    rvcs = pcpost.compute_rv_contents([specrvprob])
+    rvcs_chunks = np.zeros((len(specrvprob.chunks), n_iterations))
+    for ichunk, chunk in enumerate(specrvprob.chunks):
+        chunk.rvs_dict = specrvprob.rvs_dict
+        rvcs_chunks[ichunk] = compute_rv_contents_baseline([chunk])[0]
+    rvcs_expected = np.sum(1 / rvcs_chunks**2, axis=0)**-0.5
+    assert np.all(np.isfinite(rvcs))
+    assert np.max(np.abs(rvcs[0] - rvcs_expected) / rvcs_expected) < 1E-10
+
+def test_parameter_corrs(specrvprob, tmp_path):
+    """parameter_corrs writes a figure for each chunk.
+    """
+    path = str(tmp_path) + os.sep
+    os.makedirs(f"{path}Order{specrvprob.order_num}")
+    pcpost.parameter_corrs(path, [specrvprob], {"rvsfwm": specrvprob.rvs_dict["rvsfwm"][None, :, :]})
+    assert len(os.listdir(f"{path}Order{specrvprob.order_num}")) == len(specrvprob.chunks)
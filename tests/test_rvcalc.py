@@ -0,0 +1,37 @@
+# Maths
+import numpy as np
+
+# Pychell deps
+import pychell.maths as pcmath
+import pychell.spectralmodeling.rvcalc as pcrvcalc
+
+# Previous implementations
+from tests.baselines import combine_rvs_weighted_mean_baseline
+
+def test_combine_rvs_weighted_mean_matches_baseline():
+    """The nightly RVs and uncertainties of combine_rvs_weighted_mean are unchanged. The per-observation uncertainties are the values the previous implementation wrote into the RVs, and the RVs are the weighted means of the offset RVs.
+    """
+    rng = np.random.default_rng(42)
+    for _ in range(200):
+
+        # Random RVs and weights with bad RVs given zero weight, as in the callers
+        n_orders, n_chunks = rng.integers(1, 5), rng.integers(1, 4)
+        n_obs_nights = rng.integers(1, 5, size=rng.integers(1, 6))
+        n_obs = np.sum(n_obs_nights)
+        rvs = rng.normal(0, 5, size=(n_orders, n_obs, n_chunks)) + rng.normal(0, 100, size=(n_orders, 1, n_chunks))
+        weights = rng.uniform(0.1, 1, size=rvs.shape)
+        bad = rng.random(rvs.shape) < 0.1
+        rvs[bad] = np.nan
+        weights[bad] = 0
+
+        rvs_out = pcrvcalc.combine_rvs_weighted_mean(rvs, weights, n_obs_nights)
+        rvs_out_baseline = combine_rvs_weighted_mean_baseline(rvs, weights, n_obs_nights)
+
+        # The RVs are the weighted means of the RVs with the weighted mean of each order and chunk removed
+        rvs_offset = rvs - np.array([[pcmath.weighted_mean(rvs[o, :, ichunk], weights[o, :, ichunk]) for ichunk in range(n_chunks)] for o in range(n_orders)])[:, None, :]
+        rvs_expected = np.array([pcmath.weighted_mean(rvs_offset[:, i, :], weights[:, i, :]) if np.any(weights[:, i, :] > 0) else np.nan for i in range(n_obs)])
+
+        assert np.array_equal(rvs_out["rvs_nightly"], rvs_out_baseline["rvs_nightly"], equal_nan=True)
+        assert np.array_equal(rvs_out["unc_nightly"], rvs_out_baseline["unc_nightly"], equal_nan=True)
+        assert np.array_equal(rvs_out["unc"], rvs_out_baseline["rvs"], equal_nan=True)
+        assert np.allclose(rvs_out["rvs"], rvs_expected, rtol=0, atol=1E-10, equal_nan=True)
@@ -0,0 +1,276 @@
+# Base Python
+import copy
+import warnings
+
+# Maths
+import numpy as np
+import scipy.optimize
+
+# Testing
+import pytest
+
+# The spectral models need optimize
+pytest.importorskip("optimize")
+
+# Pychell deps
+import pychell.maths as pcmath
+import pychell.spectralmodeling.spectralmodels as pcsm
+from pychell.spectralmodeling.spectral_objectives import WeightedSpectralUncRMS
+from pychell.spectralmodeling.spectral_optimizers import LevenbergMarquardt
+
+# Synthetic spectra and previous implementations
+from tests.synthetic_spectra import synthetic_data, synthetic_model
+from tests.baselines import weighted_median_baseline
+
+def initialized_model(templates_path, data, vel=1234.0, **kwargs):
+    """A synthetic model initialized for an observation with the stellar RV set to vel.
+    """
+    spectral_model = synthetic_model(templates_path, [data], **kwargs)
+    p0 = spectral_model.p0
+    p0[spectral_model.star.par_names[0]].value = vel
+    spectral_model.initialize(p0, data, iter_index=1)
+    return spectral_model
+
+########################
+#### FLUX PRECISION ####
+########################
+
+def test_float32_flux_rvs(templates_path):
+    """RVs fit with a float32 (flux_dtype) model agree with a float64 model to well below the photon noise.
+    Each spectrum is generated from the float64 model, and only the stellar RV is fit, so any difference is due to the flux precision.
+    """
+    rng = np.random.default_rng(42)
+    n_spec, snr = 10, 200
+    data = synthetic_data(templates_path, n_spec=n_spec, snr=snr)
+    models = {dtype: synthetic_model(templates_path, data, model_resolution=8, flux_dtype=dtype) for dtype in [np.float64, np.float32]}
+    vel_name = models[np.float64].star.par_names[0]
+
+    def fit_rv(spectral_model, d, vel_guess):
+        pars = spectral_model.p0
+        mask = d.mask == 1
+        def rms(vel):
+            pars[vel_name].value = vel
+            _, model_flux = spectral_model.build(pars)
+            return np.sqrt(np.nanmean(((d.flux[mask] - model_flux[mask]) / d.flux_unc[mask])**2))
+        return scipy.optimize.minimize_scalar(rms, bounds=(vel_guess - 500, vel_guess + 500), method='bounded', options={'xatol': 1E-4}).x
+
+    rvs_true = rng.uniform(-2E4, 2E4, n_spec)
+    rvs = {dtype: np.zeros(n_spec) for dtype in models}
+    for i in range(n_spec):
+        p0 = models[np.float64].p0
+        p0[vel_name].value = rvs_true[i]
+        for spectral_model in models.values():
+            spectral_model.initialize(p0, data[i], iter_index=1)
+        _, model_flux = models[np.float64].build(p0)
+        data[i].flux = model_flux + rng.normal(0, 1 / snr, model_flux.size)
+        data[i].flux[data[i].mask == 0] = np.nan
+        vel_guess = rvs_true[i] + rng.uniform(-100, 100)
+        for dtype, spectral_model in models.items():
+            rvs[dtype][i] = fit_rv(spectral_model, data[i], vel_guess)
+
+    assert np.max(np.abs(rvs[np.float32] - rvs[np.float64])) < 1
+    assert np.std(rvs[np.float64] - rvs_true) < 20
+
+#############################
+#### CONVOLVE AND SAMPLE ####
+#############################
+
+def test_convolve_and_sample_matches_two_stage(templates_path):
+    """The one step convolve and sample path of build agrees with the two stage path, and both agree with a two stage model at 4x the model resolution.
+    """
+    data = synthetic_data(templates_path)[0]
+    fluxes = {}
+    for key, model_resolution, convolve_and_sample in [("two stage", 8, False), ("one step", 8, True), ("reference", 32, False)]:
+        spectral_model = initialized_model(templates_path, data, model_resolution=model_resolution, convolve_and_sample=convolve_and_sample)
+        fluxes[key] = spectral_model.build(spectral_model.p0)[1]
+    good = np.isfinite(fluxes["two stage"]) & np.isfinite(fluxes["one step"]) & np.isfinite(fluxes["reference"])
+    assert np.max(np.abs(fluxes["one step"] - fluxes["two stage"])[good]) < 1E-5
+    for key in ["two stage", "one step"]:
+        assert np.max(np.abs(fluxes[key] - fluxes["reference"])[good]) < 1E-3
+
+###################
+#### TELLURICS ####
+###################
+
+def test_tellurics_fast_matches_current(templates_path):
+    """The fast log template path of TelluricsTAPAS agrees with depth scaling the templates then Doppler shifting them, over the velocities and the bounds and start values of both depths.
+    """
+    data = synthetic_data(templates_path)[0]
+    models = {fast: initialized_model(templates_path, data, gas_cell=None, tellurics=dict(fast=fast), model_resolution=8) for fast in [False, True]}
+    par_names = models[False].tellurics.par_names
+    for vel in np.linspace(-300, 300, 7):
+        for water_depth in [0.05, 1.1, 5.0]:
+            for airmass_depth in [0.8, 1.1, 3.0]:
+                tellurics_flux, model_flux = {}, {}
+                for fast, spectral_model in models.items():
+                    pars = spectral_model.p0
+                    pars[par_names[0]].value = vel
+                    pars[par_names[1]].value = water_depth
+                    pars[par_names[2]].value = airmass_depth
+                    tellurics_flux[fast] = spectral_model.tellurics.build(pars, spectral_model.templates_dict["tellurics"], spectral_model.model_wave)
+                    model_flux[fast] = spectral_model.build(pars)[1]
+                good = np.isfinite(model_flux[False]) & np.isfinite(model_flux[True])
+                assert np.nanmax(np.abs(tellurics_flux[True] - tellurics_flux[False])) < 1E-4
+                assert np.max(np.abs(model_flux[True] - model_flux[False])[good]) < 1E-5
+
+####################
+#### MODEL GRID ####
+####################
+
+def test_model_grid_within_region(templates_path):
+    """The model grid is np.arange(wavemin, wavemax, model_dl) without any points past wavemax, where the splines are undefined.
+    The Jacobian of the residuals is finite for every model resolution where arange oversteps, and for a few where it does not.
+    """
+    data = synthetic_data(templates_path)
+    sregion = synthetic_model(templates_path, data).sregion
+    overstep = []
+    for model_resolution in np.arange(4, 16, 0.001):
+        model_dl = (1 / sregion.pix_per_wave()) / model_resolution
+        if np.arange(sregion.wavemin, sregion.wavemax, model_dl)[-1] > sregion.wavemax:
+            overstep.append(model_resolution)
+    assert len(overstep) > 0
+    for model_resolution in overstep + [4, 8, 12]:
+        spectral_model = synthetic_model(templates_path, data, model_resolution=model_resolution)
+        p0 = spectral_model.p0
+        p0.sanity_lock()
+        spectral_model.initialize(p0, data[0], iter_index=1)
+        wave_arange = np.arange(spectral_model.sregion.wavemin, spectral_model.sregion.wavemax, spectral_model.model_dl)
+        assert np.array_equal(spectral_model.model_wave, wave_arange[wave_arange <= spectral_model.sregion.wavemax])
+        obj = WeightedSpectralUncRMS()
+        obj.initialize(spectral_model)
+        pars = spectral_model.p0
+        par_names = [pname for pname in pars if pars[pname].vary]
+        pixels, norm = obj.compute_residual_pixels(pars)
+        _, jac = obj.compute_residuals_and_jacobian(pars, pixels, norm, par_names)
+        assert np.all(np.isfinite(jac))
+
+#####################
+#### GRID CACHES ####
+#####################
+
+@pytest.mark.parametrize("gas_cell", ["dynamic", "perfect"])
+def test_grid_caches_model_grid_modified_in_place(templates_path, gas_cell):
+    """The continuum bases and the gas cell interpolators are not served the weights of a model grid modified in place, and cached outputs are read-only.
+    """
+    data = synthetic_data(templates_path)
+    spectral_model = synthetic_model(templates_path, data, gas_cell=gas_cell, cache_size=8)
+    pars = spectral_model.p0
+    spectral_model.initialize(pars, data[0], iter_index=1)
+    templates = spectral_model.templates_dict
+    model_wave = spectral_model.model_wave
+    spectral_model.continuum.build(pars, model_wave)
+    spectral_model.gas_cell.build(pars, templates["gas_cell"], model_wave)
+    model_wave += 0.01
+
+    # Each cached result is compared to the same call with a fresh cache
+    cached = spectral_model.continuum.build(pars, model_wave)
+    spectral_model.continuum.basis = None
+    assert np.nanmax(np.abs(cached - spectral_model.continuum.build(pars, model_wave))) < 1E-12
+    cached = spectral_model.gas_cell.build(pars, templates["gas_cell"], model_wave)
+    spectral_model.gas_cell.interpolator = None
+    assert np.nanmax(np.abs(cached - spectral_model.gas_cell.build(pars, templates["gas_cell"], model_wave))) < 1E-12
+    model_wave -= 0.01
+
+    # Cached outputs are read-only
+    spectral_model.build(pars)
+    data_wave, _ = spectral_model.build(pars)
+    with pytest.raises(ValueError):
+        data_wave += 1
+
+#########################
+#### WEIGHTED MEDIAN ####
+#########################
+
+def test_weighted_median_fits_match_sort(templates_path, monkeypatch):
+    """Fits with the O(n) selection of weighted_median (used to renormalize the model in build) give the same RVs and RMS as with the sort implementation.
+    """
+    rng = np.random.default_rng(42)
+    n_spec, snr = 4, 200
+    data = synthetic_data(templates_path, n_spec=n_spec, snr=snr)
+    spectral_model = synthetic_model(templates_path, data, gas_cell="perfect", model_resolution=8)
+    vel_name = spectral_model.star.par_names[0]
+
+    def fit(p0, d):
+        p0 = copy.deepcopy(p0)
+        p0.sanity_lock()
+        spectral_model.initialize(p0, d, iter_index=1)
+        obj = WeightedSpectralUncRMS()
+        spectral_model.obj = obj
+        obj.initialize(spectral_model)
+        optimizer = LevenbergMarquardt()
+        optimizer.initialize(obj)
+        return optimizer.optimize()
+
+    for i in range(n_spec):
+
+        # Synthesize the data
+        p0 = spectral_model.p0
+        p0[vel_name].value = rng.uniform(-2E4, 2E4)
+        spectral_model.initialize(p0, data[i], iter_index=1)
+        _, model_flux = spectral_model.build(p0)
+        data[i].flux = model_flux + rng.normal(0, 1 / snr, model_flux.size)
+        data[i].flux[data[i].mask == 0] = np.nan
+
+        # Fit with each path from the same offset, build looks up pcmath.weighted_median on each call
+        p0[vel_name].value += rng.uniform(-100, 100)
+        opt_result = fit(p0, data[i])
+        with monkeypatch.context() as m:
+            m.setattr(pcmath, "weighted_median", weighted_median_baseline)
+            opt_result_sort = fit(p0, data[i])
+        assert abs(opt_result["pbest"][vel_name].value - opt_result_sort["pbest"][vel_name].value) <= 1E-6
+        assert abs(opt_result["fbest"] - opt_result_sort["fbest"]) <= 1E-10
+
+###############
+#### TORCH ####
+###############
+
+class NoTorchFringing(pcsm.EmpiricalMult):
+    """A multiplicative component without build_torch.
+    """
+
+    name = "no_torch_fringing"
+
+    def build(self, pars, wave_final):
+        return 1 + 0.01 * np.sin(wave_final)
+
+@pytest.mark.parametrize("kwargs", [{}, {"tellurics": True}, {"truncate_tol": 1E-3}, {"fringing": NoTorchFringing()}], ids=["default", "tellurics", "truncated lsf", "no build_torch"])
+def test_build_torch_matches_build(templates_path, kwargs):
+    """build_torch agrees with build, and the gradient of compute_obj_and_grad agrees with forward differences of compute_obj. A model with a component without build_torch falls back to build.
+    """
+    torch = pytest.importorskip("torch")
+    rng = np.random.default_rng(42)
+    data = synthetic_data(templates_path)[0]
+    spectral_model = synthetic_model(templates_path, [data], **kwargs)
+    p0 = spectral_model.p0
+    p0.sanity_lock()
+    p0[spectral_model.star.par_names[0]].value = 1234.0
+    spectral_model.initialize(p0, data, iter_index=1)
+    _, model_flux = spectral_model.build(p0)
+    data.flux = model_flux + rng.normal(0, 0.005, model_flux.size)
+    data.flux[data.mask == 0] = np.nan
+    obj = WeightedSpectralUncRMS()
+    spectral_model.obj = obj
+    obj.initialize(spectral_model)
+
+    # Perturb the parameters within their bounds
+    pars = spectral_model.p0
+    for pname in pars:
+        if pars[pname].vary:
+            pars[pname].value += 0.01 * rng.uniform(-1, 1) * min(pars[pname].upper_bound - pars[pname].value, pars[pname].value - pars[pname].lower_bound)
+
+    # Models
+    wave, flux = spectral_model.build(pars)
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
+        wave_torch, flux_torch = spectral_model.build_torch({pname: torch.tensor(pars[pname].value, dtype=torch.float64) for pname in pars})
+    assert np.array_equal(np.isfinite(wave), np.isfinite(wave_torch.numpy()))
+    assert np.array_equal(np.isfinite(flux), np.isfinite(flux_torch.numpy()))
+    assert np.nanmax(np.abs(wave_torch.numpy() - wave)) < 1E-10
+    assert np.nanmax(np.abs(flux_torch.numpy() - flux)) < 1E-8
+    assert any("cannot be built with pytorch" in str(w.message) for w in caught) == ("fringing" in kwargs)
+
+    # Gradients, relative to the largest component
+    _, grad = obj.compute_obj_and_grad(pars)
+    _, grad_fd = obj.compute_obj_and_fd_grad(pars)
+    vary = np.array([pars[pname].vary for pname in pars])
+    assert np.max(np.abs(grad - grad_fd)[vary]) / np.max(np.abs(grad_fd)[vary]) < 1E-3